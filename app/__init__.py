@@ -1,18 +1,19 @@
 """
 This module initializes the Flask application 
 and sets up the necessary configurations and dependencies.
-"""
-import atexit
 
-import lgpio
+The camera and the GPIO line are owned by the capture daemon in app/daemon.py,
+the web workers reach it through the capture client.
+"""
 from flask import Flask
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 
-from app.camera import Camera
-from app.constants import BUTTON_PIN
+from app import database
+from app.constants import CAPTURE_SOCKET, DATABASE_URI, PREVIEW_SHARED_FILE
+from app.ipc import CaptureClient
 
-from eliot import to_file, Action, start_action, add_global_fields
+from eliot import to_file, add_global_fields
 import sys
 
 add_global_fields(process="server")
@@ -21,43 +22,27 @@ to_file(sys.stdout)
 # create and configure the app
 app = Flask(__name__)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///data.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options()
 socketio = SocketIO(app)
 db = SQLAlchemy(app)
 
 # Import models
-from app.models import Config, Race
+from app import models
+from app.models import Config
 
 with app.app_context():
+    database.setup(db)
     # Create the database
     db.create_all()
-
-    race = Race.query.filter_by(running=True).first()
-    # Stop any race that is running
-    if race is not None:
-        race.running = False
-        db.session.commit()
+    models.add_missing_columns()
+    models.add_missing_indexes()
 
     if Config.query.first() is None:
         db.session.add(Config())
         db.session.commit()
-    # Get values from database
-    config = Config.query.first()
-    rotation = config.rotation
-    resolution = (config.resolution_width, config.resolution_height)
 
-    camera = Camera(config.frames_per_second, config.flip_image, resolution)
-
-handle = lgpio.gpiochip_open(4)
-err = lgpio.gpio_claim_alert(handle, BUTTON_PIN, lgpio.BOTH_EDGES, lgpio.SET_PULL_UP)
-if err != 0:
-    print(f"Error: {lgpio.error_text(err)}")
-    exit(1)
-
-# Register cleanup function for normal exit
-atexit.register(lgpio.gpio_free, handle, BUTTON_PIN)
+capture = CaptureClient(CAPTURE_SOCKET, PREVIEW_SHARED_FILE)
 
 # Import views
 from app import views
-
-lgpio.callback(handle, BUTTON_PIN, lgpio.BOTH_EDGES, views.update_cage_status)
@@ -0,0 +1,151 @@
+"""
+This module contains the compaction of finished races into a single indexed frame store.
+
+The archive is built and verified next to the race in a background process, and then
+moved over the frames of the race by the server, which owns the readers of the race.
+"""
+import fnmatch
+import os
+import re
+import shutil
+import zlib
+
+import cv2
+import numpy as np
+
+from app.constants import ARCHIVE_ACTIVE_PADDING, ARCHIVE_DIRECTORY
+from app.finishline import load_crossings
+from app.framestore import (FrameStoreReader, FrameStoreWriter,
+                            has_frame_store, replace_store)
+
+_FRAME_NUMBER = re.compile(r"image_(\d+)\.jpg$")
+
+
+def loose_frames(directory):
+    """
+    Get the frames of a race that was recorded with one file per frame.
+
+    Args:
+        directory (str): The race directory.
+
+    Returns:
+        A list of (frame number, path) sorted by frame number.
+    """
+    frames = []
+    for name in fnmatch.filter(os.listdir(directory), "image*.jpg"):
+        match = _FRAME_NUMBER.match(name)
+        if match is not None:
+            frames.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(frames)
+
+
+def _read_loose_frames(directory, frame_interval):
+    frames = loose_frames(directory)
+    expected = 1
+    for number, path in frames:
+        # Missing files keep their frame number as empty records
+        while expected < number:
+            yield b"", (expected - 1) * frame_interval, False
+            expected += 1
+        with open(path, "rb") as frame:
+            yield frame.read(), (number - 1) * frame_interval, False
+        expected = number + 1
+
+
+def _read_store(directory, padding):
+    reader = FrameStoreReader(directory)
+    crossings = np.asarray(load_crossings(directory)["timestamps"], dtype=np.int64)
+    for frame_num, timestamp in enumerate(reader.timestamps.tolist(), start=1):
+        frame = reader.frame(frame_num)
+        idle = np.abs(crossings - timestamp).min() > padding
+        yield (b"" if frame is None else frame), timestamp, idle
+
+
+def _reencode(frame, quality):
+    image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return frame
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok or len(encoded) >= len(frame):
+        return frame
+    return encoded.tobytes()
+
+
+def build_archive(directory, frame_interval, idle_quality=None):
+    """
+    Write a compacted copy of the frames of a race and verify it.
+    This is run in a background process after the race.
+
+    Args:
+        directory (str): The race directory.
+        frame_interval (int): Nanoseconds between frames, used for races recorded
+            with one file per frame since those have no timestamps.
+        idle_quality (int): The JPEG quality to re-encode frames away from the crossings
+            with, or None to keep every frame as recorded. Re-encoding is lossy and
+            depends on the detected crossings, so it is only done when asked for.
+
+    Returns:
+        A dict with statistics of the archive, or None if there is nothing to compact.
+    """
+    if has_frame_store(directory):
+        # Without detected crossings there is no way to tell which frames matter
+        if idle_quality is None or not load_crossings(directory)["timestamps"]:
+            return None
+        source = _read_store(directory, ARCHIVE_ACTIVE_PADDING * 1e9)
+    else:
+        if not loose_frames(directory):
+            return None
+        source = _read_loose_frames(directory, frame_interval)
+
+    target = os.path.join(directory, ARCHIVE_DIRECTORY)
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    checksums = []
+    reencoded = 0
+    bytes_before = 0
+    try:
+        writer = FrameStoreWriter(target)
+        try:
+            for frame, timestamp, idle in source:
+                bytes_before += len(frame)
+                if idle and idle_quality is not None and len(frame) > 0:
+                    encoded = _reencode(frame, idle_quality)
+                    reencoded += encoded is not frame
+                    frame = encoded
+                writer.append(frame, timestamp)
+                checksums.append(zlib.crc32(frame))
+            writer.sync()
+        finally:
+            writer.close()
+        bytes_after = writer.bytes_written
+
+        reader = FrameStoreReader(target)
+        if len(reader) != len(checksums):
+            raise RuntimeError(f"Archive of {directory} has {len(reader)} of {len(checksums)} frames")
+        for frame_num, checksum in enumerate(checksums, start=1):
+            frame = reader.frame(frame_num)
+            if zlib.crc32(b"" if frame is None else frame) != checksum:
+                raise RuntimeError(f"Archive of {directory} differs at frame {frame_num}")
+    except BaseException:
+        shutil.rmtree(target, ignore_errors=True)
+        raise
+    return {
+        "frames": len(checksums),
+        "reencoded": reencoded,
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+    }
+
+
+def install_archive(directory):
+    """
+    Replace the frames of a race with its verified archive and remove the frame files it replaces.
+
+    Args:
+        directory (str): The race directory.
+    """
+    target = os.path.join(directory, ARCHIVE_DIRECTORY)
+    replace_store(directory, target)
+    for _, path in loose_frames(directory):
+        os.remove(path)
+    shutil.rmtree(target, ignore_errors=True)
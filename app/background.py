@@ -0,0 +1,65 @@
+"""
+This module contains the low priority process pool for work that is done after a race,
+so it never competes with the capture path for the CPU.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+
+from eliot import Action, start_action
+
+from app.constants import BACKGROUND_WORKERS
+
+_executor = None
+
+
+def _lower_priority():
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError):
+        os.nice(19)
+
+
+def start():
+    """
+    Start the worker processes.
+    This should be done before the camera and the GPIO threads are started, so the
+    workers are forked from a process without any other threads.
+    """
+    global _executor
+    if _executor is not None:
+        return
+    _executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=BACKGROUND_WORKERS,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_lower_priority,
+    )
+    # The pool forks all of its workers on the first submit
+    _executor.submit(os.getpid).result()
+
+
+def submit(action_type, function, *args):
+    """
+    Run a function in a worker process and log the outcome.
+
+    Args:
+        action_type (str): The eliot action type to log the job under.
+        function: The function to run, it must be defined at module level.
+        *args: The arguments to the function.
+
+    Returns:
+        A future for the result of the function.
+    """
+    start()
+    with start_action(action_type=action_type, args=[str(arg) for arg in args]) as action:
+        task_id = action.serialize_task_id()
+        future = _executor.submit(function, *args)
+
+    def done(future):
+        with Action.continue_task(task_id=task_id, action_type=f"{action_type}_done") as done_action:
+            error = future.exception()
+            if error is not None:
+                done_action.log(message_type="error", message=repr(error))
+
+    future.add_done_callback(done)
+    return future
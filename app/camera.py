@@ -1,42 +1,196 @@
+import collections
 import io
 import os
 import time
 
-import cv2
 import libcamera
 from picamera2 import MappedArray, Picamera2
 from picamera2.encoders import MJPEGEncoder
 from picamera2.outputs import FileOutput
 
-from eliot import start_action
+from eliot import Action, start_action
 import threading
 
-from app.constants import (RACE_DIRECTORY_BASE, STATIC_DIRECTORY,
-                           TIMESTAMP_COLOUR, TIMESTAMP_FONT, TIMESTAMP_ORIGIN,
-                           TIMESTAMP_SCALE, TIMESTAMP_THICKNESS)
+from app import metrics
+from app.finishline import FinishLineDetector
+from app.framestore import FrameStoreWriter
+from app.motion import MotionGate
+from app.writer import AsyncFrameWriter
+from app.constants import (CAPTURE_PREVIEW_FPS, PREVIEW_MAX_FPS,
+                           PREVIEW_RESOLUTION, RACE_DIRECTORY_BASE,
+                           STATIC_DIRECTORY, STORAGE_BYTES_PER_PIXEL,
+                           STRIP_DEFAULT_LINE)
+from app.overlay import TimestampRenderer
+from app.preview import PreviewBroadcaster
+from app.ringbuffer import FrameRingBuffer
+from app.slitscan import SlitScanStrip
+
+
+def sensor_timestamp(frame):
+    """
+    Get the time the sensor exposed the frame.
+
+    Args:
+        frame: The request from the camera.
+
+    Returns:
+        The SensorTimestamp of the frame as a monotonic time in nanoseconds.
+    """
+    return frame.get_metadata().get("SensorTimestamp", time.monotonic_ns())
+
+
+def preview_size(resolution):
+    """
+    Get the size of the preview stream for a resolution, as wide as PREVIEW_RESOLUTION
+    with the same aspect ratio as the resolution.
+
+    Args:
+        resolution (tuple): The size of the recorded image (width, height).
+    """
+    width, height = resolution
+    preview_width = min(PREVIEW_RESOLUTION[0], width)
+    return preview_width, min(round(preview_width * height / width / 2) * 2, height)
 
 
 class SplitFrames(io.BufferedIOBase):
     """
-    Splits a stream of MJPG bytes into separate jpeg frames.
+    Splits a stream of MJPG bytes into separate jpeg frames and hands them to a frame writer.
+
+    Until the recording window is opened the frames are kept in a ring buffer. When it is
+    opened the buffered frames inside the window are written retroactively, and after that
+    every frame inside the window is written as it arrives. Each frame is stored with its
+    sensor timestamp relative to the race start time.
+
+    With a motion gate the frames inside the window wait until the gate has decided on
+    them. Frames without motion nearby are stored as empty records, so they keep their
+    frame number and timestamp without using any space.
     """
 
-    def __init__(self, directory=None):
-        self.directory = directory
-        self.frame_num = 0
-        self.output = None
+    def __init__(self, writer, frame_period=None, gate=None):
+        """
+        Args:
+            writer: The AsyncFrameWriter to hand the frames to.
+            frame_period (int): Nanoseconds between frames, used to find gaps in the sensor timestamps.
+            gate (MotionGate): Decides which frames are stored, None to store every frame.
+        """
+        self.writer = writer
+        self.frame_period = frame_period
+        self.gate = gate
+        self.sensor_timestamp = None
+        self.race_start_time = None
+        self.window = None
+        self._ring = FrameRingBuffer()
+        self._lock = threading.Lock()
+        self._parts = None
+        self._timestamp = None
+        self._last_committed = None
+        # Frames inside the window waiting for the motion gate
+        self._pending = collections.deque()
 
     def write(self, buf):
         if buf.startswith(b"\xff\xd8"):
-            # Start of new frame; close the old one (if any) and
-            # open a new output
-            if self.output:
-                self.output.close()
-            self.frame_num += 1
-            self.output = io.open(
-                f"{self.directory}/image_{self.frame_num:04d}.jpg", "wb"
-            )
-        self.output.write(buf)
+            # Start of new frame; hand over the previous one
+            self.finish()
+            timestamp = self.sensor_timestamp
+            if timestamp is None:
+                timestamp = time.monotonic_ns()
+            self._parts = [buf]
+            self._timestamp = timestamp
+        elif self._parts is not None:
+            self._parts.append(buf)
+        return len(buf)
+
+    def finish(self):
+        """
+        Hand over the frame that is being collected, if any.
+        """
+        if self._parts is None:
+            return
+        if len(self._parts) == 1:
+            frame = self._parts[0]
+        else:
+            frame = b"".join(self._parts)
+        self._parts = None
+        metrics.encoder_latency_seconds.observe((time.monotonic_ns() - self._timestamp) / 1e9)
+        with self._lock:
+            if self.window is None:
+                self._ring.push(frame, self._timestamp)
+            else:
+                self._commit(frame, self._timestamp)
+
+    def _commit(self, frame, timestamp):
+        start, stop = self.window
+        if start <= timestamp < stop:
+            metrics.frames_received.inc()
+            last = self._last_committed
+            if last is not None and self.frame_period and timestamp - last > self.frame_period * 1.5:
+                metrics.frame_gaps.inc()
+                metrics.frames_missing.inc(round((timestamp - last) / self.frame_period) - 1)
+            self._last_committed = timestamp
+            if self.gate is None:
+                self.writer.submit(frame, timestamp - self.race_start_time)
+            else:
+                self._pending.append((frame, timestamp))
+        if self.gate is not None:
+            self._release()
+
+    def _release(self, flush=False):
+        """
+        Hand the waiting frames the motion gate has decided on to the writer.
+
+        Args:
+            flush (bool): Decide on every waiting frame with the motion seen so far.
+        """
+        gate = self.gate
+        while self._pending and (flush or gate.decided(self._pending[0][1])):
+            frame, timestamp = self._pending.popleft()
+            if gate.keep(timestamp):
+                self.writer.submit(frame, timestamp - self.race_start_time)
+            else:
+                metrics.frames_skipped.inc()
+                self.writer.submit(b"", timestamp - self.race_start_time)
+
+    def flush(self):
+        """
+        Hand over the frame that is being collected and every frame waiting for the motion gate.
+        """
+        self.finish()
+        with self._lock:
+            if self.gate is not None:
+                self._release(flush=True)
+
+    def open_window(self, race_start_time, start, stop):
+        """
+        Start writing frames, beginning with the buffered frames that are inside the window.
+
+        Args:
+            race_start_time (int): The start time of the race as a monotonic time in nanoseconds.
+            start (int): The monotonic time of the first frame to write.
+            stop (int): The monotonic time after which no frames are written.
+        """
+        with self._lock:
+            self.race_start_time = race_start_time
+            self.window = (start, stop)
+            for frame, timestamp in self._ring.drain():
+                self._commit(frame, timestamp)
+
+
+class FrameOutput(FileOutput):
+    """
+    File output that hands the sensor timestamp of each encoded frame to SplitFrames.
+    """
+
+    def __init__(self, split_frames, encoder):
+        super().__init__(split_frames)
+        self.split_frames = split_frames
+        self.encoder = encoder
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        # The encoder reports microseconds since its first frame
+        first_timestamp = getattr(self.encoder, "firsttimestamp", None)
+        if timestamp is not None and first_timestamp is not None:
+            self.split_frames.sensor_timestamp = (first_timestamp + timestamp) * 1000
+        super().outputframe(frame, keyframe, timestamp, *args, **kwargs)
 
 
 class Camera:
@@ -44,25 +198,77 @@ class Camera:
     Represents a camera used for recording races and capturing photos.
     """
 
-    def __init__(self, frames_per_second=100, flip_image=False, resolution=(1332, 990)):
+    def __init__(
+        self, frames_per_second=100, flip_image=False, resolution=(1332, 990), profiles=None, profile="standard"
+    ):
         """
         Initializes a Camera object.
 
+        A configuration is made up front for every capture profile, one to record races
+        with and one to show the preview with while no race is armed. The preview uses the
+        sensor mode of the race so the image does not move when the camera switches between them.
+
         Args:
-            frames_per_second (int): The desired frames per second for recording.
+            frames_per_second (int): The desired frames per second for recording with the standard profile.
             flip_image (bool): Whether to flip the recorded image horizontally and vertically.
-            resolution (tuple): The resolution of the recorded image (width, height).
+            resolution (tuple): The resolution of the recorded image (width, height) with the standard profile.
+            profiles (dict): More capture profiles by name, each with frames_per_second,
+                resolution and sensor_size.
+            profile (str): The name of the profile to record the next race with.
         """
         self.picam2 = Picamera2()
+        self.profiles = {
+            "standard": {
+                "frames_per_second": frames_per_second,
+                "resolution": resolution,
+                "sensor_size": resolution,
+            },
+            **(profiles or {}),
+        }
+        if profile not in self.profiles:
+            profile = "standard"
+        self.profile = profile
+        self.frames_per_second = self.profiles[profile]["frames_per_second"]
+        self._configurations = {}
+        for name, settings in self.profiles.items():
+            lores = preview_size(settings["resolution"])
+            self._configurations[(name, "race")] = self._video_configuration(
+                settings["frames_per_second"], settings["resolution"], lores, settings["sensor_size"], flip_image
+            )
+            self._configurations[(name, "preview")] = self._video_configuration(
+                min(CAPTURE_PREVIEW_FPS, settings["frames_per_second"]), lores, lores, settings["sensor_size"], flip_image
+            )
+        self._mode = (profile, "preview")
+        self.picam2.configure(self._configurations[self._mode])
+        self.picam2.start()
+        self.timestamp_renderer = TimestampRenderer()
+        self.prepare_timestamp()
+        self.preview = PreviewBroadcaster(self.picam2)
+        self.encoder = None
+        self.output = None
+        self.writer = None
+        self.race_start_time = None
+        # The recording window, the metrics when the camera was armed and the task to summarise them in
+        self.window = None
+        self._metrics_before = None
+        self._task_id = None
+        self.motion_gate = None
+        # Bytes per pixel of the frames of the last race, to estimate what a profile writes to the disk.
+        # The capture daemon keeps it in the configuration between starts.
+        self.bytes_per_pixel = STORAGE_BYTES_PER_PIXEL
+        # Steps that look at every frame of a race before it is encoded
+        self.stages = []
+        self._writer_lock = threading.Lock()
 
+    def _video_configuration(self, frames_per_second, main_size, lores_size, sensor_size, flip_image):
         frame_duration_limit = int(1000000 / frames_per_second)
-
-        video_config = self.picam2.create_video_configuration(
+        return self.picam2.create_video_configuration(
             transform=libcamera.Transform(hflip=flip_image, vflip=flip_image),
-            main={"size": resolution, "format": "YUV420"},  # More efficient format for high FPS
+            main={"size": main_size, "format": "YUV420"},  # More efficient format for high FPS
+            lores={"size": lores_size, "format": "YUV420"},  # Encoded for the preview stream
             buffer_count=16,  # Further increased buffer count to handle frame processing
             encode="main",  # Encode from the main stream
-            sensor={"output_size": resolution, "bit_depth": 8},  # Use 8-bit depth
+            sensor={"output_size": sensor_size, "bit_depth": 8},  # Use 8-bit depth
             controls={
                 "FrameDurationLimits": (frame_duration_limit, frame_duration_limit),
                 "FrameRate": frames_per_second,
@@ -75,8 +281,50 @@ class Camera:
             },
             queue=8  # Further increased queue size for smoother processing
         )
-        self.picam2.configure(video_config)
-        self.picam2.start()
+
+    def _switch_mode(self, mode):
+        """
+        Switch the running camera to one of the prepared configurations.
+        Picamera2 stops the camera, configures it and starts it again, like any change of
+        configuration, so this takes as long as a restart of the camera and is only done
+        when no frames are recorded. The preview encoder is stopped meanwhile since the
+        size of its stream may change.
+
+        Args:
+            mode (tuple): The name of the profile and "race" or "preview".
+        """
+        if mode == self._mode:
+            return
+        with start_action(action_type="switch_capture_mode", profile=mode[0], mode=mode[1]):
+            with self.preview.paused():
+                self.picam2.switch_mode(self._configurations[mode])
+            self._mode = mode
+
+    def select_profile(self, profile):
+        """
+        Choose the capture profile to record the next race with.
+        The preview switches to the sensor mode of the profile unless a race is armed.
+
+        Args:
+            profile (str): The name of the profile.
+        """
+        if profile not in self.profiles:
+            raise ValueError(f"Unknown capture profile: {profile}")
+        self.profile = profile
+        if self.output is None:
+            self._switch_mode((profile, "preview"))
+
+    def byte_rate(self, profile):
+        """
+        Estimate the bytes per second a profile writes to the disk, from the frame rate,
+        the resolution and the size of the frames of the last race.
+
+        Args:
+            profile (str): The name of the profile.
+        """
+        settings = self.profiles[profile]
+        width, height = settings["resolution"]
+        return settings["frames_per_second"] * width * height * self.bytes_per_pixel
 
     def start_camera(self):
         """
@@ -87,119 +335,184 @@ class Camera:
     def apply_timestamp(self, frame, race_start_time):
         """
         Apply a timestamp to the given frame based on the race start time.
-        The timestamp is calculated as the difference between the current time and the race start time.
+        The timestamp is calculated as the difference between the sensor timestamp
+        of the frame and the race start time.
 
         Args:
             frame: The frame to apply the timestamp to.
             race_start_time: The start time of the race.
         """
-        elapsed_ns = time.monotonic_ns() - race_start_time
-        elapsed_cs = round(elapsed_ns / 10_000_000)  # centiseconds (hundredths of a second)
-        timestamp = f"{elapsed_cs / 100:0>5.2f}"
+        elapsed_ns = sensor_timestamp(frame) - race_start_time
         with MappedArray(frame, "main") as m:
-            cv2.putText(
-                m.array,
-                timestamp,
-                TIMESTAMP_ORIGIN,
-                TIMESTAMP_FONT,
-                TIMESTAMP_SCALE,
-                TIMESTAMP_COLOUR,
-                TIMESTAMP_THICKNESS,
-            )
+            self.timestamp_renderer.render(m.array, elapsed_ns)
 
-    def start_film(
-        self,
-        current_race,
-        race_start_time,
-        start_filming_after,
-        stop_filming_after,
-        callback_func,
-    ):
+    def pre_callback(self, frame):
+        """
+        Called by the camera for every frame before it is encoded.
+        The goal line is sampled before the timestamp is drawn, and frames captured
+        before the race start time is known get no timestamp.
+        """
+        started = time.perf_counter_ns()
+        timestamp = sensor_timestamp(frame)
+        race_start_time = self.race_start_time
+        with MappedArray(frame, "main") as m:
+            for stage in self.stages:
+                stage.process(m.array, timestamp)
+            if race_start_time is not None:
+                self.timestamp_renderer.render(m.array, timestamp - race_start_time)
+        gate = self.motion_gate
+        if gate is not None:
+            with MappedArray(frame, "lores") as lores:
+                gate.process(lores.array, timestamp)
+        metrics.pre_callback_seconds.observe((time.perf_counter_ns() - started) / 1e9)
+
+    def prepare_timestamp(self):
+        """
+        Render the glyphs of the race clock for the current configuration of the main stream.
         """
-        Start recording the race and apply timestamps to the frames.
-        The recording starts after the specified start_filming_after time
-        and stops after the specified stop_filming_after time.
+        main = self.picam2.camera_configuration()["main"]
+        width, height = main["size"]
+        # The YUV420 main stream is mapped as one array with the Y plane on top
+        self.timestamp_renderer.prepare((height * 3 // 2, main.get("stride", width)))
+
+    def arm(self, current_race, goal_line=None, reserve=0, motion_gate=False):
+        """
+        Start encoding frames into the pre-trigger ring buffer so the recording
+        can start without waiting for the encoder when the race starts.
 
         Args:
-            current_race: The current race object.
-            race_start_time: The start time of the race.
-            start_filming_after: The time to wait before starting the recording.
-            stop_filming_after: The time to stop the recording after starting.
-            callback_func: The callback function to be called after the recording stops.
+            current_race: The race that is about to start.
+            goal_line (tuple): The goal line (x1, y1, x2, y2) as fractions of the image size,
+                crossings of it are detected and the photo finish strip is taken along it.
+            reserve (int): Bytes to allocate on the disk for the frames before the race starts.
+            motion_gate (bool): Only store the frames with motion in the low resolution stream nearby.
         """
-        with start_action(action_type="start_film") as action:
-            self.picam2.pre_callback = lambda frame: self.apply_timestamp(
-                frame, race_start_time
-            )
+        with start_action(action_type="arm_camera", profile=self.profile) as action:
+            self._switch_mode((self.profile, "race"))
+            self.frames_per_second = self.profiles[self.profile]["frames_per_second"]
+            self.prepare_timestamp()
+            self.race_start_time = None
+            self.window = None
+            self._metrics_before = metrics.snapshot()
+            self._task_id = action.serialize_task_id()
+            size = self.picam2.camera_configuration()["main"]["size"]
+            if goal_line is None:
+                self.stages = [SlitScanStrip(STRIP_DEFAULT_LINE, size)]
+            else:
+                self.stages = [FinishLineDetector(goal_line, size), SlitScanStrip(goal_line, size)]
+            gate = None
+            if motion_gate:
+                gate = MotionGate(self.picam2.camera_configuration()["lores"]["size"])
+            self.motion_gate = gate
+            self.picam2.pre_callback = self.pre_callback
             encoder = MJPEGEncoder(10000000)
             race_directory = (
                 STATIC_DIRECTORY + RACE_DIRECTORY_BASE + current_race.start_time
             )
             os.makedirs(race_directory)
-            output = SplitFrames(directory=race_directory)
+            writer = AsyncFrameWriter(
+                FrameStoreWriter(race_directory, reserve=reserve),
+                task_id=action.serialize_task_id(),
+            )
+            output = SplitFrames(writer, 1_000_000_000 // self.frames_per_second, gate)
+            with self._writer_lock:
+                self.encoder, self.output, self.writer = encoder, output, writer
+            # Only the encoder of the main stream is started so preview streams keep running
+            self.picam2.start_encoder(encoder, FrameOutput(output, encoder), name="main")
+            if not self.picam2.started:
+                self.picam2.start()
+
+    def start_film(self, race_start_time, start_filming_after, stop_filming_after):
+        """
+        Record the race and apply timestamps to the frames.
+        The saved frames start start_filming_after seconds after the race start time
+        and end stop_filming_after seconds after it, frames from before the call are
+        taken from the pre-trigger ring buffer.
+        The recording goes on until stop_film() is called, which should be done at the returned stop time.
+
+        Args:
+            race_start_time: The start time of the race.
+            start_filming_after: The time after the race start to start the recording.
+            stop_filming_after: The time after the race start to stop the recording.
 
-            # race_start_time is a monotonic time
-            start_delay = (time.monotonic_ns() - race_start_time)/1e9
-            time_to_sleep = start_filming_after - start_delay
-            if time_to_sleep > 0:
-                time.sleep(start_filming_after)
+        Returns:
+            The stop time of the recording as a monotonic time in nanoseconds,
+            or None if the camera is not armed.
+        """
+        with start_action(action_type="start_film") as action:
+            output = self.output
+            if output is None:
+                action.log(message_type="warn", message="Camera is not armed")
+                return None
+            self.race_start_time = race_start_time
+            start_time = race_start_time + int(start_filming_after * 1e9)
+            stop_time = race_start_time + int(stop_filming_after * 1e9)
+            self.window = (start_time, stop_time)
+            for stage in self.stages:
+                stage.window = (start_time, stop_time)
+            output.open_window(race_start_time, start_time, stop_time)
             action.log(message_type="debug", message="Start recording")
-            self.picam2.start_recording(encoder, FileOutput(output))
-            time.sleep(stop_filming_after - start_delay)
-            if self.picam2.started:
-                callback_func(current_race)
-                action.log(message_type="debug", message="Recording stopped")
-            else:
-                action.log(message_type="warn", message="Recording already stopped")
+            return stop_time
 
     def stop_film(self):
         """
         Stop the recording.
         """
         start_action(action_type="stop_film")
-        self.picam2.stop_recording()
+        with self._writer_lock:
+            encoder, output, writer = self.encoder, self.output, self.writer
+            self.encoder, self.output, self.writer = None, None, None
+        if encoder is not None:
+            self.picam2.stop_encoder(encoder)
         self.picam2.pre_callback = None
+        race_start_time, stages = self.race_start_time, self.stages
+        self.race_start_time, self.stages = None, []
+        self.motion_gate = None
+        if writer is not None:
+            output.flush()
+            writer.close()
+            if race_start_time is not None:
+                for stage in stages:
+                    stage.save(writer.store.directory, race_start_time)
+            self.log_metrics()
+            self._switch_mode((self.profile, "preview"))
+
+    def log_metrics(self):
+        """
+        Log how the frames of the race went through the pipeline, in the task where the camera was armed.
+        """
+        if self._metrics_before is None:
+            return
+        recorded = 0
+        if self.window is not None:
+            start, stop = self.window
+            recorded = max(min(stop, time.monotonic_ns()) - start, 0)
+        metrics.race_frames_expected.set(recorded * self.frames_per_second // 1_000_000_000)
+        summary = metrics.summary(self._metrics_before)
+        stored = summary[metrics.frames_written.name] - summary[metrics.frames_skipped.name]
+        if stored > 0:
+            width, height = self.picam2.camera_configuration()["main"]["size"]
+            self.bytes_per_pixel = summary[metrics.bytes_written.name] / stored / (width * height)
+        self._metrics_before, self.window = None, None
+        action = Action.continue_task(task_id=self._task_id, action_type="race_metrics")
+        with action:
+            action.add_success_fields(**{
+                name.removeprefix("photofinish_"): value for name, value in summary.items()
+            })
 
-    def get_video_stream(self):
+    def get_video_stream(self, max_fps=PREVIEW_MAX_FPS, until=None):
         """
-        Stream video from the camera.
-        
+        Stream video from the low resolution preview stream of the camera.
+        All streams share one encoder, so a race can be recorded while they are open.
+
+        Args:
+            max_fps (float): The maximum number of frames per second for this stream.
+            until: A function that returns True when the stream should end, see PreviewBroadcaster.frames().
+
         Returns:
-            A generator that yields JPEG frames suitable for MJPEG streaming.
-        """
-        
-        class StreamingOutput(io.BufferedIOBase):
-            def __init__(self):
-                self.frame = None
-                self.condition = threading.Condition()
-            
-            def write(self, buf):
-                if buf.startswith(b'\xff\xd8'):
-                    with self.condition:
-                        self.frame = buf
-                        self.condition.notify_all()
-                return len(buf)
-        
-        output = StreamingOutput()
-        encoder = MJPEGEncoder(10000000)
-        
-        # Start recording to our streaming output
-        self.picam2.start_recording(encoder, FileOutput(output))
-        
-        if not self.picam2.started:
-            self.picam2.start()
-
-        while True:
-            with output.condition:
-                output.condition.wait()
-                time.sleep(0.04) # Add a delay between frames to slow down the stream
-                if output.frame is None:
-                    continue
-                frame = output.frame
-            
-            # Yield in a format suitable for MJPEG streaming
-            yield (b'--frame\r\n'
-                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+            A generator that yields JPEG frames.
+        """
+        return self.preview.frames(max_fps, until)
 
     def flip_image(self, flip_image):
         """
@@ -210,9 +523,7 @@ class Camera:
         """
         camera_config = self.picam2.camera_configuration()
         if camera_config["transform"].hflip != flip_image:
-            camera_config["transform"] = libcamera.Transform(
-                hflip=flip_image, vflip=flip_image
-            )
-            self.picam2.stop()
-            self.picam2.configure(camera_config)
-            self.picam2.start()
\ No newline at end of file
+            for configuration in self._configurations.values():
+                configuration["transform"] = libcamera.Transform(hflip=flip_image, vflip=flip_image)
+            with self.preview.paused():
+                self.picam2.switch_mode(self._configurations[self._mode])
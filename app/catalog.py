@@ -0,0 +1,158 @@
+"""
+This module contains the race catalog, a summary of every recording that is stored
+on the race row when the recording finishes, so listing races never looks at the frames.
+"""
+import fnmatch
+import os
+import threading
+
+import cv2
+from sqlalchemy import desc
+
+from app import db, models
+from app.constants import RACES_PER_PAGE, THUMBNAIL_FILE
+from app.framestore import open_reader
+from app.thumbnails import thumbnail
+
+_pages = {}
+_pages_lock = threading.Lock()
+
+
+def summarize(directory):
+    """
+    Collect the catalog values of a race directory.
+
+    Args:
+        directory (str): The race directory.
+
+    Returns:
+        A dict with the values of the catalog columns of the race.
+    """
+    summary = {
+        "frame_count": 0,
+        "byte_size": 0,
+        "first_timestamp": None,
+        "last_timestamp": None,
+        "duration": None,
+        "thumbnail": None,
+    }
+    if not os.path.isdir(directory):
+        return summary
+    first_frame = None
+    reader = open_reader(directory)
+    if reader is not None:
+        reader.refresh()
+        index = reader.index
+        summary["frame_count"] = len(index)
+        summary["byte_size"] = int(index["length"].sum())
+        if len(index) > 0:
+            summary["first_timestamp"] = int(index["timestamp"][0])
+            summary["last_timestamp"] = int(index["timestamp"][-1])
+            summary["duration"] = (summary["last_timestamp"] - summary["first_timestamp"]) / 1e9
+            first_stored = reader.stored_frame(1)
+            if first_stored is not None:
+                first_frame = reader.frame(first_stored)
+    else:
+        # Races recorded before the frame store was introduced have one file per frame
+        images = fnmatch.filter(os.listdir(directory), "image*.jpg")
+        summary["frame_count"] = len(images)
+        summary["byte_size"] = sum(
+            os.path.getsize(os.path.join(directory, image)) for image in images
+        )
+        if images:
+            with open(os.path.join(directory, min(images)), "rb") as image:
+                first_frame = image.read()
+    if first_frame is not None:
+        image = thumbnail(first_frame)
+        if image is not None and cv2.imwrite(os.path.join(directory, THUMBNAIL_FILE), image):
+            summary["thumbnail"] = THUMBNAIL_FILE
+    return summary
+
+
+def record(race, directory):
+    """
+    Store the catalog values of a finished race on its row.
+
+    Args:
+        race: The race to update.
+        directory (str): The race directory.
+    """
+    for column, value in summarize(directory).items():
+        setattr(race, column, value)
+    db.session.commit()
+    invalidate()
+
+
+def invalidate():
+    """
+    Forget the cached race list, this must be done whenever a race is started, stopped or deleted.
+    """
+    with _pages_lock:
+        _pages.clear()
+
+
+def race_page(page, race_directory):
+    """
+    Get one page of the finished races, newest first.
+    Races that were recorded before the catalog existed are added to it the first time they are listed.
+
+    Args:
+        page (int): The page number, starting at 1.
+        race_directory: A function that gives the directory of a race from its name.
+
+    Returns:
+        A tuple with a list of dicts describing the races on the page, the page number
+        clamped to the existing pages, the number of pages and the total number of races.
+    """
+    with _pages_lock:
+        total = _pages.get("total")
+    if total is None:
+        total = models.Race.query.filter_by(running=False, started=True).count()
+    page_count = max(1, -(-total // RACES_PER_PAGE))
+    page = min(max(1, page), page_count)
+    with _pages_lock:
+        _pages["total"] = total
+        cached = _pages.get(page)
+    if cached is not None:
+        return cached, page, page_count, total
+
+    races = (
+        models.Race.query.filter_by(running=False, started=True)
+        .order_by(desc(models.Race.start_time))
+        .offset((page - 1) * RACES_PER_PAGE)
+        .limit(RACES_PER_PAGE)
+        .all()
+    )
+    for race in races:
+        if race.frame_count is None:
+            record(race, race_directory(race.start_time))
+    entries = [
+        {
+            "number": total - (page - 1) * RACES_PER_PAGE - position,
+            "start_time": race.start_time,
+            "frame_count": race.frame_count,
+            "byte_size": race.byte_size,
+            "duration": race.duration,
+            "thumbnail": race.thumbnail,
+        }
+        for position, race in enumerate(races)
+    ]
+    with _pages_lock:
+        _pages[page] = entries
+    return entries, page, page_count, total
+
+
+def frame_count(race):
+    """
+    Get the catalogued number of frames of a finished race.
+
+    Args:
+        race (str): The name of the race.
+
+    Returns:
+        The number of frames, or None if the race is not in the catalog yet.
+    """
+    row = models.Race.query.filter_by(start_time=race, running=False).first()
+    if row is None:
+        return None
+    return row.frame_count
@@ -10,6 +10,144 @@ STATIC_DIRECTORY = "app/static/"
 RACE_DIRECTORY_BASE = "race/"
 WEBSOCKET_ROOM = "photofinish"
 
+DATABASE_URI = "sqlite:///data.db"
+# Connections kept open per process, enough for every gunicorn thread of a web worker
+DATABASE_POOL_SIZE = 5
+DATABASE_POOL_OVERFLOW = 5
+# Seconds to wait for the write lock of the database, the capture daemon and the web workers share it
+DATABASE_BUSY_TIMEOUT = 10
+
+FRAME_SEGMENT_FILE = "frames.seg"
+FRAME_INDEX_FILE = "frames.idx"
+FRAME_SEGMENT_PREALLOCATE = 64 * 1024 * 1024
+# Races a process keeps a reader for, each reader maps the whole segment file of its race
+FRAME_READER_CACHE_SIZE = 8
+
+FRAME_WRITER_QUEUE_SIZE = 512
+FRAME_WRITER_THREADS = 1
+FRAME_WRITER_BATCH = 16
+# "block" or "drop" when the writer queue is full
+FRAME_WRITER_OVERFLOW = "block"
+# "batch", "close" or "never"
+FRAME_WRITER_FSYNC = "close"
+
+# A frame URL with the generation of its frame store never changes, a replaced store gets new URLs
+FRAME_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Frame URLs without the current generation are revalidated with their ETag
+FRAME_REVALIDATE_CACHE_CONTROL = "public, no-cache"
+# The internal nginx location that serves the race directories
+FRAME_ACCEL_LOCATION = "/race_files/"
+# Race exports each web worker sends at the same time, the other threads are left for viewers
+EXPORT_MAX_CONCURRENT = 2
+# Seconds a client is asked to wait when every export slot is taken
+EXPORT_RETRY_AFTER = 10
+# Seconds between the updates of the written frames sent to the viewers during a race
+FRAME_PROGRESS_INTERVAL = 0.25
+
+FRAME_RING_BUFFER_SIZE = 32 * 1024 * 1024
+FRAME_RING_BUFFER_SECONDS = 2
+
+# The preview is this wide, its height follows the aspect ratio of the capture profile
+PREVIEW_RESOLUTION = (640, 476)
+PREVIEW_BITRATE = 2000000
+PREVIEW_MAX_FPS = 25
+# The capture daemon shares the latest preview frames with the web workers through this file
+PREVIEW_SHARED_FILE = "/dev/shm/photofinish-preview"
+PREVIEW_SHARED_SLOTS = 4
+PREVIEW_SHARED_SLOT_SIZE = 512 * 1024
+# The preview is encoded while a web worker has asked for it within this many seconds
+PREVIEW_LEASE_SECONDS = 3
+
+# The unix socket the web workers use to send commands to the capture daemon
+CAPTURE_SOCKET = "capture.sock"
+# Seconds to wait for an answer from the capture daemon
+CAPTURE_TIMEOUT = 30
+# Events waiting to be sent to a web worker before the worker is dropped as too slow
+CAPTURE_SUBSCRIBER_QUEUE_SIZE = 256
+
+CROSSINGS_FILE = "crossings.json"
+# A pixel on the goal line has changed when its luma differs this much from the empty track
+FINISH_LINE_PIXEL_THRESHOLD = 40
+# Part of the goal line that has to change for a crossing to start and to end
+FINISH_LINE_HIGH_FRACTION = 0.15
+FINISH_LINE_LOW_FRACTION = 0.05
+FINISH_LINE_BASELINE_RATE = 0.02
+
+FINISH_TIMES_FILE = "finish_times.json"
+# Finish times kept per race, the oldest is dropped first
+FINISH_TIMES_MAX_ENTRIES = 64
+# Decimals the goal line is rounded to, a ten thousandth of the image is less than a pixel
+FINISH_TIMES_LINE_DECIMALS = 4
+# Part of the goal line that has to change for something to have reached it
+FINISH_TIME_FRACTION = 0.02
+# The most frames a finish time can be searched for in
+FINISH_TIME_MAX_FRAMES = 200
+
+STRIP_FILE = "strip.jpg"
+STRIP_INDEX_FILE = "strip.json"
+STRIP_QUALITY = 90
+STRIP_AXIS_HEIGHT = 20
+# The strip follows the centre column of the image when no goal line has been drawn
+STRIP_DEFAULT_LINE = (0.5, 0.0, 0.5, 1.0)
+
+# The preview stream is compared at 1/4 of its size, every other pixel is averaged into 2x2 blocks
+MOTION_GATE_SCALE = 4
+# A pixel has moved when its averaged luma differs this much from the previous frame
+MOTION_GATE_PIXEL_THRESHOLD = 15
+# Part of the pixels that have to move for a frame to have motion
+MOTION_GATE_FRACTION = 0.002
+# Seconds of frames kept before and after a frame with motion
+MOTION_GATE_PRE_PADDING = 0.5
+MOTION_GATE_POST_PADDING = 1.0
+
+BACKGROUND_WORKERS = 1
+
+# Thumbnails are decoded at 1/2, 1/4 or 1/8 of the frame size
+THUMBNAIL_SCALE = 8
+SPRITE_FILE = "sprite_{:03d}.jpg"
+SPRITE_INDEX_FILE = "sprites.json"
+SPRITE_COLUMNS = 16
+SPRITE_FRAMES_PER_SHEET = 256
+SPRITE_QUALITY = 70
+
+# A finished race is compacted here before it replaces the frames of the race
+ARCHIVE_DIRECTORY = "archive.tmp"
+# JPEG quality of the frames further than ARCHIVE_ACTIVE_PADDING seconds from a detected crossing,
+# they are only re-encoded when the configuration asks for it since the originals are replaced
+ARCHIVE_IDLE_QUALITY = 60
+ARCHIVE_ACTIVE_PADDING = 1.0
+
+# Deleted races are moved here and removed in the background, it must be on the same file system
+TRASH_DIRECTORY = "app/trash/"
+# Capture profiles a race can be recorded with besides "standard", which uses the frame rate
+# and resolution of the configuration. A smaller sensor size selects a faster, cropped sensor mode.
+CAPTURE_PROFILES = {
+    "burst": {
+        "label": "Hög bildfrekvens",
+        "frames_per_second": 200,
+        "resolution": (1332, 496),
+        "sensor_size": (1332, 496),
+    },
+}
+# Frame rate of the camera while no race is armed, it uses the sensor mode of the chosen profile
+CAPTURE_PREVIEW_FPS = 30
+
+# The most bytes the races may use, None to only keep STORAGE_MIN_FREE bytes free on the disk
+STORAGE_BUDGET = 16 * 1024 * 1024 * 1024
+STORAGE_MIN_FREE = 512 * 1024 * 1024
+# Bytes per second of a race, used to estimate the size of a race before any race is recorded
+STORAGE_DEFAULT_BYTE_RATE = 8 * 1024 * 1024
+STORAGE_ESTIMATE_MARGIN = 1.5
+# Bytes written to measure how fast the disk is, when the capture daemon has no measurement saved
+STORAGE_BANDWIDTH_TEST_SIZE = 64 * 1024 * 1024
+# Bytes of a JPEG frame per pixel, until a race has shown what the encoder produces
+STORAGE_BYTES_PER_PIXEL = 0.07
+# A capture profile may use this part of the measured disk bandwidth
+STORAGE_BANDWIDTH_MARGIN = 0.8
+
+THUMBNAIL_FILE = "thumbnail.jpg"
+RACES_PER_PAGE = 20
+
 TIMESTAMP_COLOUR = (255, 255, 255)
 TIMESTAMP_ORIGIN = (0, 60)
 TIMESTAMP_FONT = cv2.FONT_HERSHEY_PLAIN
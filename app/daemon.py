@@ -0,0 +1,491 @@
+"""
+This module contains the capture daemon, the one process that owns the camera, the GPIO
+line of the cage and the frame writer, and makes every change to the state of a race.
+
+The web workers are clients of the daemon: they send commands such as starting a race
+over a unix socket, relay the events the daemon publishes to the browsers, and read the
+live preview from a shared memory ring. Restarting the web workers therefore never
+touches the camera, and any number of them can run.
+
+Run it from the repository root with: python -m app.daemon
+"""
+import atexit
+import os
+import threading
+import time
+
+import lgpio
+from eliot import Action, add_global_fields, start_action
+
+from app import app, background, catalog, db, metrics, models
+from app.archive import build_archive, install_archive, loose_frames
+from app.camera import Camera
+from app.constants import (ARCHIVE_IDLE_QUALITY, BUTTON_PIN, CAPTURE_PROFILES,
+                           CAPTURE_SOCKET, FRAME_PROGRESS_INTERVAL,
+                           PREVIEW_LEASE_SECONDS, PREVIEW_MAX_FPS,
+                           PREVIEW_SHARED_FILE, RACE_DIRECTORY_BASE,
+                           STATIC_DIRECTORY, TRASH_DIRECTORY)
+from app.framestore import has_frame_store
+from app.ipc import CaptureServer
+from app.scheduler import CaptureScheduler
+from app.sharedframe import SharedFrameRing
+from app.state import RaceState
+from app.storage import StorageManager
+from app.thumbnails import build_sprites
+
+# Set up by main()
+camera = None
+handle = None
+scheduler = None
+server = None
+storage = None
+# The running race and the configuration
+state = RaceState()
+
+# The deadline that stops the recording of the running race, only used on the scheduler thread
+_stop_deadline = None
+# The deadline of the next update of the written frames, only used on the scheduler thread
+_progress_deadline = None
+# True while the disk bandwidth is measured, only used on the scheduler thread
+_measuring_bandwidth = False
+
+
+def race_directory(race):
+    """
+    Get the directory of the specified race.
+    """
+    return STATIC_DIRECTORY + RACE_DIRECTORY_BASE + race
+
+
+def update_cage_status(_, __, level, race_start_time):
+    """
+    Called by lgpio when the button changes state.
+    The change is handled on the capture scheduler thread so the alert thread is never held up.
+    """
+    scheduler.post(cage_changed, level, race_start_time)
+
+
+def cage_changed(level, race_start_time):
+    """
+    Update the status of the cage based on the button state and start the race when the cage opens.
+    If the button is pressed, the cage is considered closed.
+    If the button is not pressed, the cage is considered open.
+    Runs on the capture scheduler thread.
+    """
+    global _stop_deadline
+    button_state = level
+    if not button_state:
+        # Cage is closed
+        server.publish("cage", "🟢 Stängd")
+        return
+    server.publish("cage", "🟡 Öppen")
+    current_race = state.race
+    # A bouncing cage button must not restart a race that has already started
+    if current_race is None or current_race.started:
+        return
+    with Action.continue_task(task_id=current_race.eliot_task_id, action_type="update_cage_status") as action:
+        config = state.config
+        # The recording starts before anything is written to the database
+        stop_time = camera.start_film(
+            race_start_time,
+            config.start_filming_after,
+            config.stop_filming_after,
+        )
+        with app.app_context():
+            state.start_race()
+        server.publish("race", "🔴 Pågår")
+        if stop_time is not None:
+            _stop_deadline = scheduler.schedule(stop_time, recording_finished, current_race.id)
+            publish_progress(current_race.start_time, state.finished + 1, 0)
+
+
+def publish_progress(race, number, last_count):
+    """
+    Tell the viewers how many frames of the running race are written, so they can be
+    looked at before the recording is finished. Repeats every FRAME_PROGRESS_INTERVAL
+    seconds while the camera is recording.
+    Runs on the capture scheduler thread.
+
+    Args:
+        race (str): The name of the race.
+        number (int): The number of the race in the race list.
+        last_count (int): The number of written frames in the last update.
+    """
+    global _progress_deadline
+    writer = camera.writer
+    if writer is None:
+        _progress_deadline = None
+        return
+    count = writer.store.committed
+    if count != last_count:
+        server.publish("frames", {"race": race, "number": number, "count": count})
+    _progress_deadline = scheduler.schedule(
+        time.monotonic_ns() + int(FRAME_PROGRESS_INTERVAL * 1e9), publish_progress, race, number, count
+    )
+
+
+def recording_finished(race_id):
+    """
+    Stop the race when its recording window has passed.
+    Runs on the capture scheduler thread.
+    """
+    current_race = state.race
+    if current_race is not None and current_race.id == race_id:
+        with app.app_context():
+            stop_race_actions()
+
+
+def cage_status():
+    """
+    Get the status of the cage.
+    If the button is pressed, the cage is considered closed.
+    If the button is not pressed, the cage is considered open.
+    """
+    button_state = lgpio.gpio_read(handle, BUTTON_PIN)
+    if not button_state:
+        return "🟢 Stängd"
+    else:
+        return "🟡 Öppen"
+
+
+def arm_race():
+    """
+    Create a new race and arm the camera for it.
+    Runs on the capture scheduler thread.
+
+    Returns:
+        The body and the HTTP status of the answer to the browser.
+    """
+    with app.app_context():
+        if state.race is not None:
+            with start_action(action_type="start_race") as action:
+                action.log(message_type="warn", message="Race is already running")
+        else:
+            with start_action(action_type="start_race") as action:
+                config = state.config
+                camera.select_profile(config.capture_profile)
+                byte_rate = camera.byte_rate(config.capture_profile)
+                # The standard profile is what the camera has always recorded with, only the
+                # faster profiles are refused on an estimate
+                if config.capture_profile != "standard" and not storage.fast_enough(byte_rate):
+                    action.log(
+                        message_type="warn",
+                        message="The disk is too slow for the capture profile",
+                        profile=config.capture_profile,
+                        byte_rate=int(byte_rate),
+                        bandwidth=int(storage.bandwidth),
+                    )
+                    return "Disken hinner inte spara bilderna med den här profilen", 507
+                needed = storage.race_estimate(config)
+                if not storage.ensure_space(needed):
+                    action.log(message_type="warn", message="Not enough disk space for a race")
+                    return "Inte tillräckligt med diskutrymme för ett race", 507
+                current_race = state.create_race(time.strftime("%Y%m%d-%H%M%S"), action.serialize_task_id())
+                catalog.invalidate()
+                #Make sure the camera is not filming
+                camera.stop_film()
+                # Start encoding into the pre-trigger buffer
+                camera.arm(current_race, config.goal_line(), reserve=needed, motion_gate=config.motion_gate)
+
+                action.log(message_type="debug", message="Race ready to start")
+                server.publish("race", "🟢 Redo för start")
+        return "OK", 200
+
+
+def stop_race_early():
+    """
+    Stop the current race before its recording window has passed.
+    Runs on the capture scheduler thread.
+    """
+    with app.app_context(), start_action(action_type="stop_race") as action:
+        if state.race is None:
+            action.log(message_type="warn", message="No race is running")
+        else:
+            action.log(message_type="warn", message="Stopping race early")
+            stop_race_actions()
+    return "OK"
+
+
+def stop_race_actions():
+    """
+    Stops recording, update the race in database, informs liteners and remove the timestamp callback.
+    """
+    global _stop_deadline, _progress_deadline
+    with start_action(action_type="stop_race_actions") as action:
+        for deadline in (_stop_deadline, _progress_deadline):
+            if deadline is not None:
+                deadline.cancel()
+        _stop_deadline, _progress_deadline = None, None
+        camera.stop_film()
+        if camera.bytes_per_pixel != state.config.bytes_per_pixel:
+            # Kept so the estimate of the next start does not go back to the guess
+            state.update_config(bytes_per_pixel=camera.bytes_per_pixel)
+        current_race = state.race
+        summary = {}
+        if current_race.started:
+            summary = catalog.summarize(race_directory(current_race.start_time))
+        state.finish_race(**summary)
+        catalog.invalidate()
+        if current_race.started:
+            race = current_race.start_time
+            directory = race_directory(race)
+            # The viewers show the finished race in place instead of reloading the page
+            server.publish(
+                "race_finished",
+                {
+                    "race": race,
+                    "number": state.finished,
+                    "frame_count": summary["frame_count"],
+                },
+            )
+            sprites = background.submit("build_sprites", build_sprites, directory)
+
+            def sprites_built(future):
+                if future.exception() is None:
+                    server.publish("sprites", race)
+
+            sprites.add_done_callback(sprites_built)
+            archive_race(race)
+        server.publish("race", "🟡 Inte redo")
+
+
+def archive_race(race):
+    """
+    Compact the frames of a race in the background and swap them in when they are verified.
+
+    Args:
+        race (str): The name of the race.
+    """
+    directory = race_directory(race)
+    frame_interval = round(1e9 / camera.frames_per_second)
+    idle_quality = ARCHIVE_IDLE_QUALITY if state.config.archive_reencode else None
+    future = background.submit("archive_race", build_archive, directory, frame_interval, idle_quality)
+
+    def install(future):
+        if future.exception() is not None or future.result() is None:
+            return
+        if not os.path.isdir(directory):
+            # The race was deleted while it was archived
+            return
+        with start_action(action_type="install_archive", race=race, **future.result()):
+            install_archive(directory)
+            with app.app_context():
+                current_race = models.Race.query.filter_by(start_time=race).first()
+                if current_race is not None:
+                    catalog.record(current_race, directory)
+            server.publish("catalog")
+
+    future.add_done_callback(install)
+
+
+def archive_legacy_races():
+    """
+    Compact races that were recorded with one file per frame.
+    """
+    base = STATIC_DIRECTORY + RACE_DIRECTORY_BASE
+    for race in sorted(os.listdir(base)):
+        directory = os.path.join(base, race)
+        if race.startswith("."):
+            continue
+        if os.path.isdir(directory) and not has_frame_store(directory) and loose_frames(directory):
+            archive_race(race)
+
+
+def config_changed():
+    """
+    Reload the configuration after a web worker has changed it and apply it to the camera.
+    Runs on the capture scheduler thread.
+    """
+    with app.app_context():
+        config = state.reload_config()
+    camera.flip_image(config.flip_image)
+    camera.select_profile(config.capture_profile)
+    if config.disk_bandwidth is None:
+        # Resetting everything forgets the measurement, which asks for a new one
+        measure_disk_bandwidth()
+
+
+def measure_disk_bandwidth():
+    """
+    Measure how fast the disk writes on a background thread and keep the result in the
+    configuration. Writing the test file wears the SD card and competes with a race,
+    so it is only done when no measurement is saved.
+    Runs on the capture scheduler thread.
+    """
+    global _measuring_bandwidth
+    if _measuring_bandwidth:
+        return
+    _measuring_bandwidth = True
+
+    def measure():
+        bandwidth = None
+        try:
+            bandwidth = storage.measure_bandwidth()
+        finally:
+            scheduler.post(save_disk_bandwidth, bandwidth)
+
+    threading.Thread(target=measure, name="disk-bandwidth", daemon=True).start()
+
+
+def save_disk_bandwidth(bandwidth):
+    """
+    Keep a measured disk bandwidth in the configuration.
+    Runs on the capture scheduler thread.
+
+    Args:
+        bandwidth (float): Bytes per second, or None if the measurement failed.
+    """
+    global _measuring_bandwidth
+    _measuring_bandwidth = False
+    if bandwidth is not None:
+        with app.app_context():
+            state.update_config(disk_bandwidth=bandwidth)
+
+
+def delete_race(race):
+    """
+    Delete a race, the web worker has checked the name.
+    The race the camera is armed or recording for has to be stopped first.
+    Runs on the capture scheduler thread.
+
+    Returns:
+        The body and the HTTP status of the answer to the browser.
+    """
+    with app.app_context():
+        current_race = state.race
+        if current_race is not None and current_race.start_time == race:
+            with start_action(action_type="delete_race", race=race) as action:
+                action.log(message_type="warn", message="Race is running")
+            return "Racet pågår, stoppa det innan det tas bort", 409
+        storage.delete_race(race)
+        # The number of finished races may have changed
+        state.load()
+    server.publish("catalog")
+    return "OK", 200
+
+
+def delete_all_races():
+    """
+    Delete every race, unless a race is running.
+    Runs on the capture scheduler thread.
+
+    Returns:
+        The body and the HTTP status of the answer to the browser.
+    """
+    with app.app_context():
+        if state.race is not None:
+            with start_action(action_type="delete_all_races") as action:
+                action.log(message_type="warn", message="Race is running")
+            return "Ett race pågår, stoppa det innan allt tas bort", 409
+        storage.delete_all()
+        state.load()
+    server.publish("catalog")
+    return "OK", 200
+
+
+class PreviewPublisher(threading.Thread):
+    """
+    Copies the preview frames to the shared ring while a web worker is watching them.
+    The preview encoder is stopped when no worker has renewed its lease for PREVIEW_LEASE_SECONDS.
+    """
+
+    def __init__(self, camera, ring):
+        super().__init__(name="preview-publisher", daemon=True)
+        self.camera = camera
+        self.ring = ring
+        self._lease_until = 0
+        self._watched = threading.Event()
+        self._lock = threading.Lock()
+
+    def watch(self):
+        """
+        Keep the preview running for another PREVIEW_LEASE_SECONDS.
+        """
+        with self._lock:
+            self._lease_until = time.monotonic() + PREVIEW_LEASE_SECONDS
+            self._watched.set()
+
+    def _expired(self):
+        with self._lock:
+            if time.monotonic() < self._lease_until:
+                return False
+            self._watched.clear()
+            return True
+
+    def run(self):
+        while True:
+            self._watched.wait()
+            # The lease is also checked while the camera delivers no frames
+            frames = self.camera.get_video_stream(PREVIEW_MAX_FPS, until=self._expired)
+            try:
+                for frame in frames:
+                    self.ring.publish(frame)
+            finally:
+                frames.close()
+
+
+def main():
+    """
+    Open the camera and the GPIO line and serve the web workers until the process ends.
+    """
+    global camera, handle, scheduler, server, storage
+    add_global_fields(process="capture")
+
+    with app.app_context():
+        # Stop any race that is running
+        models.Race.query.filter_by(running=True).update({"running": False})
+        db.session.commit()
+        state.load()
+        config = state.config
+        resolution = (config.resolution_width, config.resolution_height)
+
+        # Fork the background workers before the camera starts its threads
+        background.start()
+        storage = StorageManager(STATIC_DIRECTORY + RACE_DIRECTORY_BASE, TRASH_DIRECTORY)
+        camera = Camera(
+            config.frames_per_second, config.flip_image, resolution, CAPTURE_PROFILES, config.capture_profile
+        )
+        if config.bytes_per_pixel is not None:
+            camera.bytes_per_pixel = config.bytes_per_pixel
+
+    handle = lgpio.gpiochip_open(4)
+    err = lgpio.gpio_claim_alert(handle, BUTTON_PIN, lgpio.BOTH_EDGES, lgpio.SET_PULL_UP)
+    if err != 0:
+        print(f"Error: {lgpio.error_text(err)}")
+        exit(1)
+
+    # Register cleanup function for normal exit
+    atexit.register(lgpio.gpio_free, handle, BUTTON_PIN)
+
+    # Changes to the state of a race are made on this thread
+    scheduler = CaptureScheduler()
+    scheduler.start()
+
+    server = CaptureServer(CAPTURE_SOCKET)
+    preview = PreviewPublisher(camera, SharedFrameRing(PREVIEW_SHARED_FILE))
+    preview.start()
+    atexit.register(preview.ring.close)
+
+    server.register("start_race", lambda: scheduler.post(arm_race).result())
+    server.register("stop_race", lambda: scheduler.post(stop_race_early).result())
+    server.register("delete_race", lambda race: scheduler.post(delete_race, race).result())
+    server.register("delete_all_races", lambda: scheduler.post(delete_all_races).result())
+    server.register("config_changed", lambda: scheduler.post(config_changed).result())
+    server.register("cage_status", cage_status)
+    server.register("watch_preview", preview.watch)
+    server.register("metrics", metrics.render)
+
+    lgpio.callback(handle, BUTTON_PIN, lgpio.BOTH_EDGES, update_cage_status)
+
+    archive_legacy_races()
+    # Measured once and kept, so a profile the disk can not keep up with is refused
+    if state.config.disk_bandwidth is None:
+        scheduler.post(measure_disk_bandwidth)
+    else:
+        storage.use_bandwidth(state.config.disk_bandwidth)
+    start_action(action_type="capture_daemon_started", socket=CAPTURE_SOCKET)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+This module contains the setup of the SQLite database that the capture daemon and the web workers share.
+
+The database is used in WAL mode: readers never wait for the one writer and the writer
+never waits for readers, so a web worker rendering the race list does not hold up the
+daemon recording the end of a race. Commits only sync the log when it is checkpointed,
+a commit can be lost in a power cut but the database stays consistent.
+"""
+from sqlalchemy import event
+
+from app.constants import (DATABASE_BUSY_TIMEOUT, DATABASE_POOL_OVERFLOW,
+                           DATABASE_POOL_SIZE)
+
+
+def engine_options():
+    """
+    Get the options of the SQLAlchemy engine, a pool of connections shared by the threads of a process.
+    """
+    return {
+        "pool_size": DATABASE_POOL_SIZE,
+        "max_overflow": DATABASE_POOL_OVERFLOW,
+        "connect_args": {"timeout": DATABASE_BUSY_TIMEOUT},
+    }
+
+
+def configure_connection(connection, _):
+    """
+    Set up a new SQLite connection. Called by SQLAlchemy for every connection it opens.
+    """
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DATABASE_BUSY_TIMEOUT * 1000}")
+    cursor.close()
+
+
+def setup(db):
+    """
+    Configure every connection of the engine of the database.
+    Must be called in an application context, before the first connection is opened.
+
+    Args:
+        db: The Flask-SQLAlchemy extension.
+    """
+    event.listen(db.engine, "connect", configure_connection)
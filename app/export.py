@@ -0,0 +1,285 @@
+"""
+This module contains the export of a race as one file, built from the frame store while it is sent.
+
+An export is a list of parts with known sizes: headers and the frames themselves. The
+position of every byte is known before anything is read, so the file has a fixed length,
+a part of it can be sent for a Range request, and only one part is held in memory at a time.
+"""
+import struct
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+_MAX_SIZE = 2**32 - 1
+_MAX_ZIP_ENTRIES = 0xFFFF
+# Every frame is a keyframe
+_AVIIF_KEYFRAME = 0x10
+_AVIF_HASINDEX = 0x10
+# Bit 3 of a local file header: the CRC and sizes follow the data in a data descriptor
+_ZIP_DATA_DESCRIPTOR = 0x08
+_ZIP_STORED = 0
+_ZIP_VERSION = 20
+
+
+class RaceChanged(Exception):
+    """
+    The frame store was changed while it was exported, e.g. when the race was archived.
+    """
+
+
+class Export:
+    """
+    A file made of parts that are read when they are sent.
+    """
+
+    def __init__(self, parts):
+        """
+        Args:
+            parts (list): Tuples of the size of a part and a function that returns its bytes.
+        """
+        self.parts = parts
+        self.size = sum(size for size, _ in parts)
+        if self.size > _MAX_SIZE:
+            raise ValueError("The race is too large to export as one file")
+
+    def stream(self, start=0, stop=None):
+        """
+        Get the bytes of the file between two positions, one part at a time.
+
+        Args:
+            start (int): The position of the first byte.
+            stop (int): The position after the last byte, the end of the file if None.
+
+        Yields:
+            The bytes of each part, cut to the positions.
+        """
+        if stop is None:
+            stop = self.size
+        offset = 0
+        for size, content in self.parts:
+            end = offset + size
+            if end > start and offset < stop:
+                data = content()
+                if len(data) != size:
+                    raise RaceChanged()
+                yield bytes(data[max(start - offset, 0) : min(stop, end) - offset])
+            offset = end
+            if offset >= stop:
+                return
+
+
+def _snapshot(reader):
+    reader.refresh()
+    return np.array(reader.index)
+
+
+def _frame(reader, frame_num):
+    return lambda: reader.frame(frame_num) or b""
+
+
+def _frame_size(reader, frame_num):
+    """
+    Get the width and height of a stored frame.
+    Raises RaceChanged if the frame is gone since the index was read.
+    """
+    frame = reader.frame(frame_num)
+    if frame is None:
+        raise RaceChanged()
+    image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise RaceChanged()
+    height, width = image.shape
+    return width, height
+
+
+def avi(reader):
+    """
+    Export a race as a Motion JPEG AVI.
+
+    An AVI has a constant frame rate, so the frame period of the race is taken from its
+    timestamps and every period gets the frame recorded closest to it. Frames the motion
+    gate skipped or the camera missed are filled with the frame before them, which keeps
+    the time in a player the same as the time in the race.
+
+    Args:
+        reader: The FrameStoreReader of the race.
+
+    Returns:
+        An Export or None if the race has no stored frames.
+    """
+    index = _snapshot(reader)
+    stored = np.flatnonzero(index["length"] > 0)
+    if len(stored) == 0:
+        return None
+    timestamps = index["timestamp"].astype(np.int64)
+    periods = np.diff(timestamps)
+    period = int(np.median(periods)) if len(periods) > 0 else 10_000_000
+    period = max(period, 1000)
+    slots = int(round((timestamps[-1] - timestamps[0]) / period)) + 1
+    nearest = reader.nearest_frames(timestamps[0] + np.arange(slots, dtype=np.int64) * period) - 1
+    nearest = nearest.clip(0, len(index) - 1)
+    # The last stored frame at or before each frame, or the first stored frame at the start
+    last_stored = np.where(index["length"] > 0, np.arange(len(index)), -1)
+    last_stored = np.maximum.accumulate(last_stored)
+    last_stored[last_stored < 0] = stored[0]
+    frames = last_stored[nearest] + 1
+    lengths = index["length"][frames - 1].astype(np.int64)
+
+    width, height = _frame_size(reader, int(frames[0]))
+    microseconds = max(period // 1000, 1)
+    largest = int(lengths.max())
+    padded = lengths + (lengths & 1)
+    movi_size = 4 + int((8 + padded).sum())
+    index_size = 16 * slots
+
+    main_header = struct.pack(
+        "<10I4I",
+        microseconds, largest * 1_000_000 // microseconds, 0, _AVIF_HASINDEX, slots, 0, 1, largest,
+        width, height, 0, 0, 0, 0,
+    )
+    stream_header = struct.pack(
+        "<4s4sIHHIIIIIIIIhhhh",
+        b"vids", b"MJPG", 0, 0, 0, 0, microseconds, 1_000_000, 0, slots, largest, 0xFFFFFFFF, 0,
+        0, 0, width, height,
+    )
+    stream_format = struct.pack(
+        "<IiiHH4sIiiII", 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0
+    )
+    stream_list = (
+        b"LIST" + struct.pack("<I", 4 + 8 + len(stream_header) + 8 + len(stream_format)) + b"strl"
+        + b"strh" + struct.pack("<I", len(stream_header)) + stream_header
+        + b"strf" + struct.pack("<I", len(stream_format)) + stream_format
+    )
+    header_list = (
+        b"LIST" + struct.pack("<I", 4 + 8 + len(main_header) + len(stream_list)) + b"hdrl"
+        + b"avih" + struct.pack("<I", len(main_header)) + main_header
+        + stream_list
+    )
+    riff_size = 4 + len(header_list) + 8 + movi_size + 8 + index_size
+    head = (
+        b"RIFF" + struct.pack("<I", riff_size) + b"AVI " + header_list
+        + b"LIST" + struct.pack("<I", movi_size) + b"movi"
+    )
+
+    parts = [(len(head), lambda: head)]
+    for frame_num, length in zip(frames.tolist(), lengths.tolist()):
+        chunk = b"00dc" + struct.pack("<I", length)
+        parts.append((8, lambda chunk=chunk: chunk))
+        parts.append((length, _frame(reader, frame_num)))
+        if length & 1:
+            parts.append((1, lambda: b"\0"))
+
+    def frame_index():
+        # Offsets are counted from the "movi" of the list
+        offsets = 4 + np.concatenate(([0], np.cumsum(8 + padded)[:-1]))
+        entries = np.zeros(slots, dtype=[("id", "S4"), ("flags", "<u4"), ("offset", "<u4"), ("size", "<u4")])
+        entries["id"] = b"00dc"
+        entries["flags"] = _AVIIF_KEYFRAME
+        entries["offset"] = offsets
+        entries["size"] = lengths
+        return b"idx1" + struct.pack("<I", index_size) + entries.tobytes()
+
+    parts.append((8 + index_size, frame_index))
+    return Export(parts)
+
+
+def _dos_time(race):
+    """
+    Get the time of a race in the MS-DOS format of ZIP entries.
+    """
+    try:
+        started = time.strptime(race, "%Y%m%d-%H%M%S")
+    except ValueError:
+        return 0, (1 << 5) | 1
+    return (
+        (started.tm_hour << 11) | (started.tm_min << 5) | (started.tm_sec // 2),
+        ((max(started.tm_year, 1980) - 1980) << 9) | (started.tm_mon << 5) | started.tm_mday,
+    )
+
+
+def zip_archive(reader, race):
+    """
+    Export a race as a ZIP file with every stored frame and an index of their timestamps.
+
+    The entries are stored without compression, since the frames are JPEGs already, so
+    their positions follow from the sizes of the frames. The checksums are only known
+    after a frame has been read, so they follow each frame in a data descriptor. The
+    checksum of an entry is kept when it is sent for the central directory, an entry
+    is only read again when a Range request skipped it.
+
+    Args:
+        reader: The FrameStoreReader of the race.
+        race (str): The name of the race, the start time it was recorded at.
+
+    Returns:
+        An Export or None if the race has no stored frames.
+    """
+    index = _snapshot(reader)
+    stored = np.flatnonzero(index["length"] > 0) + 1
+    if len(stored) == 0:
+        return None
+    if len(stored) + 1 > _MAX_ZIP_ENTRIES:
+        raise ValueError("The race has too many frames to export as a ZIP file")
+    dos_time, dos_date = _dos_time(race)
+
+    lines = ["frame,timestamp_ns,file"]
+    for frame_num, (length, timestamp) in enumerate(zip(index["length"].tolist(), index["timestamp"].tolist()), 1):
+        lines.append(f"{frame_num},{timestamp},{f'image_{frame_num:04d}.jpg' if length else ''}")
+    timestamps = ("\n".join(lines) + "\n").encode()
+
+    # Each entry is a name, a size and a function that returns its bytes
+    entries = [("timestamps.csv", len(timestamps), lambda: timestamps)]
+    for frame_num in stored.tolist():
+        entries.append((f"image_{frame_num:04d}.jpg", int(index["length"][frame_num - 1]), _frame(reader, frame_num)))
+
+    parts = []
+    directory = []
+    # The CRC-32 of each entry that has been sent, by its name
+    checksums = {}
+    offset = 0
+    for name, size, content in entries:
+        name = name.encode()
+        local_header = struct.pack(
+            "<4sHHHHHIIIHH",
+            b"PK\x03\x04", _ZIP_VERSION, _ZIP_DATA_DESCRIPTOR, _ZIP_STORED, dos_time, dos_date,
+            0, 0, 0, len(name), 0,
+        ) + name
+
+        def data(content=content, name=name):
+            data = content()
+            checksums[name] = zlib.crc32(data)
+            return data
+
+        def checksum(content=content, size=size, name=name):
+            if name not in checksums:
+                data = content()
+                if len(data) != size:
+                    raise RaceChanged()
+                checksums[name] = zlib.crc32(data)
+            return checksums[name]
+
+        def descriptor(checksum=checksum, size=size):
+            return struct.pack("<4sIII", b"PK\x07\x08", checksum(), size, size)
+
+        def central_header(checksum=checksum, size=size, name=name, offset=offset):
+            return struct.pack(
+                "<4sHHHHHHIIIHHHHHII",
+                b"PK\x01\x02", _ZIP_VERSION, _ZIP_VERSION, _ZIP_DATA_DESCRIPTOR, _ZIP_STORED,
+                dos_time, dos_date, checksum(), size, size, len(name), 0, 0, 0, 0, 0, offset,
+            ) + name
+
+        parts.append((len(local_header), lambda local_header=local_header: local_header))
+        parts.append((size, data))
+        parts.append((16, descriptor))
+        directory.append((46 + len(name), central_header))
+        offset += len(local_header) + size + 16
+
+    directory_size = sum(size for size, _ in directory)
+    end = struct.pack(
+        "<4sHHHHIIH", b"PK\x05\x06", 0, 0, len(entries), len(entries), directory_size, offset, 0
+    )
+    if offset > _MAX_SIZE:
+        raise ValueError("The race is too large to export as a ZIP file")
+    return Export(parts + directory + [(len(end), lambda: end)])
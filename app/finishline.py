@@ -0,0 +1,249 @@
+"""
+This module contains the detection of finish line crossings from the goal line drawn by the user.
+"""
+import json
+import math
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from app.constants import (CROSSINGS_FILE, FINISH_LINE_BASELINE_RATE,
+                           FINISH_LINE_HIGH_FRACTION, FINISH_LINE_LOW_FRACTION,
+                           FINISH_LINE_PIXEL_THRESHOLD, FINISH_TIME_FRACTION,
+                           FINISH_TIMES_FILE, FINISH_TIMES_LINE_DECIMALS,
+                           FINISH_TIMES_MAX_ENTRIES, FRAME_INDEX_FILE)
+from app.framestore import FrameStoreReader, open_reader
+
+
+def line_samples(goal_line, size):
+    """
+    Get the pixel coordinates of every pixel along the goal line.
+
+    Args:
+        goal_line (tuple): The end points of the line (x1, y1, x2, y2) as fractions of the image size.
+        size (tuple): The size of the image (width, height).
+
+    Returns:
+        A tuple with the row and column indices of the pixels.
+    """
+    width, height = size
+    x1, y1, x2, y2 = goal_line
+    x1, x2 = x1 * (width - 1), x2 * (width - 1)
+    y1, y2 = y1 * (height - 1), y2 * (height - 1)
+    count = int(max(abs(x2 - x1), abs(y2 - y1))) + 1
+    xs = np.rint(np.linspace(x1, x2, count)).astype(np.intp)
+    ys = np.rint(np.linspace(y1, y2, count)).astype(np.intp)
+    return np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)
+
+
+def load_crossings(directory):
+    """
+    Get the detected crossings of a race.
+
+    Args:
+        directory (str): The race directory.
+
+    Returns:
+        A dict with the frame numbers and timestamps of the crossings.
+    """
+    try:
+        with open(os.path.join(directory, CROSSINGS_FILE)) as crossings:
+            return json.load(crossings)
+    except FileNotFoundError:
+        return {"frames": [], "timestamps": []}
+
+
+class FinishLineDetector:
+    """
+    Finds the frames where something crosses the goal line.
+
+    The luma along the line is sampled from every frame. Before the recording window
+    opens the samples build a baseline of the empty track. Inside the window a crossing
+    starts when a large part of the line differs from the baseline, and ends when most
+    of the line is back to the baseline.
+    """
+
+    def __init__(self, goal_line, size):
+        """
+        Args:
+            goal_line (tuple): The end points of the line (x1, y1, x2, y2) as fractions of the image size.
+            size (tuple): The size of the Y plane (width, height).
+        """
+        self._ys, self._xs = line_samples(goal_line, size)
+        self.baseline = None
+        self.window = None
+        self.crossings = []
+        self._crossing = False
+
+    def process(self, array, timestamp):
+        """
+        Check a frame for a crossing.
+
+        Args:
+            array: The frame array, the Y plane must be at the top of it.
+            timestamp (int): The sensor timestamp of the frame in nanoseconds.
+        """
+        profile = array[self._ys, self._xs].astype(np.float32)
+        if self.baseline is None:
+            self.baseline = profile
+            return
+        window = self.window
+        inside = window is not None and window[0] <= timestamp < window[1]
+        changed = np.count_nonzero(np.abs(profile - self.baseline) > FINISH_LINE_PIXEL_THRESHOLD)
+        fraction = changed / len(profile)
+        if inside and not self._crossing and fraction >= FINISH_LINE_HIGH_FRACTION:
+            self._crossing = True
+            self.crossings.append(timestamp)
+        elif self._crossing and fraction < FINISH_LINE_LOW_FRACTION:
+            self._crossing = False
+        if not self._crossing:
+            # Follow slow changes of the light on the empty track
+            self.baseline += FINISH_LINE_BASELINE_RATE * (profile - self.baseline)
+
+    def save(self, directory, race_start_time):
+        """
+        Store the crossings of the race next to its frames.
+
+        Args:
+            directory (str): The race directory with the frame store.
+            race_start_time (int): The start time of the race as a monotonic time in nanoseconds.
+        """
+        timestamps = [timestamp - race_start_time for timestamp in self.crossings]
+        frames = FrameStoreReader(directory).nearest_frames(timestamps)
+        if frames is None:
+            timestamps, frames = [], []
+        with open(os.path.join(directory, CROSSINGS_FILE), "w") as crossings:
+            json.dump({"frames": list(map(int, frames)), "timestamps": timestamps}, crossings)
+
+
+def finish_time(directory, goal_line, first_frame, last_frame, fraction=FINISH_TIME_FRACTION):
+    """
+    Find the instant something first reaches the goal line between two frames of a race.
+
+    The luma along the line is sampled from every stored frame in the range and compared
+    to the first of them, which has to show the empty line. The part of the line that
+    has changed grows from frame to frame as something enters it, the instant it reaches
+    the given fraction is interpolated linearly between the sensor timestamps of the
+    frames on either side.
+
+    The uncertainty combines the noise of the changed part before the crossing, the
+    jitter of the sensor timestamps and how much the next pair of frames disagrees with
+    the interpolation. It is never more than the uncertainty of picking one of the two frames.
+
+    Args:
+        directory (str): The race directory with the frame store.
+        goal_line (tuple): The end points of the line (x1, y1, x2, y2) as fractions of the image size.
+        first_frame (int): The first frame of the range, starting at 1.
+        last_frame (int): The last frame of the range.
+        fraction (float): The part of the line that has to change.
+
+    Returns:
+        A dict with the time and its uncertainty in seconds after the race start and the
+        frames on either side, or None if nothing reaches the line in the range.
+    """
+    reader = open_reader(directory)
+    if reader is None:
+        return None
+    numbers = []
+    profiles = []
+    samples = None
+    for frame_num in range(first_frame, last_frame + 1):
+        frame = reader.frame(frame_num)
+        if not frame:
+            # Missing, or skipped by the motion gate
+            continue
+        image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            continue
+        if samples is None:
+            samples = line_samples(goal_line, (image.shape[1], image.shape[0]))
+        profiles.append(image[samples])
+        numbers.append(frame_num)
+    if len(numbers) < 2:
+        return None
+
+    profiles = np.asarray(profiles, dtype=np.int16)
+    timestamps = reader.timestamps[np.asarray(numbers) - 1].astype(np.float64)
+    changed = (np.abs(profiles - profiles[0]) > FINISH_LINE_PIXEL_THRESHOLD).mean(axis=1)
+    reached = np.flatnonzero(changed >= fraction)
+    if len(reached) == 0:
+        return None
+    after = reached[0]
+    before = after - 1
+    interval = timestamps[after] - timestamps[before]
+    slope = (changed[after] - changed[before]) / interval
+    instant = timestamps[before] + (fraction - changed[before]) / slope
+
+    # One pixel of the line is the least the changed part can be known to
+    noise = 1 / (profiles.shape[1] * math.sqrt(12))
+    if before >= 3:
+        # The frame just before may already show a little of what is coming
+        noise = max(noise, float(changed[1:before].std()))
+    periods = np.diff(timestamps)
+    period = np.median(periods)
+    jitter = float(np.std(periods - np.rint(periods / period) * period)) if len(periods) > 1 else 0.0
+    # How far the changed part is from growing linearly, from the next pair of frames
+    curvature = 0.0
+    if after + 1 < len(numbers) and changed[after + 1] > changed[after]:
+        next_slope = (changed[after + 1] - changed[after]) / (timestamps[after + 1] - timestamps[after])
+        curvature = abs(timestamps[after] + (fraction - changed[after]) / next_slope - instant) / 2
+    uncertainty = min(math.sqrt((noise / slope) ** 2 + jitter**2 + curvature**2), interval / math.sqrt(12))
+
+    return {
+        "time": float(instant) / 1e9,
+        "uncertainty": float(uncertainty) / 1e9,
+        "frame_before": numbers[before],
+        "frame_after": numbers[after],
+        "time_before": float(timestamps[before]) / 1e9,
+        "time_after": float(timestamps[after]) / 1e9,
+    }
+
+
+def cached_finish_time(directory, goal_line, first_frame, last_frame):
+    """
+    Get the finish time in a range of frames of a race, from the finish times of the race
+    found before if possible. The cache is kept next to the frames and is forgotten when
+    the frame store changes, e.g. while the race is still recording or when it is archived.
+    The goal line is rounded so a line dragged by a fraction of a pixel finds the same
+    result, and only the last FINISH_TIMES_MAX_ENTRIES results are kept.
+
+    Args:
+        directory (str): The race directory with the frame store.
+        goal_line (tuple): The end points of the line (x1, y1, x2, y2) as fractions of the image size.
+        first_frame (int): The first frame of the range, starting at 1.
+        last_frame (int): The last frame of the range.
+
+    Returns:
+        The result of finish_time().
+    """
+    try:
+        index = os.stat(os.path.join(directory, FRAME_INDEX_FILE))
+    except FileNotFoundError:
+        return None
+    store = [index.st_ino, index.st_size, index.st_mtime_ns]
+    path = os.path.join(directory, FINISH_TIMES_FILE)
+    try:
+        with open(path) as file:
+            cache = json.load(file)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    if cache.get("store") != store:
+        cache = {"store": store, "results": {}}
+    goal_line = tuple(round(value, FINISH_TIMES_LINE_DECIMALS) for value in goal_line)
+    key = json.dumps([first_frame, last_frame, list(goal_line)])
+    results = cache["results"]
+    if key in results:
+        return results[key]
+
+    result = finish_time(directory, goal_line, first_frame, last_frame)
+    results[key] = result
+    # The results keep the order they were added in
+    for oldest in list(results)[: max(len(results) - FINISH_TIMES_MAX_ENTRIES, 0)]:
+        del results[oldest]
+    # Written to the side and moved in place, other threads and workers may be reading it
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=f"{FINISH_TIMES_FILE}.", delete=False) as file:
+        json.dump(cache, file)
+    os.replace(file.name, path)
+    return result
@@ -0,0 +1,447 @@
+"""
+This module contains the frame store used to keep all frames of a race in a single file.
+
+A race directory holds one preallocated segment file with the encoded JPEG frames
+appended back to back, and a compact index with one fixed size record
+(offset, length, timestamp) per frame.
+"""
+import collections
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from app.constants import (FRAME_INDEX_FILE, FRAME_READER_CACHE_SIZE,
+                           FRAME_SEGMENT_FILE, FRAME_SEGMENT_PREALLOCATE)
+
+INDEX_RECORD = struct.Struct("<QIq")
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("timestamp", "<i8")])
+
+
+def has_frame_store(directory):
+    """
+    Check if the given race directory contains a frame store.
+
+    Args:
+        directory (str): The race directory.
+    """
+    return os.path.exists(os.path.join(directory, FRAME_INDEX_FILE))
+
+
+class FrameStoreWriter:
+    """
+    Appends encoded frames to the segment file of a race and records them in the index.
+
+    Writing is split in two steps so several threads can write at the same time:
+    reserve() hands out frame numbers and segment offsets in order, and write()
+    stores the frames at the reserved place.
+    """
+
+    def __init__(self, directory, preallocate=FRAME_SEGMENT_PREALLOCATE, reserve=0):
+        """
+        Creates the segment and index files in the given directory.
+
+        Args:
+            directory (str): The race directory, it must already exist.
+            preallocate (int): Number of bytes to reserve on disk each time the segment grows.
+            reserve (int): Number of bytes to reserve on disk up front.
+        """
+        self.directory = directory
+        self.frame_count = 0
+        self.bytes_written = 0
+        # Frames 1 to committed are all written and can be read
+        self.committed = 0
+        self._written_batches = {}
+        self._preallocate = preallocate
+        self._offset = 0
+        self._allocated = 0
+        self._lock = threading.Lock()
+        self._segment = os.open(
+            os.path.join(directory, FRAME_SEGMENT_FILE),
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            0o644,
+        )
+        self._index = os.open(
+            os.path.join(directory, FRAME_INDEX_FILE),
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            0o644,
+        )
+        self._allocate(max(preallocate, reserve))
+
+    def _allocate(self, size):
+        """
+        Make sure the segment has room for at least size more bytes.
+        """
+        needed = self._offset + size
+        if needed <= self._allocated:
+            return
+        allocated = self._allocated
+        while allocated < needed:
+            allocated += self._preallocate
+        try:
+            os.posix_fallocate(self._segment, self._allocated, allocated - self._allocated)
+        except OSError:
+            # Not every file system supports fallocate, the writes still work without it
+            pass
+        self._allocated = allocated
+
+    def reserve(self, lengths):
+        """
+        Reserve room for a number of frames.
+
+        Args:
+            lengths (list): The length in bytes of each frame.
+
+        Returns:
+            A tuple with the frame number of the first frame, starting at 1,
+            and its offset in the segment.
+        """
+        total = sum(lengths)
+        with self._lock:
+            first_frame = self.frame_count + 1
+            offset = self._offset
+            self._allocate(total)
+            self._offset += total
+            self.frame_count += len(lengths)
+        return first_frame, offset
+
+    def write(self, first_frame, offset, frames):
+        """
+        Write frames to a place returned by reserve().
+        The frame data is written before the index so readers never see a
+        record that points to data that is not there yet.
+
+        Args:
+            first_frame (int): The frame number of the first frame.
+            offset (int): The offset in the segment of the first frame.
+            frames (list): Tuples of the encoded bytes and the sensor timestamp of each frame,
+                in nanoseconds relative to the race start time.
+        """
+        buffers = [buf for buf, _ in frames]
+        _pwrite_all(self._segment, buffers, offset)
+        records = bytearray()
+        for buf, timestamp in frames:
+            records += INDEX_RECORD.pack(offset, len(buf), timestamp)
+            offset += len(buf)
+        _pwrite_all(self._index, [records], (first_frame - 1) * INDEX_RECORD.size)
+        with self._lock:
+            self.bytes_written += sum(len(buf) for buf in buffers)
+            # Batches from several writer threads can finish out of order
+            self._written_batches[first_frame] = len(frames)
+            while self.committed + 1 in self._written_batches:
+                self.committed += self._written_batches.pop(self.committed + 1)
+
+    def append(self, buf, timestamp):
+        """
+        Append a new frame.
+
+        Args:
+            buf: The encoded bytes of the frame.
+            timestamp (int): The sensor timestamp of the frame in nanoseconds,
+                relative to the race start time.
+
+        Returns:
+            The frame number, starting at 1.
+        """
+        first_frame, offset = self.reserve([len(buf)])
+        self.write(first_frame, offset, [(buf, timestamp)])
+        return first_frame
+
+    def sync(self):
+        """
+        Flush the written frames to the disk.
+        """
+        os.fdatasync(self._segment)
+        os.fdatasync(self._index)
+
+    def close(self):
+        """
+        Release the unused preallocated space and close the files.
+        """
+        if self._segment is None:
+            return
+        os.ftruncate(self._segment, self._offset)
+        os.close(self._segment)
+        os.close(self._index)
+        self._segment = None
+        self._index = None
+
+
+def _pwrite_all(fd, buffers, offset):
+    """
+    Write all buffers at the given offset with as few system calls as possible.
+    """
+    total = sum(len(buf) for buf in buffers)
+    written = os.pwritev(fd, buffers, offset)
+    if written < total:
+        # Short writes are rare, write what is left one buffer at a time
+        data = memoryview(b"".join(buffers))
+        while written < total:
+            written += os.pwrite(fd, data[written:], offset + written)
+
+
+class FrameStoreReader:
+    """
+    Gives access to the frames of a race through a memory map of the segment file.
+    """
+
+    def __init__(self, directory):
+        """
+        Opens the frame store in the given directory.
+
+        Args:
+            directory (str): The race directory.
+        """
+        self.directory = directory
+        self._segment_path = os.path.join(directory, FRAME_SEGMENT_FILE)
+        self._index_path = os.path.join(directory, FRAME_INDEX_FILE)
+        self._lock = threading.RLock()
+        self._index_key = None
+        self._segment_key = None
+        self._segment_size = -1
+        self._map = None
+        self.index = np.empty(0, dtype=INDEX_DTYPE)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Pick up frames that have been written since the store was opened,
+        or the whole store if it has been replaced.
+
+        replace_store() moves the segment before the index, possibly in another process.
+        A new segment is only mapped together with a new index, so while the segment has
+        been moved and the index has not, the old index and the old map are kept and
+        still agree with each other.
+        """
+        with self._lock:
+            stat = os.stat(self._index_path)
+            replaced = self._index_key is None or stat.st_ino != self._index_key[0]
+            if (stat.st_ino, stat.st_size) != self._index_key:
+                count = stat.st_size // INDEX_DTYPE.itemsize
+                self.index = np.fromfile(self._index_path, dtype=INDEX_DTYPE, count=count)
+                self._index_key = (stat.st_ino, stat.st_size)
+            stat = os.stat(self._segment_path)
+            if not replaced and self._segment_key is not None and stat.st_ino != self._segment_key[0]:
+                return
+            segment_size = stat.st_size
+            if (stat.st_ino, segment_size) != self._segment_key:
+                # The old map is left to the garbage collector since slices of it may still be in use
+                mapping = None
+                if segment_size > 0:
+                    with open(self._segment_path, "rb") as segment:
+                        mapping = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+                self._map = mapping
+                self._segment_key = (stat.st_ino, segment_size)
+                self._segment_size = segment_size
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def generation(self):
+        """
+        A number that identifies the stored frames, it changes when the store is replaced,
+        e.g. when the race is archived, and stays the same while frames are added.
+        """
+        return self._segment_key[0]
+
+    @property
+    def timestamps(self):
+        """
+        The timestamps of all frames in nanoseconds relative to the race start time.
+        """
+        return self.index["timestamp"]
+
+    def nearest_frame(self, timestamp):
+        """
+        Find the frame closest in time to the given timestamp.
+
+        Args:
+            timestamp (int): Nanoseconds relative to the race start time.
+
+        Returns:
+            The frame number, starting at 1, or None if the store is empty.
+        """
+        frames = self.nearest_frames([timestamp])
+        if frames is None:
+            return None
+        return int(frames[0])
+
+    def nearest_frames(self, timestamps):
+        """
+        Find the frames closest in time to each of the given timestamps with a binary search.
+
+        Args:
+            timestamps: Nanoseconds relative to the race start time.
+
+        Returns:
+            An array of frame numbers, starting at 1, or None if the store is empty.
+        """
+        self.refresh()
+        stored = self.timestamps
+        if len(stored) == 0:
+            return None
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        right = np.searchsorted(stored, timestamps).clip(0, len(stored) - 1)
+        left = (right - 1).clip(0)
+        closer_left = np.abs(timestamps - stored[left]) <= np.abs(stored[right] - timestamps)
+        return np.where(closer_left, left, right) + 1
+
+    def stored_frame(self, frame_num):
+        """
+        Find the frame to show for a frame number. Frames the motion gate skipped are
+        stored as empty records, they are shown as the last stored frame before them,
+        or the first one after them at the start of a race.
+
+        Args:
+            frame_num (int): The frame number, starting at 1.
+
+        Returns:
+            The frame number of a stored frame, or None if there is none.
+        """
+        with self._lock:
+            if frame_num < 1 or frame_num > len(self.index):
+                self.refresh()
+                if frame_num < 1 or frame_num > len(self.index):
+                    return None
+            stored = self.index["length"] > 0
+            if stored[frame_num - 1]:
+                return frame_num
+            before = np.flatnonzero(stored[:frame_num])
+            if len(before) > 0:
+                return int(before[-1]) + 1
+            after = np.flatnonzero(stored[frame_num:])
+            if len(after) > 0:
+                return frame_num + int(after[0]) + 1
+            return None
+
+    def _locate(self, frame_num):
+        if frame_num < 1 or frame_num > len(self.index):
+            self.refresh()
+            if frame_num < 1 or frame_num > len(self.index):
+                return None
+        record = self.index[frame_num - 1]
+        offset = int(record["offset"])
+        length = int(record["length"])
+        if length == 0:
+            return None
+        if offset + length > self._segment_size:
+            self.refresh()
+            if offset + length > self._segment_size:
+                return None
+        return offset, length
+
+    def open_frame(self, frame_num):
+        """
+        Open the segment file at the start of a frame, so it can be sent without reading it in Python.
+        The index may belong to a segment that another process has replaced since it was
+        read, so the opened file is checked against it and the store is read again if it differs.
+
+        Args:
+            frame_num (int): The frame number, starting at 1.
+
+        Returns:
+            A tuple (file, offset, length) or None if the frame does not exist.
+        """
+        with self._lock:
+            for _ in range(2):
+                location = self._locate(frame_num)
+                if location is None:
+                    return None
+                file = open(self._segment_path, "rb")
+                if os.fstat(file.fileno()).st_ino == self._segment_key[0]:
+                    break
+                file.close()
+                self.refresh()
+            else:
+                # The store is being replaced, the old segment can no longer be opened
+                return None
+        offset, length = location
+        file.seek(offset)
+        return file, offset, length
+
+    def frame(self, frame_num):
+        """
+        Get the encoded bytes of a frame without copying them.
+
+        Args:
+            frame_num (int): The frame number, starting at 1.
+
+        Returns:
+            A memoryview of the frame or None if the frame does not exist.
+        """
+        with self._lock:
+            location = self._locate(frame_num)
+            if location is None:
+                return None
+            offset, length = location
+            return memoryview(self._map)[offset : offset + length]
+
+
+# The readers of the most recently used races, the least recently used is dropped first
+_readers = collections.OrderedDict()
+_readers_lock = threading.Lock()
+
+
+def open_reader(directory):
+    """
+    Get a shared reader for the frame store in the given directory.
+    Only the readers of the last FRAME_READER_CACHE_SIZE races are kept, so the
+    address space taken by their maps stays bounded. A dropped reader unmaps its
+    segment when the garbage collector has seen the last frame that was sliced from it.
+
+    Args:
+        directory (str): The race directory.
+
+    Returns:
+        A FrameStoreReader or None if the directory has no frame store.
+    """
+    with _readers_lock:
+        reader = _readers.get(directory)
+        if reader is not None:
+            _readers.move_to_end(directory)
+            return reader
+        if not has_frame_store(directory):
+            return None
+        reader = FrameStoreReader(directory)
+        _readers[directory] = reader
+        while len(_readers) > FRAME_READER_CACHE_SIZE:
+            _readers.popitem(last=False)
+        return reader
+
+
+def forget_reader(directory):
+    """
+    Drop the shared reader for the given directory, e.g. when the race is deleted.
+
+    Args:
+        directory (str): The race directory.
+    """
+    with _readers_lock:
+        _readers.pop(directory, None)
+
+
+def replace_store(directory, source):
+    """
+    Move the frame store in the source directory over the frame store of a race.
+    Readers of the race pick up the new store the next time they are used.
+
+    Args:
+        directory (str): The race directory.
+        source (str): The directory with the new frame store, on the same file system.
+    """
+    with _readers_lock:
+        reader = _readers.get(directory)
+        lock = reader._lock if reader is not None else threading.Lock()
+        with lock:
+            # The index is moved last, its existence marks a complete store
+            os.replace(
+                os.path.join(source, FRAME_SEGMENT_FILE), os.path.join(directory, FRAME_SEGMENT_FILE)
+            )
+            os.replace(
+                os.path.join(source, FRAME_INDEX_FILE), os.path.join(directory, FRAME_INDEX_FILE)
+            )
+            if reader is not None:
+                reader.refresh()
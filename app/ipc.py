@@ -0,0 +1,278 @@
+"""
+This module contains the command channel between the web workers and the capture daemon.
+
+The daemon listens on a unix socket and every message is one line of JSON. A worker
+sends a command and reads one answer on the same connection, or sends "subscribe" and
+then reads every event the daemon publishes until the connection is closed.
+"""
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from eliot import write_traceback
+
+from app.constants import (CAPTURE_SUBSCRIBER_QUEUE_SIZE, CAPTURE_TIMEOUT,
+                           PREVIEW_LEASE_SECONDS, PREVIEW_MAX_FPS)
+from app.sharedframe import SharedFrameReader
+
+
+class CaptureError(Exception):
+    """
+    The capture daemon could not run a command.
+    """
+
+
+class CaptureUnavailable(CaptureError):
+    """
+    The capture daemon is not running.
+    """
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+class CaptureServer:
+    """
+    Runs the commands of the web workers and publishes events to them, used by the capture daemon.
+    Every connection is served by its own thread.
+    """
+
+    def __init__(self, path):
+        """
+        Listens on the unix socket, replacing a socket left by an earlier daemon.
+
+        Args:
+            path (str): The path of the unix socket.
+        """
+        self.path = path
+        self._commands = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen()
+
+    def register(self, name, function):
+        """
+        Add a command.
+
+        Args:
+            name (str): The name the workers use for the command.
+            function: Called with the arguments of the command, it must return something that can be sent as JSON.
+        """
+        self._commands[name] = function
+
+    def publish(self, event, data=None):
+        """
+        Send an event to every subscribed worker.
+        This never blocks, a worker that falls too far behind is dropped and reconnects.
+
+        Args:
+            event (str): The name of the event.
+            data: The data of the event, it must be possible to send as JSON.
+        """
+        line = json.dumps({"event": event, "data": data}).encode() + b"\n"
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait(line)
+            except queue.Full:
+                with self._lock:
+                    self._subscribers.discard(events)
+
+    def serve_forever(self):
+        """
+        Accept connections until the process ends.
+        """
+        while True:
+            connection, _ = self._socket.accept()
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        with connection, connection.makefile("rb") as lines:
+            for line in lines:
+                try:
+                    message = json.loads(line)
+                    name = message["command"]
+                except (ValueError, KeyError):
+                    _send(connection, {"error": "Invalid message"})
+                    continue
+                if name == "subscribe":
+                    self._stream(connection)
+                    return
+                function = self._commands.get(name)
+                if function is None:
+                    _send(connection, {"error": f"Unknown command: {name}"})
+                    continue
+                try:
+                    result = function(**message.get("args", {}))
+                except Exception as error:
+                    write_traceback()
+                    _send(connection, {"error": repr(error)})
+                else:
+                    _send(connection, {"result": result})
+
+    def _stream(self, connection):
+        events = queue.Queue(CAPTURE_SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(events)
+        try:
+            while True:
+                try:
+                    line = events.get(timeout=1)
+                except queue.Empty:
+                    with self._lock:
+                        if events not in self._subscribers:
+                            # Dropped by publish() for falling behind
+                            return
+                    continue
+                connection.sendall(line)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.discard(events)
+
+
+class CaptureClient:
+    """
+    Sends commands to the capture daemon and receives its events, used by the web workers.
+    A new connection is made for every command, so one client can be shared by all threads.
+    """
+
+    def __init__(self, path, preview_path, timeout=CAPTURE_TIMEOUT):
+        """
+        Args:
+            path (str): The path of the unix socket of the daemon.
+            preview_path (str): The shared ring with the preview frames.
+            timeout (float): Seconds to wait for an answer.
+        """
+        self.path = path
+        self.preview_path = preview_path
+        self.timeout = timeout
+        self._relay = None
+        self._relay_lock = threading.Lock()
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.path)
+        except OSError as error:
+            connection.close()
+            raise CaptureUnavailable(f"The capture daemon is not running: {error}") from error
+        return connection
+
+    def call(self, command, **args):
+        """
+        Run a command in the capture daemon and wait for the result.
+
+        Args:
+            command (str): The name of the command.
+            **args: The arguments of the command.
+
+        Returns:
+            The result of the command.
+
+        Raises:
+            CaptureUnavailable: The daemon is not running.
+            CaptureError: The command failed.
+        """
+        with self._connect() as connection, connection.makefile("rb") as lines:
+            try:
+                _send(connection, {"command": command, "args": args})
+                line = lines.readline()
+            except OSError as error:
+                raise CaptureUnavailable(f"No answer from the capture daemon: {error}") from error
+        if not line:
+            raise CaptureUnavailable("The capture daemon closed the connection")
+        answer = json.loads(line)
+        if "error" in answer:
+            raise CaptureError(answer["error"])
+        return answer["result"]
+
+    def start_relay(self, handler):
+        """
+        Start a thread that hands every event of the daemon to a function.
+        The thread reconnects when the daemon is restarted. Only the first call starts a thread.
+
+        Args:
+            handler: Called with the name and the data of each event. It is called with
+                the event "connected" every time the thread has connected, since events
+                may have been missed while it was not.
+        """
+        with self._relay_lock:
+            if self._relay is not None:
+                return
+            self._relay = threading.Thread(
+                target=self._run_relay, args=(handler,), name="capture-relay", daemon=True
+            )
+            self._relay.start()
+
+    def _run_relay(self, handler):
+        while True:
+            try:
+                connection = self._connect()
+            except CaptureUnavailable:
+                time.sleep(1)
+                continue
+            with connection, connection.makefile("rb") as lines:
+                try:
+                    connection.settimeout(None)
+                    _send(connection, {"command": "subscribe"})
+                    handler("connected", None)
+                    for line in lines:
+                        message = json.loads(line)
+                        try:
+                            handler(message["event"], message["data"])
+                        except Exception:
+                            write_traceback()
+                except OSError:
+                    pass
+            time.sleep(1)
+
+    def preview_frames(self, max_fps=PREVIEW_MAX_FPS):
+        """
+        Get the preview frames from the shared ring.
+        The daemon is asked to keep encoding the preview for as long as the generator is used.
+        A slow consumer skips to the newest frame instead of falling behind.
+
+        Args:
+            max_fps (float): The maximum number of frames per second.
+
+        Returns:
+            A generator that yields JPEG frames.
+        """
+        reader = SharedFrameReader(self.preview_path)
+        interval = 1 / max_fps
+        # Poll for a new frame a few times per frame interval
+        poll = min(interval, 1 / PREVIEW_MAX_FPS) / 4
+        lease = 0
+        sequence = 0
+        next_frame = time.monotonic()
+        while True:
+            if time.monotonic() >= lease:
+                self.call("watch_preview")
+                lease = time.monotonic() + PREVIEW_LEASE_SECONDS / 2
+            if reader.sequence() == sequence:
+                time.sleep(poll)
+                continue
+            latest = reader.read()
+            if latest is None:
+                time.sleep(poll)
+                continue
+            sequence, frame = latest
+            yield frame
+            next_frame = max(next_frame + interval, time.monotonic())
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
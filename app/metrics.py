@@ -0,0 +1,220 @@
+"""
+This module contains the counters and histograms of the capture pipeline.
+
+The metrics are cheap enough to update for every frame: a histogram is a fixed list of
+bucket counts. Several frame writer threads update the same metrics, so each metric
+has a lock, which is only taken for the update itself.
+They are exposed in the Prometheus text format on /metrics and summarised per race.
+"""
+import bisect
+import threading
+
+# Bucket upper bounds in seconds
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+_metrics = []
+
+
+class Counter:
+    """
+    A value that only goes up.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+    def snapshot(self):
+        return self.value
+
+    def summary(self, before):
+        return self.value - before
+
+
+class Gauge(Counter):
+    """
+    A value that can be set to anything.
+    """
+
+    kind = "gauge"
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def summary(self, before):
+        return self.value
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # The last count is for observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        counts, observed_sum = self.snapshot()
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((f"{self.name}_bucket", f'{{le="{le}"}}', cumulative))
+        samples.append((f"{self.name}_sum", "", observed_sum))
+        samples.append((f"{self.name}_count", "", cumulative))
+        return samples
+
+    def snapshot(self):
+        # The counts and the sum are copied together so they agree
+        with self._lock:
+            return list(self.counts), self.sum
+
+    def summary(self, before):
+        """
+        Summarise the observations made since the snapshot.
+        Percentiles are given as the upper bound of the bucket they fall in.
+        """
+        now = self.snapshot()
+        counts = [count - old for count, old in zip(now[0], before[0])]
+        total = sum(counts)
+        if total == 0:
+            return {"count": 0}
+        summary = {"count": total, "mean": (now[1] - before[1]) / total}
+        bounds = self.buckets + (float("inf"),)
+        for name, quantile in (("p50_le", 0.5), ("p99_le", 0.99)):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                if cumulative >= quantile * total:
+                    summary[name] = bound if bound != float("inf") else "+Inf"
+                    break
+        return summary
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def counter(name, description):
+    """
+    Create and register a counter.
+    """
+    return _register(Counter(name, description))
+
+
+def gauge(name, description):
+    """
+    Create and register a gauge.
+    """
+    return _register(Gauge(name, description))
+
+
+def histogram(name, description, buckets=LATENCY_BUCKETS):
+    """
+    Create and register a histogram.
+    """
+    return _register(Histogram(name, description, buckets))
+
+
+def snapshot():
+    """
+    Get the current state of every metric, to summarise what happens after it.
+    """
+    return {metric.name: metric.snapshot() for metric in _metrics}
+
+
+def summary(before):
+    """
+    Summarise every metric since a snapshot.
+
+    Args:
+        before (dict): A snapshot from snapshot().
+
+    Returns:
+        A dict from metric name to its change since the snapshot.
+    """
+    return {
+        metric.name: metric.summary(before[metric.name])
+        for metric in _metrics
+        if metric.name in before
+    }
+
+
+def render():
+    """
+    Get every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+pre_callback_seconds = histogram(
+    "photofinish_pre_callback_seconds", "Time spent in the camera pre_callback per frame."
+)
+encoder_latency_seconds = histogram(
+    "photofinish_encoder_latency_seconds",
+    "Time from the sensor timestamp of a frame until it is handed on by the frame splitter.",
+)
+write_latency_seconds = histogram(
+    "photofinish_write_latency_seconds",
+    "Time from a frame being handed to the frame writer until it is written to the frame store.",
+)
+bytes_written = counter("photofinish_bytes_written_total", "Bytes of frames written to frame stores.")
+frames_received = counter(
+    "photofinish_frames_received_total", "Frames inside a recording window received from the encoder."
+)
+frames_written = counter("photofinish_frames_written_total", "Frames written to frame stores.")
+frames_skipped = counter(
+    "photofinish_frames_skipped_total", "Frames stored as empty records because the motion gate saw no motion."
+)
+frames_dropped = counter(
+    "photofinish_frames_dropped_total", "Frames dropped because the frame writer queue was full."
+)
+frame_gaps = counter(
+    "photofinish_frame_gaps_total",
+    "Times the sensor timestamps of consecutive recorded frames were more than 1.5 frame periods apart.",
+)
+frames_missing = counter(
+    "photofinish_frames_missing_total", "Frames missing in the gaps between recorded sensor timestamps."
+)
+race_frames_expected = gauge(
+    "photofinish_race_frames_expected", "Frames the last recording window should have held."
+)
+disk_bandwidth = gauge(
+    "photofinish_disk_bandwidth_bytes", "Bytes per second the disk of the races wrote when it was measured."
+)
@@ -2,6 +2,9 @@
 This module contains the models for the application.
 """
 
+from typing import Optional
+
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app import db
@@ -13,10 +16,19 @@ class Race(db.Model):
     """
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    start_time: Mapped[str] = mapped_column()
-    running: Mapped[bool] = mapped_column(default=False)
-    started: Mapped[bool] = mapped_column(default=False)
+    start_time: Mapped[str] = mapped_column(index=True)
+    running: Mapped[bool] = mapped_column(default=False, index=True)
+    started: Mapped[bool] = mapped_column(default=False, index=True)
     eliot_task_id: Mapped[str] = mapped_column()
+    # Catalog of the recording, filled in when the recording finishes
+    frame_count: Mapped[Optional[int]] = mapped_column(default=None)
+    byte_size: Mapped[Optional[int]] = mapped_column(default=None)
+    # Timestamps in nanoseconds relative to the race start time
+    first_timestamp: Mapped[Optional[int]] = mapped_column(default=None)
+    last_timestamp: Mapped[Optional[int]] = mapped_column(default=None)
+    # Seconds between the first and the last frame
+    duration: Mapped[Optional[float]] = mapped_column(default=None)
+    thumbnail: Mapped[Optional[str]] = mapped_column(default=None)
 
 
 class Config(db.Model):
@@ -32,3 +44,53 @@ class Config(db.Model):
     rotation: Mapped[int] = mapped_column(default=0)
     start_filming_after: Mapped[int] = mapped_column(default=7)
     stop_filming_after: Mapped[int] = mapped_column(default=25)
+    # The capture profile races are recorded with, "standard" uses the frame rate and resolution above
+    capture_profile: Mapped[str] = mapped_column(default="standard")
+    # Only store the frames with motion, the other frames are kept as empty records
+    motion_gate: Mapped[bool] = mapped_column(default=False)
+    # Re-encode the frames far from the detected crossings at a lower quality when a race is archived
+    archive_reencode: Mapped[bool] = mapped_column(default=False)
+    # Bytes of a JPEG frame per pixel in the last race, learned by the capture daemon
+    bytes_per_pixel: Mapped[Optional[float]] = mapped_column(default=None)
+    # Bytes per second the disk of the races wrote when the capture daemon measured it
+    disk_bandwidth: Mapped[Optional[float]] = mapped_column(default=None)
+    # End points of the goal line as fractions of the image width and height
+    goal_line_x1: Mapped[Optional[float]] = mapped_column(default=None)
+    goal_line_y1: Mapped[Optional[float]] = mapped_column(default=None)
+    goal_line_x2: Mapped[Optional[float]] = mapped_column(default=None)
+    goal_line_y2: Mapped[Optional[float]] = mapped_column(default=None)
+
+    def goal_line(self):
+        """
+        Get the goal line as (x1, y1, x2, y2), or None if no line has been drawn.
+        """
+        goal_line = (self.goal_line_x1, self.goal_line_y1, self.goal_line_x2, self.goal_line_y2)
+        if None in goal_line:
+            return None
+        return goal_line
+
+
+def add_missing_columns():
+    """
+    Add columns that were added to the models after the database was created.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            statement = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}"
+            if column.default is not None and column.default.is_scalar and column.default.arg is not None:
+                statement += f" DEFAULT {column.default.arg!r}"
+            db.session.execute(text(statement))
+    db.session.commit()
+
+
+def add_missing_indexes():
+    """
+    Create indexes that were added to the models after the database was created.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
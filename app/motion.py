@@ -0,0 +1,104 @@
+"""
+This module contains the motion gate that keeps the frames of an empty track out of the frame store.
+"""
+import bisect
+
+import cv2
+import numpy as np
+
+from app.constants import (MOTION_GATE_FRACTION, MOTION_GATE_PIXEL_THRESHOLD,
+                           MOTION_GATE_POST_PADDING, MOTION_GATE_PRE_PADDING,
+                           MOTION_GATE_SCALE)
+
+
+class MotionGate:
+    """
+    Decides which frames of a race are stored from the motion in the low resolution stream.
+
+    Every Y plane of the preview stream is shrunk and compared to the one before it. A frame
+    has motion when enough pixels have changed, and every frame from MOTION_GATE_PRE_PADDING
+    seconds before to MOTION_GATE_POST_PADDING seconds after a frame with motion is kept,
+    so a crossing is never cut. The other frames are only counted.
+
+    process() is called from the camera thread before a frame is encoded, keep() from the
+    encoder thread once the frames after it have been processed.
+    """
+
+    def __init__(
+        self,
+        size,
+        scale=MOTION_GATE_SCALE,
+        threshold=MOTION_GATE_PIXEL_THRESHOLD,
+        fraction=MOTION_GATE_FRACTION,
+        pre_padding=MOTION_GATE_PRE_PADDING,
+        post_padding=MOTION_GATE_POST_PADDING,
+    ):
+        """
+        Args:
+            size (tuple): The size of the Y plane of the low resolution stream (width, height).
+            scale (int): The Y plane is shrunk by this factor, it must be even.
+            threshold (int): The change in luma of a pixel that counts as motion.
+            fraction (float): Part of the pixels that have to change for a frame to have motion.
+            pre_padding (float): Seconds of frames kept before a frame with motion.
+            post_padding (float): Seconds of frames kept after a frame with motion.
+        """
+        width, height = size
+        self._size = size
+        self._shrunk = (width // scale, height // scale)
+        self.threshold = threshold
+        self.min_pixels = max(1, int(fraction * self._shrunk[0] * self._shrunk[1]))
+        self.pre_padding = int(pre_padding * 1e9)
+        self.post_padding = int(post_padding * 1e9)
+        self.processed_until = None
+        self.motion_frames = 0
+        self._previous = None
+        # Sorted, non overlapping (start, end) sensor timestamps of the frames to keep
+        self._intervals = []
+
+    def process(self, array, timestamp):
+        """
+        Look for motion in a frame of the low resolution stream.
+
+        Args:
+            array: The frame array, the Y plane must be at the top of it.
+            timestamp (int): The sensor timestamp of the frame in nanoseconds.
+        """
+        width, height = self._size
+        # Skipping every other pixel before averaging is much cheaper and still averages out the noise
+        half = np.ascontiguousarray(array[:height:2, :width:2])
+        shrunk = cv2.resize(half, self._shrunk, interpolation=cv2.INTER_AREA)
+        previous = self._previous
+        if previous is not None:
+            moved = np.count_nonzero(cv2.absdiff(shrunk, previous) > self.threshold)
+            if moved >= self.min_pixels:
+                self._motion(timestamp)
+        self._previous = shrunk
+        self.processed_until = timestamp
+
+    def _motion(self, timestamp):
+        self.motion_frames += 1
+        start, end = timestamp - self.pre_padding, timestamp + self.post_padding
+        if self._intervals and start <= self._intervals[-1][1]:
+            self._intervals[-1] = (self._intervals[-1][0], end)
+        else:
+            self._intervals.append((start, end))
+
+    def decided(self, timestamp):
+        """
+        Check if every frame that could make a frame kept has been processed.
+
+        Args:
+            timestamp (int): The sensor timestamp of the frame in nanoseconds.
+        """
+        return self.processed_until is not None and self.processed_until >= timestamp + self.pre_padding
+
+    def keep(self, timestamp):
+        """
+        Check if a frame is close enough to motion to be stored.
+
+        Args:
+            timestamp (int): The sensor timestamp of the frame in nanoseconds.
+        """
+        intervals = self._intervals
+        position = bisect.bisect_right(intervals, (timestamp, float("inf"))) - 1
+        return position >= 0 and intervals[position][1] >= timestamp
@@ -0,0 +1,135 @@
+"""
+This module contains the renderer for the race clock that is burned into every frame.
+"""
+import cv2
+import numpy as np
+
+from app.constants import (TIMESTAMP_COLOUR, TIMESTAMP_FONT, TIMESTAMP_ORIGIN,
+                           TIMESTAMP_SCALE, TIMESTAMP_THICKNESS)
+
+
+def format_timestamp(elapsed_ns):
+    """
+    Format the time since the race start the way it is shown on the frames.
+
+    Args:
+        elapsed_ns (int): Nanoseconds since the race start.
+    """
+    elapsed_cs = round(elapsed_ns / 10_000_000)  # centiseconds (hundredths of a second)
+    return f"{elapsed_cs / 100:0>5.2f}"
+
+
+class TimestampRenderer:
+    """
+    Draws the race clock from a glyph atlas instead of calling cv2.putText for every frame.
+
+    cv2.putText draws every character on its own at an offset given by the width of
+    the characters before it, so the text can be put together from characters that
+    were rendered once. The atlas holds the pixels of each character at each position
+    it can appear, rendered with cv2.putText on an image of the same size as the frame,
+    which makes the result identical to drawing the whole text with cv2.putText.
+    """
+
+    GLYPHS = "0123456789.-"
+
+    def __init__(
+        self,
+        origin=TIMESTAMP_ORIGIN,
+        font=TIMESTAMP_FONT,
+        scale=TIMESTAMP_SCALE,
+        colour=TIMESTAMP_COLOUR,
+        thickness=TIMESTAMP_THICKNESS,
+    ):
+        self.origin = origin
+        self.font = font
+        self.scale = scale
+        self.colour = colour
+        self.thickness = thickness
+        self.exact = True
+        self._advances = {
+            glyph: cv2.getTextSize(glyph, font, scale, thickness)[0][0] - thickness
+            for glyph in self.GLYPHS
+        }
+        self._shape = None
+        self._atlas = {}
+
+    def prepare(self, shape):
+        """
+        Render the atlas for frames of the given shape.
+        This takes a few milliseconds so it should be done before the recording starts.
+
+        Args:
+            shape (tuple): The shape of the frame array, (rows, columns).
+        """
+        shape = tuple(shape[:2])
+        if shape == self._shape:
+            return
+        self._shape = shape
+        _, baseline = cv2.getTextSize("0", self.font, self.scale, self.thickness)
+        # Only the rows the text can reach need to be rendered
+        self._rows = min(shape[0], self.origin[1] + baseline + self.thickness + 1)
+        self._atlas = {}
+        self.exact = True
+        for pattern in ("00.00", "000.00", "-0.00", "-00.00"):
+            for digit in "0123456789":
+                self._glyphs(pattern.replace("0", digit))
+        # Fall back to cv2.putText if the font does not line up on whole pixels
+        for text in ("07.53", "-1.26", "654.32"):
+            reference = np.zeros(shape, dtype=np.uint8)
+            cv2.putText(reference, text, self.origin, self.font, self.scale, 255, self.thickness)
+            rendered = np.zeros(shape, dtype=np.uint8)
+            for indices in self._glyphs(text):
+                rendered.reshape(-1)[indices] = 255
+            if not np.array_equal(reference, rendered):
+                self.exact = False
+                break
+
+    def _glyph(self, glyph, x):
+        """
+        Get the pixels of a character drawn with its origin at column x,
+        as indices into the flattened frame.
+        """
+        key = (glyph, x)
+        indices = self._atlas.get(key)
+        if indices is None:
+            canvas = np.zeros((self._rows, self._shape[1]), dtype=np.uint8)
+            cv2.putText(canvas, glyph, (x, self.origin[1]), self.font, self.scale, 255, self.thickness)
+            indices = np.flatnonzero(canvas)
+            self._atlas[key] = indices
+        return indices
+
+    def _glyphs(self, text):
+        glyphs = []
+        x = self.origin[0]
+        for glyph in text:
+            glyphs.append(self._glyph(glyph, x))
+            x += self._advances[glyph]
+        return glyphs
+
+    def render(self, array, elapsed_ns):
+        """
+        Draw the race clock on a frame.
+
+        Args:
+            array: The frame array, e.g. the YUV420 array of the main stream.
+            elapsed_ns (int): Nanoseconds since the race start.
+        """
+        text = format_timestamp(elapsed_ns)
+        self.prepare(array.shape)
+        if (
+            not self.exact
+            or not array.flags.c_contiguous
+            or any(glyph not in self._advances for glyph in text)
+        ):
+            cv2.putText(
+                array, text, self.origin, self.font, self.scale, self.colour, self.thickness
+            )
+            return
+        if array.ndim == 2:
+            pixels = array.reshape(-1)
+            colour = self.colour[0]
+        else:
+            pixels = array.reshape(-1, array.shape[2])
+            colour = self.colour[: array.shape[2]]
+        for indices in self._glyphs(text):
+            pixels[indices] = colour
@@ -0,0 +1,124 @@
+"""
+This module contains the broadcaster for the live preview stream.
+"""
+import contextlib
+import io
+import threading
+import time
+
+from eliot import start_action
+from picamera2.encoders import MJPEGEncoder
+from picamera2.outputs import FileOutput
+
+from app.constants import PREVIEW_BITRATE, PREVIEW_MAX_FPS
+
+
+class PreviewBroadcaster(io.BufferedIOBase):
+    """
+    Encodes the low resolution stream once and shares the latest frame with every subscriber.
+
+    The encoder runs on the lores stream only while there are subscribers, so it never
+    interferes with a race being recorded from the main stream.
+    """
+
+    def __init__(self, picam2):
+        """
+        Args:
+            picam2: The Picamera2 object that owns the lores stream.
+        """
+        self.picam2 = picam2
+        self.frame = None
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self._subscribers = 0
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+
+    def write(self, buf):
+        if buf.startswith(b"\xff\xd8"):
+            with self.condition:
+                self.frame = buf
+                self.sequence += 1
+                self.condition.notify_all()
+        return len(buf)
+
+    def _subscribe(self):
+        with self._encoder_lock:
+            self._subscribers += 1
+            if self._encoder is not None:
+                return
+            with start_action(action_type="start_preview_encoder"):
+                self._encoder = MJPEGEncoder(PREVIEW_BITRATE)
+                self.picam2.start_encoder(self._encoder, FileOutput(self), name="lores")
+                if not self.picam2.started:
+                    self.picam2.start()
+
+    def _unsubscribe(self):
+        # The condition is not held here since stopping waits for the encoder thread,
+        # which may be waiting for the condition in write()
+        with self._encoder_lock:
+            self._subscribers -= 1
+            if self._subscribers > 0 or self._encoder is None:
+                return
+            with start_action(action_type="stop_preview_encoder"):
+                self.picam2.stop_encoder(self._encoder)
+                self._encoder = None
+            with self.condition:
+                self.frame = None
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        Stop the encoder while the camera is reconfigured and start it again afterwards
+        if anyone is still watching. The subscribers keep waiting for the next frame.
+        """
+        with self._encoder_lock:
+            if self._encoder is not None:
+                self.picam2.stop_encoder(self._encoder)
+                self._encoder = None
+            try:
+                yield
+            finally:
+                if self._subscribers > 0:
+                    self._encoder = MJPEGEncoder(PREVIEW_BITRATE)
+                    self.picam2.start_encoder(self._encoder, FileOutput(self), name="lores")
+                    if not self.picam2.started:
+                        self.picam2.start()
+
+    def frames(self, max_fps=PREVIEW_MAX_FPS, until=None):
+        """
+        Get the preview frames as they are encoded.
+        A slow subscriber skips to the newest frame instead of falling behind.
+
+        Args:
+            max_fps (float): The maximum number of frames per second for this subscriber.
+            until: A function that returns True when the subscriber is done. It is called
+                after every frame and every second without one, so the stream also ends
+                when the camera delivers no frames.
+
+        Returns:
+            A generator that yields JPEG frames.
+        """
+        interval = 1 / max_fps
+        self._subscribe()
+        try:
+            sequence = 0
+            next_frame = time.monotonic()
+            while True:
+                with self.condition:
+                    frame = None
+                    if self.condition.wait_for(lambda: self.sequence != sequence, timeout=1):
+                        frame, sequence = self.frame, self.sequence
+                if frame is not None:
+                    yield frame
+                if until is not None and until():
+                    return
+                if frame is None:
+                    continue
+                # Throttle outside of the lock so other subscribers are not held up
+                next_frame = max(next_frame + interval, time.monotonic())
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            self._unsubscribe()
@@ -0,0 +1,72 @@
+"""
+This module contains the ring buffer that keeps the latest encoded frames in memory
+before the recording window of a race opens.
+"""
+import collections
+
+from app.constants import FRAME_RING_BUFFER_SECONDS, FRAME_RING_BUFFER_SIZE
+
+
+class FrameRingBuffer:
+    """
+    Keeps the encoded frames of the last few seconds in one preallocated buffer.
+    The oldest frames are overwritten when the buffer is full.
+    """
+
+    def __init__(self, size=FRAME_RING_BUFFER_SIZE, seconds=FRAME_RING_BUFFER_SECONDS):
+        """
+        Allocates the buffer.
+
+        Args:
+            size (int): The size of the buffer in bytes.
+            seconds (float): Frames older than this, compared to the newest frame, are dropped.
+        """
+        self._data = bytearray(size)
+        self._max_age = int(seconds * 1e9)
+        self._head = 0
+        # (offset, length, timestamp) of each frame, oldest first
+        self._frames = collections.deque()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, buf, timestamp):
+        """
+        Add a frame, overwriting the oldest frames if needed.
+
+        Args:
+            buf: The encoded bytes of the frame.
+            timestamp (int): The sensor timestamp of the frame in nanoseconds.
+        """
+        length = len(buf)
+        if length > len(self._data):
+            return
+        start = self._head
+        if start + length > len(self._data):
+            start = 0
+            # The frames after the head are the oldest ones, they are skipped when wrapping
+            while self._frames and self._frames[0][0] >= self._head:
+                self._frames.popleft()
+        end = start + length
+        while self._frames and self._frames[0][0] < end and self._frames[0][0] + self._frames[0][1] > start:
+            self._frames.popleft()
+        while self._frames and timestamp - self._frames[0][2] > self._max_age:
+            self._frames.popleft()
+        self._data[start:end] = buf
+        self._frames.append((start, length, timestamp))
+        self._head = end
+
+    def drain(self):
+        """
+        Remove all frames from the buffer.
+
+        Returns:
+            A list of tuples with a copy of the encoded bytes and the timestamp of each frame, oldest first.
+        """
+        frames = [
+            (bytes(self._data[offset : offset + length]), timestamp)
+            for offset, length, timestamp in self._frames
+        ]
+        self._frames.clear()
+        self._head = 0
+        return frames
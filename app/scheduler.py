@@ -0,0 +1,116 @@
+"""
+This module contains the capture scheduler, the one thread that changes the state of a race.
+"""
+import concurrent.futures
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+from eliot import start_action, write_traceback
+
+
+class Deadline:
+    """
+    A function that is run by the scheduler at a monotonic time.
+    """
+
+    def __init__(self, when, function, args):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Keep the function from being run. Must be called from the scheduler thread.
+        """
+        self.cancelled = True
+
+
+class CaptureScheduler(threading.Thread):
+    """
+    Runs events and deadlines one at a time on a single long lived thread.
+
+    Other threads, like the GPIO alert callback and the request handlers, only post
+    events, so they never block on the camera and two events never change a race at the
+    same time. Deadlines are kept in a heap ordered by their time.monotonic_ns() time,
+    and the thread sleeps on the event queue until the next deadline is due.
+    """
+
+    def __init__(self):
+        super().__init__(name="capture-scheduler", daemon=True)
+        self._events = queue.SimpleQueue()
+        self._deadlines = []
+        self._sequence = itertools.count()
+        # Nanoseconds between when deadlines were due and when they ran
+        self.last_jitter = None
+        self.max_jitter = 0
+
+    def post(self, function, *args):
+        """
+        Run a function on the scheduler thread as soon as possible.
+        This only puts the function on a queue, so it is safe to call from any thread.
+
+        Args:
+            function: The function to run.
+            *args: The arguments to the function.
+
+        Returns:
+            A future for the result of the function.
+        """
+        future = concurrent.futures.Future()
+        self._events.put((future, function, args))
+        return future
+
+    def schedule(self, when, function, *args):
+        """
+        Run a function on the scheduler thread at a monotonic time.
+        Must be called from the scheduler thread, i.e. from a posted function.
+
+        Args:
+            when (int): The time.monotonic_ns() time to run the function at.
+            function: The function to run.
+            *args: The arguments to the function.
+
+        Returns:
+            A Deadline that can be cancelled.
+        """
+        deadline = Deadline(when, function, args)
+        heapq.heappush(self._deadlines, (when, next(self._sequence), deadline))
+        return deadline
+
+    def run(self):
+        while True:
+            timeout = None
+            if self._deadlines:
+                timeout = max(self._deadlines[0][0] - time.monotonic_ns(), 0) / 1e9
+            try:
+                future, function, args = self._events.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args))
+                    except Exception as error:
+                        write_traceback()
+                        future.set_exception(error)
+            self._run_due()
+
+    def _run_due(self):
+        while self._deadlines and self._deadlines[0][0] <= time.monotonic_ns():
+            _, _, deadline = heapq.heappop(self._deadlines)
+            if deadline.cancelled:
+                continue
+            jitter = time.monotonic_ns() - deadline.when
+            self.last_jitter = jitter
+            self.max_jitter = max(self.max_jitter, jitter)
+            with start_action(
+                action_type="deadline", function=deadline.function.__name__, jitter_us=jitter // 1000
+            ):
+                try:
+                    deadline.function(*deadline.args)
+                except Exception:
+                    write_traceback()
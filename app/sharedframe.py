@@ -0,0 +1,163 @@
+"""
+This module contains the shared memory ring that hands the latest preview frames
+from the capture daemon to the web workers.
+
+The ring is a file in /dev/shm that the daemon writes and the workers map read only.
+It holds a header with the sequence number of the newest frame and a few fixed size
+slots. A frame is written to the slot after the newest one, so a reader copying the
+newest frame is not disturbed until the writer has gone round the whole ring, and
+the sequence number of the slot is checked after the copy to detect that case.
+"""
+import mmap
+import os
+import struct
+
+from app.constants import PREVIEW_SHARED_SLOT_SIZE, PREVIEW_SHARED_SLOTS
+
+# Magic, number of slots, slot size and the sequence number of the newest frame
+HEADER = struct.Struct("<4sIIQ")
+# Sequence number and length of the frame in the slot
+SLOT_HEADER = struct.Struct("<QI")
+MAGIC = b"PFPV"
+
+
+class SharedFrameRing:
+    """
+    Writes frames to the shared ring, used by the capture daemon.
+    """
+
+    def __init__(self, path, slots=PREVIEW_SHARED_SLOTS, slot_size=PREVIEW_SHARED_SLOT_SIZE):
+        """
+        Creates the ring, replacing any ring left by an earlier daemon.
+
+        Args:
+            path (str): The file of the ring.
+            slots (int): The number of frames in the ring.
+            slot_size (int): The largest frame in bytes.
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.sequence = 0
+        size = HEADER.size + slots * (SLOT_HEADER.size + slot_size)
+        # A new file so readers of an old ring see that it was replaced
+        temporary = f"{path}.{os.getpid()}"
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self._map, 0, MAGIC, slots, slot_size, 0)
+        os.replace(temporary, path)
+
+    def publish(self, frame):
+        """
+        Make a frame the newest frame of the ring.
+
+        Args:
+            frame: The encoded bytes of the frame.
+
+        Returns:
+            False if the frame is too large for a slot and was skipped.
+        """
+        length = len(frame)
+        if length > self.slot_size:
+            return False
+        sequence = self.sequence + 1
+        offset = _slot_offset(sequence, self.slots, self.slot_size)
+        # The slot is marked empty while it is written
+        SLOT_HEADER.pack_into(self._map, offset, 0, 0)
+        start = offset + SLOT_HEADER.size
+        self._map[start : start + length] = frame
+        SLOT_HEADER.pack_into(self._map, offset, sequence, length)
+        HEADER.pack_into(self._map, 0, MAGIC, self.slots, self.slot_size, sequence)
+        self.sequence = sequence
+        return True
+
+    def close(self):
+        """
+        Remove the ring.
+        """
+        self._map.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SharedFrameReader:
+    """
+    Reads the newest frame from the shared ring, used by the web workers.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The file of the ring.
+        """
+        self.path = path
+        self._map = None
+        self._inode = None
+        self._slots = 0
+        self._slot_size = 0
+
+    def _open(self):
+        """
+        Map the ring, or map it again if the daemon has replaced it.
+
+        Returns:
+            False if there is no ring.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._map = None
+            return False
+        if stat.st_ino == self._inode and self._map is not None:
+            return True
+        with open(self.path, "rb") as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, slots, slot_size, _ = HEADER.unpack_from(mapping, 0)
+        if magic != MAGIC:
+            mapping.close()
+            return False
+        self._map, self._inode = mapping, stat.st_ino
+        self._slots, self._slot_size = slots, slot_size
+        return True
+
+    def sequence(self):
+        """
+        Get the sequence number of the newest frame, 0 if there is no frame yet.
+        """
+        if not self._open():
+            return 0
+        return HEADER.unpack_from(self._map, 0)[3]
+
+    def read(self):
+        """
+        Copy the newest frame.
+
+        Returns:
+            A tuple (sequence, frame) or None if there is no frame.
+        """
+        if not self._open():
+            return None
+        for _ in range(self._slots):
+            sequence = HEADER.unpack_from(self._map, 0)[3]
+            if sequence == 0:
+                return None
+            offset = _slot_offset(sequence, self._slots, self._slot_size)
+            slot_sequence, length = SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_sequence != sequence or length > self._slot_size:
+                continue
+            start = offset + SLOT_HEADER.size
+            frame = self._map[start : start + length]
+            # The writer may have gone round the ring while the frame was copied
+            if SLOT_HEADER.unpack_from(self._map, offset)[0] == sequence:
+                return sequence, frame
+        return None
+
+
+def _slot_offset(sequence, slots, slot_size):
+    return HEADER.size + (sequence % slots) * (SLOT_HEADER.size + slot_size)
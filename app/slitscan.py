@@ -0,0 +1,104 @@
+"""
+This module contains the slit-scan photo finish strip that is built while a race is recorded.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from app.constants import (STRIP_AXIS_HEIGHT, STRIP_FILE, STRIP_INDEX_FILE,
+                           STRIP_QUALITY)
+from app.finishline import line_samples
+from app.framestore import FrameStoreReader
+
+
+def load_strip_index(directory):
+    """
+    Get the frame number and timestamp of every column of the strip of a race.
+
+    Args:
+        directory (str): The race directory.
+
+    Returns:
+        A dict with the frame numbers and timestamps, or None if the race has no strip.
+    """
+    try:
+        with open(os.path.join(directory, STRIP_INDEX_FILE)) as index:
+            return json.load(index)
+    except FileNotFoundError:
+        return None
+
+
+class SlitScanStrip:
+    """
+    Stacks the pixels on the goal line of every recorded frame side by side,
+    so the strip shows the goal line over time like a photo finish camera.
+    """
+
+    def __init__(self, goal_line, size, capacity=1024):
+        """
+        Args:
+            goal_line (tuple): The end points of the line (x1, y1, x2, y2) as fractions of the image size.
+            size (tuple): The size of the Y plane (width, height).
+            capacity (int): The number of frames to allocate room for, the buffer grows when needed.
+        """
+        self._ys, self._xs = line_samples(goal_line, size)
+        self.window = None
+        self.count = 0
+        # One row per frame, transposed when the strip is saved
+        self._rows = np.empty((capacity, len(self._ys)), dtype=np.uint8)
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+
+    def process(self, array, timestamp):
+        """
+        Add the goal line of a frame to the strip if it is inside the recording window.
+
+        Args:
+            array: The frame array, the Y plane must be at the top of it.
+            timestamp (int): The sensor timestamp of the frame in nanoseconds.
+        """
+        window = self.window
+        if window is None or not window[0] <= timestamp < window[1]:
+            return
+        if self.count == len(self._rows):
+            self._rows = np.concatenate((self._rows, np.empty_like(self._rows)))
+            self._timestamps = np.concatenate((self._timestamps, np.empty_like(self._timestamps)))
+        self._rows[self.count] = array[self._ys, self._xs]
+        self._timestamps[self.count] = timestamp
+        self.count += 1
+
+    def save(self, directory, race_start_time):
+        """
+        Store the strip with a time axis below it, and the frame of every column.
+
+        Args:
+            directory (str): The race directory with the frame store.
+            race_start_time (int): The start time of the race as a monotonic time in nanoseconds.
+        """
+        if self.count == 0:
+            return
+        timestamps = self._timestamps[: self.count] - race_start_time
+        strip = self._rows[: self.count].T
+        axis = np.zeros((STRIP_AXIS_HEIGHT, self.count), dtype=np.uint8)
+        seconds = timestamps // 1_000_000_000
+        for column in np.flatnonzero(np.diff(seconds)) + 1:
+            cv2.line(axis, (int(column), 0), (int(column), STRIP_AXIS_HEIGHT // 3), 255)
+            cv2.putText(
+                axis,
+                f"{seconds[column]}s",
+                (int(column) + 2, STRIP_AXIS_HEIGHT - 4),
+                cv2.FONT_HERSHEY_PLAIN,
+                1,
+                255,
+            )
+        cv2.imwrite(
+            os.path.join(directory, STRIP_FILE),
+            np.vstack((strip, axis)),
+            [cv2.IMWRITE_JPEG_QUALITY, STRIP_QUALITY],
+        )
+        frames = FrameStoreReader(directory).nearest_frames(timestamps)
+        if frames is None:
+            return
+        with open(os.path.join(directory, STRIP_INDEX_FILE), "w") as index:
+            json.dump({"frames": frames.tolist(), "timestamps": timestamps.tolist()}, index)
@@ -0,0 +1,141 @@
+"""
+This module contains the state of the races that the capture daemon keeps in memory.
+"""
+import threading
+
+from sqlalchemy import update
+
+from app import db, models
+
+
+def _copy(row):
+    """
+    Copy the columns of a row into a new object of its model that no session knows about,
+    so it can be read from any thread and is never reloaded from the database.
+    """
+    return type(row)(**{column.key: getattr(row, column.key) for column in row.__table__.columns})
+
+
+class RaceState:
+    """
+    The running race and the configuration, held in memory and written through to the database.
+
+    The capture daemon is the only process that changes races, so once the state is loaded
+    it knows the running race without asking the database, and an opening cage or a new
+    race reads nothing from it. Every change is made in memory and written to the database
+    before the method returns. The configuration is changed by the web workers, they tell
+    the daemon to reload it.
+
+    The race and the configuration are copies that must not be changed by the caller.
+    The methods that touch the database have to be called in an application context.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.race = None
+        self.config = None
+        # Finished races that were started, the number of the next race is one more
+        self.finished = 0
+
+    def load(self):
+        """
+        Read the running race, the configuration and the number of finished races from the database.
+        """
+        with self._lock:
+            row = models.Race.query.filter_by(running=True).first()
+            self.race = None if row is None else _copy(row)
+            self.finished = models.Race.query.filter_by(running=False, started=True).count()
+            self.reload_config()
+
+    def reload_config(self):
+        """
+        Read the configuration from the database after a web worker has changed it.
+
+        Returns:
+            The configuration.
+        """
+        with self._lock:
+            self.config = _copy(models.Config.query.first())
+            return self.config
+
+    def update_config(self, **values):
+        """
+        Change the columns of the configuration that the capture daemon learns itself,
+        the web workers only write the columns the user sets.
+
+        Args:
+            values: The columns to change and their new values.
+
+        Returns:
+            The configuration.
+        """
+        with self._lock:
+            config = _copy(self.config)
+            for name, value in values.items():
+                setattr(config, name, value)
+            db.session.execute(update(models.Config).where(models.Config.id == config.id).values(**values))
+            db.session.commit()
+            self.config = config
+            return config
+
+    def create_race(self, start_time, task_id):
+        """
+        Add a new running race.
+
+        Args:
+            start_time (str): The name of the race, the time it was created.
+            task_id (str): The serialized eliot task id of the race.
+
+        Returns:
+            The race.
+        """
+        with self._lock:
+            row = models.Race(start_time=start_time, running=True, eliot_task_id=task_id)
+            db.session.add(row)
+            # The id is known after the flush, copying after the commit would reload the row
+            db.session.flush()
+            race = _copy(row)
+            db.session.commit()
+            self.race = race
+            return race
+
+    def start_race(self):
+        """
+        Mark the running race as started.
+
+        Returns:
+            The race, or None if no race is running or it has already started.
+        """
+        with self._lock:
+            race = self.race
+            if race is None or race.started:
+                return None
+            race = _copy(race)
+            race.started = True
+            self._write(race.id, started=True)
+            self.race = race
+            return race
+
+    def finish_race(self, **catalog):
+        """
+        Mark the running race as finished.
+
+        Args:
+            catalog: The catalog values of the race to store with it.
+
+        Returns:
+            The race as it was before it finished, or None if no race is running.
+        """
+        with self._lock:
+            race = self.race
+            if race is None:
+                return None
+            self._write(race.id, running=False, **catalog)
+            self.race = None
+            if race.started:
+                self.finished += 1
+            return race
+
+    def _write(self, race_id, **values):
+        db.session.execute(update(models.Race).where(models.Race.id == race_id).values(**values))
+        db.session.commit()
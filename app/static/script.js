@@ -7,14 +7,83 @@ const raceSelect = document.getElementById('race');
 document.getElementById('deleteRaceInput').value = raceSelect.options[raceSelect.selectedIndex].value;
 var selectedRaceName = raceSelect.options[raceSelect.selectedIndex].text;
 
+// Time without slider movement before the full size frame is loaded
+const FULL_IMAGE_DELAY = 150;
+var sprites = undefined;
+var fullImageTimer = undefined;
+// The version of the frames of the selected race, frame URLs with it are cached for good
+var frameVersion = undefined;
+
 function changeImage(e) {
-    image.src = image.src.replace(/\d{4}.jpg/, e.target.value.padStart(4, 0) + '.jpg')
+    const frame = parseInt(e.target.value);
+    clearTimeout(fullImageTimer);
+    if (showSprite(frame)) {
+        fullImageTimer = setTimeout(function () { loadFullImage(frame); }, FULL_IMAGE_DELAY);
+    } else {
+        loadFullImage(frame);
+    }
+}
+
+function loadFullImage(frame) {
+    image.src = image.src.replace(/\d{4}.jpg/, String(frame).padStart(4, 0) + '.jpg')
+}
+
+function frameUrl(race, frame) {
+    const url = '/static/race/' + race + '/image_' + String(frame).padStart(4, 0) + '.jpg';
+    return frameVersion ? url + '?v=' + frameVersion : url;
+}
+
+function loadSprites(race) {
+    sprites = undefined;
+    hideSprite();
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/static/race/' + race + '/sprites.json', true);
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            return;
+        }
+        const index = JSON.parse(xhr.responseText);
+        index.urls = index.sheets.map(function (sheet) {
+            const url = '/static/race/' + race + '/' + sheet;
+            // Fetch every sheet up front so scrubbing never waits for the network
+            new Image().src = url;
+            return url;
+        });
+        sprites = index;
+    };
+    xhr.send();
+}
+
+function showSprite(frame) {
+    if (!sprites || frame < 1 || frame > sprites.offsets.length) {
+        return false;
+    }
+    const [sheet, x, y] = sprites.offsets[frame - 1];
+    const [sheetWidth, sheetHeight] = sprites.sheet_sizes[sheet];
+    const overlay = document.getElementById('sprite_preview');
+    const scaleX = overlay.parentElement.clientWidth / sprites.tile[0];
+    const scaleY = overlay.parentElement.clientHeight / sprites.tile[1];
+    overlay.style.backgroundImage = 'url(' + sprites.urls[sheet] + ')';
+    overlay.style.backgroundSize = (sheetWidth * scaleX) + 'px ' + (sheetHeight * scaleY) + 'px';
+    overlay.style.backgroundPosition = (-x * scaleX) + 'px ' + (-y * scaleY) + 'px';
+    overlay.style.display = 'block';
+    return true;
+}
+
+function hideSprite() {
+    document.getElementById('sprite_preview').style.display = 'none';
 }
 
 function raceChanged(race) {
     if (race === 'preview') {
         document.getElementById('image').src = '/video_stream';
         selectedRaceName = undefined;
+        stripFrames = [];
+        sprites = undefined;
+        hideSprite();
+        document.getElementById('strip').removeAttribute('src');
+        document.getElementById('crossings').replaceChildren();
+        document.getElementById('finish_time').textContent = '';
         document.getElementById('deleteRaceButton').disabled = true;
     } else {
         document.getElementById('deleteRaceButton').disabled = false;
@@ -22,30 +91,211 @@ function raceChanged(race) {
         document.getElementById('deleteRaceInput').value = race;
         var xhr = new XMLHttpRequest();
         xhr.open('GET', '/image_count?race=' + race, true);
-        xhr.onreadystatechange = function () {
+        xhr.onload = function () {
             if (xhr.status === 200) {
-                // Handle successful response
-                var count = parseInt(xhr.responseText);
-                slider.max = count;
+                var response = JSON.parse(xhr.responseText);
+                frameVersion = response.version;
+                slider.max = response.count;
                 slider.value = 1;
                 slider.focus()
+                document.getElementById('image').src = frameUrl(race, 1);
             } else {
-                // Handle error or other status codes
                 console.error(xhr.status);
             }
         };
         xhr.send();
-        var img = document.getElementById('image');
-        img.src = '/static/race/' + race + '/image_0001.jpg';
+        loadCrossings(race);
+        loadStrip(race);
+        loadSprites(race);
     }
 }
 
+function showsPlaceholder() {
+    const src = document.getElementById('image').src;
+    return src.endsWith('/static/active_race.png') || src.endsWith('/static/ready_for_race.png');
+}
+
+function raceOption(race, number) {
+    // Races recorded since the page was loaded are added to the list without reloading it
+    for (const option of raceSelect.options) {
+        if (option.value === race) {
+            return option;
+        }
+    }
+    const option = document.createElement('option');
+    option.value = race;
+    option.text = 'Race ' + number + ' - ' + race;
+    raceSelect.insertBefore(option, raceSelect.firstChild);
+    return option;
+}
+
+function selectRace(option) {
+    option.selected = true;
+    selectedRaceName = option.text;
+    document.getElementById('deleteRaceInput').value = option.value;
+    document.getElementById('deleteRaceButton').disabled = false;
+}
+
+function showLiveFrames(race, number, count) {
+    const option = raceOption(race, number);
+    if (!option.selected || showsPlaceholder()) {
+        selectRace(option);
+        sprites = undefined;
+        hideSprite();
+        stripFrames = [];
+        document.getElementById('strip').removeAttribute('src');
+        document.getElementById('crossings').replaceChildren();
+        document.getElementById('finish_time').textContent = '';
+        slider.value = 1;
+        // The frames of a race that is recorded are revalidated until it has a version
+        frameVersion = undefined;
+        document.getElementById('image').src = frameUrl(race, 1);
+    }
+    slider.max = count;
+    // The written frames can be looked at while the race is recorded
+    slider.disabled = false;
+    document.getElementById('frame_time').disabled = false;
+    document.getElementById('frame_time_button').disabled = false;
+    document.getElementById('finish_time_button').disabled = false;
+}
+
+function raceFinished(race, number, frameCount) {
+    const option = raceOption(race, number);
+    if (!option.selected || showsPlaceholder()) {
+        selectRace(option);
+        raceChanged(race);
+        return;
+    }
+    // Keep the frame that is shown, only the end of the race and the results are new
+    slider.max = frameCount;
+    loadCrossings(race);
+    loadStrip(race);
+    loadSprites(race);
+}
+
+var stripFrames = [];
+
+function loadStrip(race) {
+    const strip = document.getElementById('strip');
+    stripFrames = [];
+    strip.removeAttribute('src');
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/strip_index?race=' + race, true);
+    xhr.onload = function () {
+        if (xhr.status === 200) {
+            stripFrames = JSON.parse(xhr.responseText).frames;
+            strip.src = '/strip?race=' + race;
+        }
+    };
+    xhr.send();
+}
+
+function stripClicked(event) {
+    const strip = event.target;
+    const column = Math.floor(event.offsetX * strip.naturalWidth / strip.clientWidth);
+    if (column >= 0 && column < stripFrames.length) {
+        slider.value = stripFrames[column];
+        slider.dispatchEvent(new Event('input'));
+        slider.focus()
+    }
+}
+
+function loadCrossings(race) {
+    const container = document.getElementById('crossings');
+    container.replaceChildren();
+    document.getElementById('finish_time').textContent = '';
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/crossings?race=' + race, true);
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            console.error(xhr.status);
+            return;
+        }
+        JSON.parse(xhr.responseText).frames.forEach(function (frame, index) {
+            const button = document.createElement('button');
+            button.textContent = index + 1;
+            button.onclick = function () {
+                slider.value = frame;
+                slider.dispatchEvent(new Event('input'));
+                slider.focus()
+            };
+            container.appendChild(button);
+        });
+    };
+    xhr.send();
+}
+
+function goToTime() {
+    const race = raceSelect.options[raceSelect.selectedIndex].value;
+    const seconds = document.getElementById('frame_time').value;
+    if (race === 'preview' || seconds === '') {
+        return;
+    }
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/frame_at?race=' + race + '&t=' + seconds, true);
+    xhr.onload = function () {
+        if (xhr.status === 200) {
+            var response = JSON.parse(xhr.responseText);
+            slider.value = response.frame;
+            slider.dispatchEvent(new Event('input'));
+            slider.focus()
+        } else {
+            console.error(xhr.status);
+        }
+    };
+    xhr.send();
+}
+
+function findFinishTime() {
+    const race = raceSelect.options[raceSelect.selectedIndex].value;
+    const result = document.getElementById('finish_time');
+    if (race === 'preview') {
+        return;
+    }
+    // The search starts a little before the frame that is shown, where the goal line is still empty
+    const frame = parseInt(slider.value);
+    const first = Math.max(1, frame - 10);
+    const last = Math.min(parseInt(slider.max), frame + 10);
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/finish_time?race=' + race + '&first=' + first + '&last=' + last, true);
+    xhr.onload = function () {
+        if (xhr.status === 200) {
+            var response = JSON.parse(xhr.responseText);
+            result.textContent = response.time.toFixed(4) + ' s ± ' + (response.uncertainty * 1000).toFixed(1) + ' ms';
+            slider.value = response.frame_after;
+            slider.dispatchEvent(new Event('input'));
+            slider.focus()
+        } else {
+            result.textContent = 'Ingen målgång hittades';
+            console.error(xhr.status);
+        }
+    };
+    xhr.send();
+}
+
+function exportRace(format) {
+    const race = raceSelect.options[raceSelect.selectedIndex].value;
+    if (race === 'preview') {
+        return;
+    }
+    // A link with a download attribute does not leave the page
+    const link = document.createElement('a');
+    link.href = '/export?race=' + race + '&format=' + format;
+    link.download = race + '.' + format;
+    link.click();
+}
+
 function startRace() {
     var img = document.getElementById('image');
     img.src = '/static/ready_for_race.png';
     var xhr = new XMLHttpRequest();
     xhr.open('POST', '/start_race', true);
     xhr.setRequestHeader('Content-Type', 'application/json');
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            alert(xhr.responseText);
+        }
+    };
     xhr.send(JSON.stringify({ race: 'start' }));
 }
 
@@ -68,7 +318,6 @@ function removeBeforeUnloadEventListener() {
     window.removeEventListener('beforeunload', beforeUnloadHandler);
 }
 
-const LINE_KEY = 'lineCoordinates';
 document.addEventListener('DOMContentLoaded', function () {
     const urlParams = new URLSearchParams(window.location.search);
     const training = urlParams.get('training');
@@ -132,13 +381,17 @@ document.addEventListener('DOMContentLoaded', function () {
     const ctx = canvas.getContext('2d');
     canvas.addEventListener('click', handleCanvasClick);
 
-    var coordinates = localStorage.getItem(LINE_KEY);
-    if (coordinates) {
-        const ctx = canvas.getContext('2d');
-        const { x1, y1, x2, y2 } = JSON.parse(coordinates);
-        drawRectangle(ctx, x1, y1);
-        drawRectangle(ctx, x2, y2);
-        drawLine(ctx, x1, y1, x2, y2);
+    const goalLine = JSON.parse(canvas.dataset.goalLine);
+    if (goalLine) {
+        const [x1, y1, x2, y2] = goalLine;
+        drawGoalLine(ctx, x1 * canvas.width, y1 * canvas.height, x2 * canvas.width, y2 * canvas.height);
+    }
+    document.getElementById('strip').addEventListener('click', stripClicked);
+    document.getElementById('image').addEventListener('load', hideSprite);
+    if (raceSelect.value !== 'preview') {
+        loadCrossings(raceSelect.value);
+        loadStrip(raceSelect.value);
+        loadSprites(raceSelect.value);
     }
 
     var firstPoint = undefined;
@@ -158,7 +411,12 @@ document.addEventListener('DOMContentLoaded', function () {
         } else {
             drawRectangle(ctx, x, y);
             drawLine(ctx, firstPoint.x, firstPoint.y, x, y);
-            localStorage.setItem(LINE_KEY, JSON.stringify({ x1: firstPoint.x, y1: firstPoint.y, x2: x, y2: y }));
+            saveGoalLine({
+                x1: firstPoint.x / canvasRect.width,
+                y1: firstPoint.y / canvasRect.height,
+                x2: x / canvasRect.width,
+                y2: y / canvasRect.height
+            });
             firstPoint = undefined;
             goalLinePaintingActive = false;
         }
@@ -167,6 +425,24 @@ document.addEventListener('DOMContentLoaded', function () {
 
 });
 
+function saveGoalLine(goalLine) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('POST', '/goal_line', true);
+    xhr.setRequestHeader('Content-Type', 'application/json');
+    xhr.send(JSON.stringify(goalLine));
+}
+
+function clearGoalLine() {
+    clearCanvas();
+    saveGoalLine({});
+}
+
+function drawGoalLine(ctx, x1, y1, x2, y2) {
+    drawRectangle(ctx, x1, y1);
+    drawRectangle(ctx, x2, y2);
+    drawLine(ctx, x1, y1, x2, y2);
+}
+
 function clearCanvas() {
     const canvas = document.getElementById('canvas');
     const ctx = canvas.getContext('2d');
@@ -1,4 +1,5 @@
-var socket = io();
+// Only WebSocket, so every message of a connection reaches the same web worker
+var socket = io({ transports: ['websocket'] });
 
 socket.on('cage', function(data) {
     
@@ -13,20 +14,46 @@ socket.on('race', function(data) {
         document.getElementById('ready_button').disabled = true;
         document.getElementById('race').disabled = true;
         document.getElementById('image_index').disabled = true;
+        document.getElementById('frame_time').disabled = true;
+        document.getElementById('frame_time_button').disabled = true;
+        document.getElementById('finish_time_button').disabled = true;
         document.getElementById('stop_button').disabled = true;
     }
     else if(data === '🟡 Inte redo') {
-        window.removeEventListener('beforeunload', beforeUnloadHandler);
-        window.location = window.location.href
         document.getElementById('ready_button').disabled = false;
         document.getElementById('race').disabled = false;
         document.getElementById('image_index').disabled = false;
+        document.getElementById('frame_time').disabled = false;
+        document.getElementById('frame_time_button').disabled = false;
+        document.getElementById('finish_time_button').disabled = false;
         document.getElementById('stop_button').disabled = true;
+        // Nothing was recorded if the race never started, go back to the selected race
+        if (showsPlaceholder()) {
+            raceChanged(raceSelect.value);
+        }
     }
     else {
         document.getElementById('ready_button').disabled = true;
         document.getElementById('race').disabled = true;
         document.getElementById('image_index').disabled = true;
+        document.getElementById('frame_time').disabled = true;
+        document.getElementById('frame_time_button').disabled = true;
+        document.getElementById('finish_time_button').disabled = true;
         document.getElementById('stop_button').disabled = false;
     }
 })
+
+// The frames written so far of the running race
+socket.on('frames', function(data) {
+    showLiveFrames(data.race, data.number, data.count);
+})
+
+socket.on('race_finished', function(data) {
+    raceFinished(data.race, data.number, data.frame_count);
+})
+
+socket.on('sprites', function(race) {
+    if (raceSelect.value === race) {
+        loadSprites(race);
+    }
+})
@@ -0,0 +1,233 @@
+"""
+This module contains the storage manager that keeps the recorded races within a disk budget.
+"""
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from eliot import start_action
+from sqlalchemy import func
+
+from app import background, catalog, db, metrics, models
+from app.constants import (FRAME_RING_BUFFER_SECONDS,
+                           STORAGE_BANDWIDTH_MARGIN,
+                           STORAGE_BANDWIDTH_TEST_SIZE, STORAGE_BUDGET,
+                           STORAGE_DEFAULT_BYTE_RATE, STORAGE_ESTIMATE_MARGIN,
+                           STORAGE_MIN_FREE)
+from app.framestore import forget_reader
+
+
+def empty_trash(trash):
+    """
+    Remove everything in the trash directory.
+    This is run in a background process.
+
+    Args:
+        trash (str): The trash directory.
+    """
+    for name in os.listdir(trash):
+        shutil.rmtree(os.path.join(trash, name), ignore_errors=True)
+
+
+class StorageManager:
+    """
+    Keeps the races within a disk budget and leaves room on the disk for the next race.
+
+    Races are deleted by moving their directory to a trash directory on the same file
+    system, which is instant, and the trash is emptied by the background process pool.
+    When a new race needs room, the oldest races are deleted first.
+    """
+
+    def __init__(self, race_base, trash, budget=STORAGE_BUDGET, min_free=STORAGE_MIN_FREE):
+        """
+        Args:
+            race_base (str): The directory with one directory per race.
+            trash (str): The trash directory, it must be on the same file system as the races.
+            budget (int): The most bytes the races may use, or None for no limit.
+            min_free (int): The fewest bytes to leave free on the disk.
+        """
+        self.race_base = race_base
+        self.trash = trash
+        self.budget = budget
+        self.min_free = min_free
+        # Bytes in the trash that are not yet free on the disk
+        self._pending = 0
+        self._lock = threading.Lock()
+        # Bytes per second the disk can write, None until it has been measured
+        self.bandwidth = None
+        os.makedirs(race_base, exist_ok=True)
+        os.makedirs(trash, exist_ok=True)
+        # Races that were deleted just before a restart
+        self._empty_trash(0)
+
+    def _empty_trash(self, size):
+        future = background.submit("empty_trash", empty_trash, self.trash)
+
+        def done(_):
+            with self._lock:
+                self._pending -= size
+
+        future.add_done_callback(done)
+
+    def _move_to_trash(self, directory, size):
+        if not os.path.exists(directory):
+            return
+        forget_reader(directory)
+        os.rename(directory, os.path.join(self.trash, uuid.uuid4().hex))
+        with self._lock:
+            self._pending += size
+        self._empty_trash(size)
+
+    def used(self):
+        """
+        Get the number of bytes used by the catalogued races.
+        """
+        return db.session.query(func.coalesce(func.sum(models.Race.byte_size), 0)).scalar()
+
+    def free(self):
+        """
+        Get the number of bytes that are free on the disk, counting the trash as free.
+        """
+        with self._lock:
+            pending = self._pending
+        return shutil.disk_usage(self.race_base).free + pending
+
+    def race_estimate(self, config):
+        """
+        Estimate the size of the next race from the byte rate of the earlier races.
+
+        Args:
+            config: The configuration with the recording window.
+
+        Returns:
+            The estimated size in bytes.
+        """
+        size, duration = db.session.query(
+            func.sum(models.Race.byte_size), func.sum(models.Race.duration)
+        ).filter(models.Race.duration > 0).one()
+        byte_rate = size / duration if duration else STORAGE_DEFAULT_BYTE_RATE
+        seconds = int(config.stop_filming_after) - int(config.start_filming_after)
+        seconds = max(seconds, 0) + FRAME_RING_BUFFER_SECONDS
+        return int(byte_rate * seconds * STORAGE_ESTIMATE_MARGIN)
+
+    def measure_bandwidth(self, size=STORAGE_BANDWIDTH_TEST_SIZE):
+        """
+        Measure how fast the disk of the races writes, by writing a file in large chunks
+        and syncing it like the frame writer does. The file is written in the trash directory
+        so nothing else sees it.
+
+        Args:
+            size (int): The number of bytes to write.
+
+        Returns:
+            The bandwidth in bytes per second.
+        """
+        path = os.path.join(self.trash, f"bandwidth-{uuid.uuid4().hex}")
+        # Random bytes so a compressing file system can not make the disk look faster
+        chunk = os.urandom(1024 * 1024)
+        with start_action(action_type="measure_disk_bandwidth", size=size) as action:
+            started = time.perf_counter()
+            try:
+                with open(path, "wb") as file:
+                    for _ in range(max(size // len(chunk), 1)):
+                        file.write(chunk)
+                    file.flush()
+                    os.fsync(file.fileno())
+                elapsed = time.perf_counter() - started
+            finally:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.bandwidth = max(size // len(chunk), 1) * len(chunk) / elapsed
+            metrics.disk_bandwidth.set(self.bandwidth)
+            action.add_success_fields(bytes_per_second=int(self.bandwidth))
+        return self.bandwidth
+
+    def use_bandwidth(self, bandwidth):
+        """
+        Use a bandwidth that was measured before instead of measuring the disk again.
+
+        Args:
+            bandwidth (float): Bytes per second.
+        """
+        self.bandwidth = bandwidth
+        metrics.disk_bandwidth.set(bandwidth)
+
+    def fast_enough(self, byte_rate):
+        """
+        Check if the disk can keep up with frames written at a rate.
+        The answer is yes until the disk has been measured.
+
+        Args:
+            byte_rate (float): Bytes per second.
+        """
+        return self.bandwidth is None or byte_rate <= self.bandwidth * STORAGE_BANDWIDTH_MARGIN
+
+    def ensure_space(self, needed):
+        """
+        Delete the oldest races until there is room for a new race.
+
+        Args:
+            needed (int): The number of bytes the new race needs.
+
+        Returns:
+            True if there is room for the race.
+        """
+        with start_action(action_type="ensure_space", needed=needed) as action:
+            used = self.used()
+            free = self.free()
+            oldest = models.Race.query.filter_by(running=False).order_by(models.Race.start_time).all()
+            evictable = sum(race.byte_size or 0 for race in oldest)
+            if not self._fits(used - evictable, free + evictable, needed):
+                # Deleting every race would not be enough, so keep them
+                action.add_success_fields(used=used, free=free, enough=False)
+                return False
+            for race in oldest:
+                if self._fits(used, free, needed):
+                    break
+                action.log(message_type="evict_race", race=race.start_time)
+                size = race.byte_size or 0
+                self.delete_race(race.start_time)
+                used -= size
+                free += size
+            action.add_success_fields(used=used, free=free, enough=True)
+            return True
+
+    def _fits(self, used, free, needed):
+        within_budget = self.budget is None or used + needed <= self.budget
+        return within_budget and free - needed >= self.min_free
+
+    def delete_race(self, race):
+        """
+        Delete a race and its frames. The frames are removed in the background.
+
+        Args:
+            race (str): The name of the race.
+        """
+        with start_action(action_type="delete_race", race=race):
+            row = models.Race.query.filter_by(start_time=race).first()
+            size = 0
+            if row is not None:
+                size = row.byte_size or 0
+                db.session.delete(row)
+                db.session.commit()
+            catalog.invalidate()
+            self._move_to_trash(os.path.join(self.race_base, race), size)
+
+    def delete_all(self):
+        """
+        Delete every race and its frames. The frames are removed in the background.
+        """
+        with start_action(action_type="delete_all_races"):
+            size = self.used()
+            models.Race.query.delete()
+            db.session.commit()
+            catalog.invalidate()
+            # Readers of every race have to go since the directories move
+            for name in os.listdir(self.race_base):
+                forget_reader(os.path.join(self.race_base, name))
+            self._move_to_trash(self.race_base, size)
+            os.makedirs(self.race_base)
@@ -0,0 +1,108 @@
+"""
+This module contains the generation of downscaled frames packed into sprite sheets,
+used by the viewer to scrub through a race without loading every full size frame.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from app.constants import (SPRITE_COLUMNS, SPRITE_FILE, SPRITE_FRAMES_PER_SHEET,
+                           SPRITE_INDEX_FILE, SPRITE_QUALITY, THUMBNAIL_SCALE)
+from app.framestore import open_reader
+
+_REDUCED_READ_MODES = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def load_sprite_index(directory):
+    """
+    Get the sprite sheet index of a race.
+
+    Args:
+        directory (str): The race directory.
+
+    Returns:
+        The index as a dict, or None if the sprites have not been built.
+    """
+    try:
+        with open(os.path.join(directory, SPRITE_INDEX_FILE)) as index:
+            return json.load(index)
+    except FileNotFoundError:
+        return None
+
+
+def thumbnail(frame, scale=THUMBNAIL_SCALE):
+    """
+    Decode a frame at a reduced size.
+    The JPEG decoder skips the detail that is not needed, which is much faster than
+    decoding the full frame and resizing it.
+
+    Args:
+        frame: The encoded bytes of the frame.
+        scale (int): How many times smaller the thumbnail is, 2, 4 or 8.
+    """
+    return cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), _REDUCED_READ_MODES[scale])
+
+
+def build_sprites(directory):
+    """
+    Write the sprite sheets of a race and an index with the position of every frame.
+    This is run in a background process after the race.
+
+    Args:
+        directory (str): The race directory with the frame store.
+
+    Returns:
+        The number of frames in the sprite sheets.
+    """
+    reader = open_reader(directory)
+    if reader is None or len(reader) == 0:
+        return 0
+    first_stored = reader.stored_frame(1)
+    if first_stored is None:
+        return 0
+    first = thumbnail(reader.frame(first_stored))
+    tile_height, tile_width = first.shape[:2]
+    count = len(reader)
+    offsets = []
+    sheet_sizes = []
+    image = first
+    for sheet_number, start in enumerate(range(0, count, SPRITE_FRAMES_PER_SHEET)):
+        frames = min(SPRITE_FRAMES_PER_SHEET, count - start)
+        columns = min(SPRITE_COLUMNS, frames)
+        rows = -(-frames // SPRITE_COLUMNS)
+        sheet = np.zeros((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+        for position in range(frames):
+            x = position % SPRITE_COLUMNS * tile_width
+            y = position // SPRITE_COLUMNS * tile_height
+            frame = reader.frame(start + position + 1)
+            if frame is not None:
+                decoded = thumbnail(frame)
+                if decoded is not None and decoded.shape == first.shape:
+                    image = decoded
+            # Frames skipped by the motion gate repeat the stored frame before them
+            sheet[y : y + tile_height, x : x + tile_width] = image
+            offsets.append((sheet_number, x, y))
+        cv2.imwrite(
+            os.path.join(directory, SPRITE_FILE.format(sheet_number)),
+            sheet,
+            [cv2.IMWRITE_JPEG_QUALITY, SPRITE_QUALITY],
+        )
+        sheet_sizes.append((sheet.shape[1], sheet.shape[0]))
+    # The index is written last, so its existence means the sheets are complete
+    with open(os.path.join(directory, SPRITE_INDEX_FILE), "w") as index:
+        json.dump(
+            {
+                "tile": (tile_width, tile_height),
+                "sheets": [SPRITE_FILE.format(number) for number in range(len(sheet_sizes))],
+                "sheet_sizes": sheet_sizes,
+                "offsets": offsets,
+            },
+            index,
+        )
+    return count
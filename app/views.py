@@ -3,64 +3,58 @@ This module contains the views for the Flask application.
 """
 
 import fnmatch
+import math
 import os
-import shutil
-import time
+import threading
 
 import flask_socketio
-import lgpio
-from flask import render_template, request, send_file, url_for, Response
-from sqlalchemy import desc
+from flask import (Response, abort, jsonify, render_template, request,
+                   send_file, send_from_directory, url_for)
+from eliot import start_action
 
-from eliot import start_action, Action
-
-from app import app, camera, db, handle, models, socketio
-from app.constants import (BUTTON_PIN, RACE_DIRECTORY_BASE, STATIC_DIRECTORY,
+from app import app, capture, catalog, db, export, models, socketio
+from app.constants import (CAPTURE_PROFILES, EXPORT_MAX_CONCURRENT,
+                           EXPORT_RETRY_AFTER, FINISH_TIME_MAX_FRAMES,
+                           FRAME_ACCEL_LOCATION, FRAME_CACHE_CONTROL,
+                           FRAME_INDEX_FILE, FRAME_REVALIDATE_CACHE_CONTROL,
+                           PREVIEW_MAX_FPS,
+                           RACE_DIRECTORY_BASE, STATIC_DIRECTORY, STRIP_FILE,
                            WEBSOCKET_ROOM)
+from app.finishline import cached_finish_time, load_crossings
+from app.framestore import open_reader
+from app.ipc import CaptureError, CaptureUnavailable
+from app.slitscan import load_strip_index
+
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
 
 
-def update_cage_status(_, __, level, race_start_time):
+def relay_event(event, data):
     """
-    Update the status of the cage based on the button state.
-    If the button is pressed, the cage is considered closed.
-    If the button is not pressed, the cage is considered open.
+    Hand an event of the capture daemon to the browsers connected to this worker.
+    The race list is cached per worker, so it is forgotten whenever the races may have changed.
     """
-    button_state = level
-    if not button_state:
-        # Cage is closed
-        with app.test_request_context("/"):
-            flask_socketio.emit("cage", "🟢 Stängd", namespace="/", room=WEBSOCKET_ROOM)
-    else:
-        with app.test_request_context("/"):
-            flask_socketio.emit("cage", "🟡 Öppen", namespace="/", room=WEBSOCKET_ROOM)
-        with app.app_context():
-            current_race = models.Race.query.filter_by(running=True).first()
-            if current_race is not None:
-                with Action.continue_task(task_id=current_race.eliot_task_id, action_type="update_cage_status") as action:
-                    config = models.Config.query.first()
-                    current_race.started = True
-                    db.session.commit()
-                    socketio.emit("race", "🔴 Pågår", namespace="/", room=WEBSOCKET_ROOM)
-                    camera.start_film(
-                        current_race,
-                        race_start_time,
-                        config.start_filming_after,
-                        config.stop_filming_after,
-                        stop_race_actions,
-                    )
+    if event in ("connected", "race", "race_finished", "catalog"):
+        catalog.invalidate()
+    if event not in ("connected", "catalog"):
+        socketio.emit(event, data, namespace="/", room=WEBSOCKET_ROOM)
+
+
+@app.before_request
+def start_relay():
+    """
+    Start relaying the events of the capture daemon the first time this worker handles a request.
+    """
+    capture.start_relay(relay_event)
 
 
 def cage_status():
     """
-    Get the status of the cage.
-    If the button is pressed, the cage is considered closed.
-    If the button is not pressed, the cage is considered open.
+    Get the status of the cage from the capture daemon.
     """
-    button_state = lgpio.gpio_read(handle, BUTTON_PIN)
-    if not button_state:
-        return "🟢 Stängd"
-    else:
-        return "🟡 Öppen"
+    try:
+        return capture.call("cage_status")
+    except CaptureUnavailable:
+        return "⚪ Okänd"
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -73,30 +67,38 @@ def index():
         raceNameToDelete = request.form.get("deleteRace")
         if bool(request.form.get("reset_everything")):
             start_action(action_type="reset")
+            # The races go first, the daemon refuses while a race is running
+            body, status = capture.call("delete_all_races")
+            if status != 200:
+                return body, status
+            catalog.invalidate()
             db.session.delete(config)
-            models.Race.query.delete()
             db.session.commit()
             db.session.add(models.Config())
             db.session.commit()
-            shutil.rmtree(STATIC_DIRECTORY + RACE_DIRECTORY_BASE)
-            os.makedirs(STATIC_DIRECTORY + RACE_DIRECTORY_BASE)
         if raceNameToDelete is not None:
             if raceNameToDelete != "undefined":
-                models.Race.query.filter_by(start_time=raceNameToDelete).delete()
-                db.session.commit()
+                # Responds with 404 Not Found for names outside of the race directories
+                race_directory(raceNameToDelete)
+                body, status = capture.call("delete_race", race=raceNameToDelete)
+                if status != 200:
+                    return body, status
+                catalog.invalidate()
         else:
             start_action(action_type="update_config")
             config.flip_image = bool(request.form.get("flip_image"))
+            config.motion_gate = bool(request.form.get("motion_gate"))
+            config.archive_reencode = bool(request.form.get("archive_reencode"))
+            if request.form.get("capture_profile") in capture_profiles(config):
+                config.capture_profile = request.form.get("capture_profile")
             config.start_filming_after = request.form.get("start_filming_after")
             config.stop_filming_after = request.form.get("stop_filming_after")
             db.session.commit()
-        camera.flip_image(config.flip_image)
+        capture.call("config_changed")
 
     race_status = "🟡 Inte redo"
-    races = (
-        models.Race.query.filter_by(running=False, started=True)
-        .order_by(desc(models.Race.start_time))
-        .all()
+    races, page, page_count, _ = catalog.race_page(
+        request.args.get("page", 1, type=int), race_directory
     )
     image_count_max = 1
     start_race_button_disabled = False
@@ -112,11 +114,12 @@ def index():
             start_race_button_disabled = True
             stop_race_button_disabled = False
     else:
-        if races is not None and len(races) > 0:
-            image_count_max = image_count(races[0].start_time)
+        if len(races) > 0:
+            image_count_max = races[0]["frame_count"]
             image_src = url_for(
                 "static",
-                filename=RACE_DIRECTORY_BASE + races[0].start_time + "/image_0001.jpg",
+                filename=RACE_DIRECTORY_BASE + races[0]["start_time"] + "/image_0001.jpg",
+                v=frame_version(races[0]["start_time"]),
             )
         else:
             image_src = url_for("video_stream")
@@ -124,14 +127,21 @@ def index():
         "index.html",
         cage_status=cage_status(),
         flip_image=config.flip_image,
+        motion_gate=config.motion_gate,
+        archive_reencode=config.archive_reencode,
+        capture_profiles=capture_profiles(config),
+        capture_profile=config.capture_profile,
         max=image_count_max,
         image_src=image_src,
         race_status=race_status,
         races=races,
+        page=page,
+        page_count=page_count,
         start_filming_after=config.start_filming_after,
         stop_filming_after=config.stop_filming_after,
         start_race_button_disabled=start_race_button_disabled,
-        stop_race_button_disabled=stop_race_button_disabled
+        stop_race_button_disabled=stop_race_button_disabled,
+        goal_line=config.goal_line(),
     )
 
 
@@ -140,32 +150,8 @@ def start_race():
     """
     Start a new race.
     """
-    current_race = models.Race.query.filter_by(running=True).first()
-    if current_race is not None:
-        with start_action(action_type="start_race") as action:
-            action.log(message_type="warn", message="Race is already running")
-    else:
-        with start_action(action_type="start_race") as action:
-            current_race = models.Race()
-            current_race.start_time = time.strftime("%Y%m%d-%H%M%S")
-            current_race.running = True
-            current_race.eliot_task_id = action.serialize_task_id()
-
-            db.session.add(current_race)
-            db.session.commit()
-            #Make sure the camera is not filming
-            camera.stop_film()
-            # Start the camera to warm it up
-            camera.start_camera()
-
-            if current_race.started:
-                action.log(message_type="debug", message="Race started")
-                race_status = "🔴 Pågår"
-            else:
-                action.log(message_type="debug", message="Race ready to start")
-                race_status = "🟢 Redo för start"
-            flask_socketio.emit("race", race_status, namespace="/", room=WEBSOCKET_ROOM)
-    return "OK"
+    body, status = capture.call("start_race")
+    return body, status
 
 
 @app.route("/stop_race", methods=["POST"])
@@ -173,61 +159,373 @@ def stop_race():
     """
     Stop the current race.
     """
-    with start_action(action_type="stop_race") as action:
-        current_race = models.Race.query.filter_by(running=True).first()
-        if current_race is None:
-            action.log(message_type="warn", message="No race is running")
-        else:
-            action.log(message_type="warn", message="Stopping race early")
-            stop_race_actions(current_race)
-    return "OK"
+    return capture.call("stop_race")
 
 
-def stop_race_actions(current_race):
+def capture_profiles(config):
+    """
+    Get the names of the capture profiles with a description to show for each.
     """
-    Stops recording, update the race in database, informs liteners and remove the timestamp callback.
+    profiles = {"standard": f"Standard ({config.frames_per_second} bilder/s)"}
+    for name, profile in CAPTURE_PROFILES.items():
+        profiles[name] = f"{profile['label']} ({profile['frames_per_second']} bilder/s)"
+    return profiles
 
-    Args:
-        current_race: The current race object.
+
+def race_directory(race):
     """
-    with start_action(action_type="stop_race_actions") as action:
-        camera.stop_film()
-        current_race.running = False
-        db.session.commit()
-        flask_socketio.emit("race", "🟡 Inte redo", namespace="/", room=WEBSOCKET_ROOM)
+    Get the directory of the specified race.
+    Responds with 404 Not Found if the race name could point outside of the race directories.
+    """
+    if not race or race.startswith(".") or "/" in race:
+        abort(404)
+    return STATIC_DIRECTORY + RACE_DIRECTORY_BASE + race
 
 
 def image_count(race):
     """
     Get the number of images in the specified race directory.
     """
-    return len(
-        fnmatch.filter(
-            os.listdir(STATIC_DIRECTORY + RACE_DIRECTORY_BASE + race), "image*.jpg"
-        )
-    )
+    count = catalog.frame_count(race)
+    if count is not None:
+        return count
+    reader = open_reader(race_directory(race))
+    if reader is not None:
+        reader.refresh()
+        return len(reader)
+    # Races recorded before the frame store was introduced have one file per frame
+    return len(fnmatch.filter(os.listdir(race_directory(race)), "image*.jpg"))
+
+
+def frame_version(race):
+    """
+    Get the version of the frames of a race to put in their URLs, so the URLs change
+    when the frame store of the race is replaced.
+
+    Returns:
+        The generation of the frame store in hex, or None for a race recorded with one
+        file per frame, those files are never changed.
+    """
+    reader = open_reader(race_directory(race))
+    if reader is None:
+        return None
+    reader.refresh()
+    return f"{reader.generation:x}"
+
+
+@app.route("/static/race/<race>/image_<int:frame_num>.jpg")
+def race_frame(race, frame_num):
+    """
+    Serve a single frame of a race.
+    A frame URL with the version of its frame store never changes and is cached as immutable.
+    Archiving can re-encode the frames into a new store, so other URLs are revalidated
+    with a strong ETag. Range requests are supported.
+    """
+    directory = race_directory(race)
+    reader = open_reader(directory)
+    if reader is not None:
+        frame = reader.open_frame(frame_num)
+        if frame is None:
+            # A frame skipped by the motion gate shows the stored frame closest before it
+            shown = reader.stored_frame(frame_num)
+            if shown is not None and shown != frame_num:
+                frame = reader.open_frame(shown)
+        if frame is None:
+            abort(404)
+        file, offset, length = frame
+        # The segment is a new file after the race is archived
+        segment = os.fstat(file.fileno()).st_ino
+        etag = f"{race}-{frame_num}-{segment:x}-{offset:x}-{length:x}"
+        if request.args.get("v") == f"{segment:x}":
+            return send_frame(file, length, etag)
+        return send_frame(file, length, etag, FRAME_REVALIDATE_CACHE_CONTROL)
+
+    # Races recorded before the frame store was introduced have one file per frame
+    name = f"image_{frame_num:04d}.jpg"
+    path = os.path.join(directory, name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        abort(404)
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    if request.headers.get("X-Sendfile-Type") == "X-Accel-Redirect":
+        # nginx sends the file itself, including range and conditional requests
+        response = Response(mimetype="image/jpeg")
+        response.headers["X-Accel-Redirect"] = f"{FRAME_ACCEL_LOCATION}{race}/{name}"
+        response.headers["Cache-Control"] = FRAME_CACHE_CONTROL
+        return response
+    return send_frame(open(path, "rb"), stat.st_size, etag)
+
+
+def send_frame(file, length, etag, cache_control=FRAME_CACHE_CONTROL):
+    """
+    Respond with a part of a file without reading it in Python.
+    gunicorn sends the file with sendfile, starting at the current position of the
+    file and stopping after the Content-Length.
+
+    Args:
+        file: The file with the frame, positioned at the start of the frame.
+        length (int): The length of the frame.
+        etag (str): The entity tag of the frame.
+        cache_control (str): The Cache-Control header of the response.
+    """
+    response = Response(mimetype="image/jpeg")
+    response.headers["Cache-Control"] = cache_control
+    response.accept_ranges = "bytes"
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        file.close()
+        response.status_code = 304
+        return response
+    start, stop = 0, length
+    if request.range is not None and (
+        request.if_range.etag is None or request.if_range.etag == etag
+    ):
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            file.close()
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{length}"
+            return response
+        start, stop = byte_range
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+    response.content_length = stop - start
+    if request.method == "HEAD":
+        file.close()
+        return response
+    file.seek(start, os.SEEK_CUR)
+    if "wsgi.file_wrapper" in request.environ:
+        response.response = request.environ["wsgi.file_wrapper"](file)
+    else:
+        response.response = _read_range(file, stop - start)
+    # Keep werkzeug from wrapping the file so the server can recognise it
+    response.direct_passthrough = True
+    return response
+
+
+def _read_range(file, length):
+    with file:
+        while length > 0:
+            chunk = file.read(min(length, 64 * 1024))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@app.route("/export")
+def export_race():
+    """
+    Download a race as a Motion JPEG AVI or as a ZIP file of its frames and their timestamps.
+    The file is built from the frame store while it is sent, so nothing is written to the disk,
+    and range requests are supported so a broken download can be resumed.
+    """
+    race = request.args.get("race")
+    directory = race_directory(race)
+    kind = request.args.get("format", "avi")
+    if kind not in ("avi", "zip"):
+        return "Invalid format", 400
+    reader = open_reader(directory)
+    if reader is None:
+        abort(404)
+    if not export_slots.acquire(blocking=False):
+        response = Response("Too many exports, try again later", status=503)
+        response.headers["Retry-After"] = str(EXPORT_RETRY_AFTER)
+        return response
+    try:
+        index = os.stat(os.path.join(directory, FRAME_INDEX_FILE))
+        exported = export.avi(reader) if kind == "avi" else export.zip_archive(reader, race)
+    except (FileNotFoundError, ValueError) as e:
+        export_slots.release()
+        return str(e), 404 if isinstance(e, FileNotFoundError) else 413
+    except export.RaceChanged:
+        export_slots.release()
+        return "The race changed, try again", 409
+    if exported is None:
+        export_slots.release()
+        abort(404)
+
+    response = Response(mimetype="video/x-msvideo" if kind == "avi" else "application/zip")
+    response.call_on_close(export_slots.release)
+    response.headers["Content-Disposition"] = f'attachment; filename="{race}.{kind}"'
+    response.accept_ranges = "bytes"
+    etag = f"{race}-{kind}-{index.st_ino:x}-{index.st_size:x}-{index.st_mtime_ns:x}"
+    response.set_etag(etag)
+    start, stop = 0, exported.size
+    if request.range is not None and (
+        request.if_range.etag is None or request.if_range.etag == etag
+    ):
+        byte_range = request.range.range_for_length(exported.size)
+        if byte_range is None:
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{exported.size}"
+            return response
+        start, stop = byte_range
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{exported.size}"
+    response.content_length = stop - start
+    if request.method != "HEAD":
+        response.response = _send_export(exported, start, stop, race)
+    return response
+
+
+def _send_export(exported, start, stop, race):
+    try:
+        yield from exported.stream(start, stop)
+    except export.RaceChanged:
+        # The client sees a short download and the new ETag when it resumes
+        with start_action(action_type="export_race", race=race) as action:
+            action.log(message_type="warn", message="Race changed during export")
 
 
 @app.route("/image_count")
 def get_image_count():
     """
-    Get the number of images in a race directory.
+    Get the number of images in a race directory and the version to put in their URLs.
+    """
+    race = request.args.get("race")
+    return jsonify(count=image_count(race), version=frame_version(race))
+
+@app.route("/frame_at")
+def frame_at():
+    """
+    Get the frame of a race closest to a time in seconds after the race start.
+    """
+    try:
+        seconds = float(request.args.get("t"))
+    except (TypeError, ValueError):
+        return "Invalid time", 400
+    if not math.isfinite(seconds):
+        return "Invalid time", 400
+    reader = open_reader(race_directory(request.args.get("race")))
+    if reader is None:
+        abort(404)
+    reader.refresh()
+    timestamps = reader.timestamps
+    if len(timestamps) == 0:
+        abort(404)
+    # Clamped to the race before it is converted, a time far outside it would overflow
+    seconds = min(max(seconds, int(timestamps[0]) / 1e9), int(timestamps[-1]) / 1e9)
+    frame_num = reader.nearest_frame(round(seconds * 1e9))
+    if frame_num is None:
+        abort(404)
+    return jsonify(
+        frame=frame_num, time=int(reader.timestamps[frame_num - 1]) / 1e9
+    )
+
+@app.route("/goal_line", methods=["POST"])
+def goal_line():
+    """
+    Save the goal line, given as fractions of the image size, or clear it.
+    """
+    with start_action(action_type="update_goal_line"):
+        data = request.get_json(silent=True) or {}
+        keys = ("x1", "y1", "x2", "y2")
+        if all(data.get(key) is None for key in keys):
+            values = (None, None, None, None)
+        else:
+            try:
+                values = tuple(float(data[key]) for key in keys)
+            except (KeyError, TypeError, ValueError):
+                return "Invalid goal line", 400
+            if not all(0 <= value <= 1 for value in values):
+                return "Invalid goal line", 400
+        config = models.Config.query.first()
+        config.goal_line_x1, config.goal_line_y1, config.goal_line_x2, config.goal_line_y2 = values
+        db.session.commit()
+    try:
+        capture.call("config_changed")
+    except CaptureUnavailable:
+        # The daemon reads the configuration when it starts
+        pass
+    return "OK"
+
+
+@app.route("/crossings")
+def crossings():
+    """
+    Get the frames where something crossed the goal line in a race.
     """
-    return str(image_count(request.args.get("race")))
+    directory = race_directory(request.args.get("race"))
+    if not os.path.isdir(directory):
+        abort(404)
+    return jsonify(load_crossings(directory))
+
+@app.route("/finish_time")
+def get_finish_time():
+    """
+    Get the instant something first reaches the goal line between two frames of a race,
+    interpolated between the frames. The first frame has to show the empty line.
+    The goal line can be given as x1, y1, x2, y2, otherwise the saved goal line is used.
+    """
+    first = request.args.get("first", type=int)
+    last = request.args.get("last", type=int)
+    if first is None or last is None or not 1 <= first < last < first + FINISH_TIME_MAX_FRAMES:
+        return "Invalid frame range", 400
+    keys = ("x1", "y1", "x2", "y2")
+    if any(key in request.args for key in keys):
+        try:
+            line = tuple(float(request.args[key]) for key in keys)
+        except (KeyError, ValueError):
+            return "Invalid goal line", 400
+        if not all(0 <= value <= 1 for value in line):
+            return "Invalid goal line", 400
+    else:
+        line = models.Config.query.first().goal_line()
+        if line is None:
+            return "No goal line", 400
+    directory = race_directory(request.args.get("race"))
+    if open_reader(directory) is None:
+        abort(404)
+    result = cached_finish_time(directory, line, first, last)
+    if result is None:
+        return "Nothing reaches the goal line", 404
+    return jsonify(result)
+
+@app.route("/strip")
+def strip():
+    """
+    Get the photo finish strip of a race.
+    """
+    directory = race_directory(request.args.get("race"))
+    return send_from_directory(os.path.abspath(directory), STRIP_FILE, max_age=0)
+
+
+@app.route("/strip_index")
+def strip_index():
+    """
+    Get the frame number and timestamp of every column of the photo finish strip of a race.
+    """
+    index = load_strip_index(race_directory(request.args.get("race")))
+    if index is None:
+        abort(404)
+    return jsonify(index)
 
 @app.route("/video_stream")
 def video_stream():
     """
     Stream video from the camera.
     """
-    
+    max_fps = min(request.args.get("fps", PREVIEW_MAX_FPS, type=float), PREVIEW_MAX_FPS)
+    # Written so NaN is rejected too, min() passes it through
+    if not max_fps > 0:
+        return "Invalid frame rate", 400
+
     def generate():
-        for frame in camera.get_video_stream():
+        for frame in capture.preview_frames(max_fps):
             yield (b'--frame\r\n'
                    b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-    
+
     return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route("/metrics")
+def pipeline_metrics():
+    """
+    Get the metrics of the capture pipeline in the Prometheus text format.
+    """
+    return Response(capture.call("metrics"), mimetype="text/plain; version=0.0.4")
+
 @app.route("/reload")
 def reload():
     """
@@ -256,6 +554,15 @@ def websocket_disconnect():
     flask_socketio.leave_room(WEBSOCKET_ROOM)
 
 
+@app.errorhandler(CaptureError)
+def capture_error(error):
+    """
+    Handle a capture daemon that is not running or could not run a command.
+    """
+    start_action(action_type="capture_error", error=str(error))
+    return "Kameran svarar inte", 503
+
+
 @app.errorhandler(404)
 def not_found(_):
     """
@@ -0,0 +1,213 @@
+"""
+This module contains the asynchronous writer that moves frames from the camera to the disk.
+"""
+import queue
+import threading
+import time
+
+from eliot import Action
+
+from app import metrics
+from app.constants import (FRAME_WRITER_BATCH, FRAME_WRITER_FSYNC,
+                           FRAME_WRITER_OVERFLOW, FRAME_WRITER_QUEUE_SIZE,
+                           FRAME_WRITER_THREADS)
+
+_STOP = object()
+
+
+class AsyncFrameWriter:
+    """
+    Writes frames to a frame store from background threads.
+
+    Frames are put in a bounded queue by the encoder thread and written in batches
+    by one or more writer threads, so latency spikes on the disk do not reach the camera.
+    If a write fails, e.g. when the disk is full, the error is kept and the frames
+    that follow are dropped, so the queue keeps moving and the recording can be stopped.
+    """
+
+    def __init__(
+        self,
+        store,
+        task_id=None,
+        queue_size=FRAME_WRITER_QUEUE_SIZE,
+        threads=FRAME_WRITER_THREADS,
+        overflow=FRAME_WRITER_OVERFLOW,
+        fsync=FRAME_WRITER_FSYNC,
+        batch_size=FRAME_WRITER_BATCH,
+    ):
+        """
+        Starts the writer threads.
+
+        Args:
+            store: The FrameStoreWriter to write the frames to.
+            task_id (str): Serialized eliot task id to log the writer statistics under.
+            queue_size (int): The maximum number of frames waiting to be written.
+            threads (int): The number of writer threads.
+            overflow (str): What to do when the queue is full,
+                "block" waits for room and "drop" drops the frame and counts it.
+            fsync (str): When to flush the frames to the disk,
+                "batch" after every batch, "close" when the writer is closed or "never".
+            batch_size (int): The maximum number of frames written with one system call.
+        """
+        if overflow not in ("block", "drop"):
+            raise ValueError(f"Unknown overflow behaviour: {overflow}")
+        if fsync not in ("batch", "close", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.store = store
+        self.overflow = overflow
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.high_water = 0
+        # The first exception from the store, no frames are written after it
+        self.error = None
+        self._queue = queue.Queue(queue_size)
+        self._take_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._action = None
+        if task_id is not None:
+            self._action = Action.continue_task(task_id=task_id, action_type="frame_writer")
+        self._threads = [
+            threading.Thread(target=self._run, name=f"frame-writer-{i}", daemon=True)
+            for i in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, buf, timestamp):
+        """
+        Queue a frame for writing.
+
+        Args:
+            buf: The encoded bytes of the frame.
+            timestamp (int): The sensor timestamp of the frame in nanoseconds,
+                relative to the race start time.
+
+        Returns:
+            False if the frame was dropped because the queue was full.
+        """
+        item = (buf, timestamp, time.monotonic_ns())
+        if self.overflow == "block":
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                if self._drop(1) and self._action is not None:
+                    self._action.log(message_type="warn", message="Frame queue full, dropping frames")
+                return False
+        self.submitted += 1
+        depth = self._queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def _take_batch(self):
+        """
+        Take the next batch of frames from the queue and reserve room for it in the store.
+        Both happen under one lock so frames keep their order with several writer threads.
+        """
+        with self._take_lock:
+            item = self._queue.get()
+            if item is _STOP:
+                return None
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    # Leave the stop marker for the next thread
+                    self._queue.put(_STOP)
+                    break
+                batch.append(item)
+            if self.error is not None:
+                # The store has failed, the frames get no place in it
+                return None, None, batch
+            first_frame, offset = self.store.reserve([len(buf) for buf, _, _ in batch])
+        return first_frame, offset, batch
+
+    def _run(self):
+        while True:
+            taken = self._take_batch()
+            if taken is None:
+                # Let the other threads see the stop marker too
+                self._queue.put(_STOP)
+                return
+            first_frame, offset, batch = taken
+            if first_frame is None:
+                self._drop(len(batch))
+                continue
+            try:
+                self.store.write(first_frame, offset, [(buf, timestamp) for buf, timestamp, _ in batch])
+                if self.fsync == "batch":
+                    self.store.sync()
+            except Exception as e:
+                self._fail(e)
+                self._drop(len(batch))
+                continue
+            written = time.monotonic_ns()
+            for buf, _, submitted in batch:
+                metrics.write_latency_seconds.observe((written - submitted) / 1e9)
+                metrics.bytes_written.inc(len(buf))
+            metrics.frames_written.inc(len(batch))
+            with self._stats_lock:
+                self.written += len(batch)
+
+    def _drop(self, count):
+        """
+        Count frames that were not written.
+
+        Returns:
+            True if these are the first dropped frames.
+        """
+        with self._stats_lock:
+            first = self.dropped == 0
+            self.dropped += count
+        metrics.frames_dropped.inc(count)
+        return first
+
+    def _fail(self, error):
+        """
+        Keep the first error from the store and log it, the frames after it are dropped.
+        """
+        with self._stats_lock:
+            if self.error is not None:
+                return
+            self.error = error
+        if self._action is not None:
+            self._action.log(
+                message_type="error", message="Writing frames failed, dropping the rest", error=repr(error)
+            )
+
+    def close(self):
+        """
+        Write the frames left in the queue, stop the threads, close the store and log the statistics.
+        A failed write does not stop the writer, it is logged here and kept in error.
+        """
+        self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if self.fsync != "never" and self.error is None:
+            try:
+                self.store.sync()
+            except OSError as e:
+                self._fail(e)
+        self.store.close()
+        if self._action is not None:
+            self._action.log(
+                message_type="frame_writer_stats",
+                frames_written=self.written,
+                bytes_written=self.store.bytes_written,
+                frames_dropped=self.dropped,
+                queue_high_water=self.high_water,
+                queue_size=self._queue.maxsize,
+                error=None if self.error is None else repr(self.error),
+            )
+            if self.error is None:
+                self._action.finish()
+            else:
+                self._action.finish(self.error)
@@ -0,0 +1,21 @@
+"""
+Benchmarks for the capture path that run without a Raspberry Pi.
+
+Run them from the repository root, e.g. python -m bench.timestamp_overlay
+"""
+import os
+import sys
+import types
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+
+def load_app_package():
+    """
+    Make the modules of the app package importable without running app/__init__.py,
+    which opens the camera, the GPIO chip and the database.
+    """
+    if "app" not in sys.modules:
+        package = types.ModuleType("app")
+        package.__path__ = [APP_DIRECTORY]
+        sys.modules["app"] = package
@@ -0,0 +1,220 @@
+"""
+Benchmark of the whole capture path with a stand-in camera, runs without a Raspberry Pi.
+
+The real Camera, SplitFrames, frame writer and preview broadcaster are run against
+synthetic YUV420 frames: the camera is armed, the race starts, the recording window is
+written and the camera is stopped, while a number of viewers watch the preview stream.
+
+Usage: python -m bench.capture [--fps 100|200] [--width W] [--height H] [--seconds S]
+                               [--viewers N] [--motion-gate] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+
+from bench import fakecamera, load_app_package
+
+fakecamera.install()
+load_app_package()
+
+from app.camera import Camera  # noqa: E402
+from app.framestore import FrameStoreReader  # noqa: E402
+
+
+def percentiles(values):
+    """
+    Summarise durations in microseconds.
+    """
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    summary = {"mean": values.mean(), "max": values.max()}
+    for percentile in (50, 90, 99, 99.9):
+        summary[f"p{percentile:g}"] = np.percentile(values, percentile)
+    return {key: round(float(value), 1) for key, value in summary.items()}
+
+
+class QueueSampler(threading.Thread):
+    """
+    Samples the depth of the frame writer queue.
+    """
+
+    def __init__(self, writer, interval=0.005):
+        super().__init__(daemon=True)
+        self.writer = writer
+        self.interval = interval
+        self.depths = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.depths.append(self.writer._queue.qsize())
+
+
+def watch_preview(camera, max_fps, stopped, counts, index):
+    stream = camera.get_video_stream(max_fps)
+    for _ in stream:
+        counts[index] += 1
+        if stopped.is_set():
+            break
+    stream.close()
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        # The race directories are relative to the working directory
+        os.chdir(directory)
+        camera = Camera(args.fps, False, (args.width, args.height))
+        picam2 = camera.picam2
+
+        stopped = threading.Event()
+        counts = [0] * args.viewers
+        viewers = [
+            threading.Thread(target=watch_preview, args=(camera, args.preview_fps, stopped, counts, i))
+            for i in range(args.viewers)
+        ]
+        for viewer in viewers:
+            viewer.start()
+
+        race = types.SimpleNamespace(start_time="bench")
+        camera.arm(race, (0.5, 0.0, 0.5, 1.0), motion_gate=args.motion_gate)
+        writer = camera.writer
+        sampler = QueueSampler(writer)
+        sampler.start()
+
+        period = 1_000_000_000 // args.fps
+        trigger = int(args.pretrigger * args.fps)
+        # The race starts when the cage opens, the recording is started a little later
+        start_film_at = trigger + args.start_delay
+        window_frames = int(args.seconds * args.fps)
+        total = trigger + window_frames + args.fps // 10
+        race_start = {}
+
+        def on_frame(index, timestamp):
+            if index == total - args.fps // 10:
+                # The viewers leave while frames are still coming, so they see that they should stop
+                stopped.set()
+            if index == trigger:
+                race_start["time"] = timestamp
+            if index == start_film_at:
+                race_start["stop"] = camera.start_film(race_start["time"], 0, args.seconds)
+
+        started = time.perf_counter()
+        picam2.run(total, args.fps, realtime=not args.no_realtime, on_frame=on_frame)
+        picam2.drain()
+        captured = time.perf_counter()
+        encoder_depths = {name: thread.max_depth for name, thread in picam2.encoder_threads()}
+        stop_started = time.perf_counter_ns()
+        camera.stop_film()
+        stop_ms = (time.perf_counter_ns() - stop_started) / 1e6
+        sampler.stopped.set()
+        for viewer in viewers:
+            viewer.join()
+
+        elapsed = captured - started
+        stored = FrameStoreReader(os.path.join("app/static/race", race.start_time))
+        timestamps = stored.timestamps
+        intervals = np.diff(timestamps) if len(timestamps) > 1 else np.empty(0)
+
+        request = fakecamera.FakeRequest(
+            {"main": picam2._pool["main"][0]}, race_start["time"] + period
+        )
+        durations = []
+        for _ in range(1000):
+            start = time.perf_counter_ns()
+            camera.apply_timestamp(request, race_start["time"])
+            durations.append((time.perf_counter_ns() - start) / 1000)
+
+        return {
+            "config": {
+                "width": args.width,
+                "height": args.height,
+                "fps": args.fps,
+                "seconds": args.seconds,
+                "viewers": args.viewers,
+                "motion_gate": args.motion_gate,
+                "realtime": not args.no_realtime,
+                "writer_threads": len(writer._threads),
+                "writer_queue_size": writer._queue.maxsize,
+                "writer_overflow": writer.overflow,
+                "writer_fsync": writer.fsync,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+            },
+            "frames_captured": total,
+            "late_frames": picam2.late_frames,
+            "pre_callback_us": percentiles(picam2.callback_latencies),
+            "apply_timestamp_us": percentiles(durations),
+            "encoder_queue_max": encoder_depths,
+            "writer": {
+                "submitted": writer.submitted,
+                "dropped": writer.dropped,
+                "queue_high_water": writer.high_water,
+                "queue_depth": {
+                    "mean": round(float(np.mean(sampler.depths)), 1) if sampler.depths else 0,
+                    "max": int(max(sampler.depths, default=0)),
+                },
+                "bytes_written": writer.store.bytes_written,
+                "throughput_mb_s": round(writer.store.bytes_written / elapsed / 1e6, 2),
+                "stop_film_ms": round(stop_ms, 1),
+            },
+            "stored": {
+                "expected_frames": window_frames,
+                "frames": len(stored),
+                "skipped_frames": int(np.count_nonzero(stored.index["length"] == 0)),
+                "max_interval_ms": round(float(intervals.max()) / 1e6, 2) if len(intervals) else None,
+            },
+            "preview": {
+                "frames_per_viewer": counts,
+                "fps_per_viewer": [round(count / elapsed, 1) for count in counts],
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fps", type=int, default=100)
+    parser.add_argument("--width", type=int, default=1332)
+    parser.add_argument("--height", type=int, default=990)
+    parser.add_argument("--seconds", type=float, default=5, help="length of the recording window")
+    parser.add_argument("--pretrigger", type=float, default=1, help="seconds armed before the race starts")
+    parser.add_argument("--start-delay", type=int, default=5, help="frames between the race start and start_film")
+    parser.add_argument("--viewers", type=int, default=2)
+    parser.add_argument("--preview-fps", type=float, default=25)
+    parser.add_argument("--motion-gate", action="store_true", help="only store frames with motion")
+    parser.add_argument("--no-realtime", action="store_true", help="capture as fast as possible")
+    parser.add_argument("--output", default="capture_results.json")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    results = run(args)
+
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    callback = results["pre_callback_us"]
+    writer = results["writer"]
+    print(f"{args.width}x{args.height} at {args.fps} fps, {args.seconds} s window, {args.viewers} viewers")
+    print(
+        f"pre_callback   p50 {callback['p50']} µs  p99 {callback['p99']} µs  max {callback['max']} µs"
+    )
+    print(
+        f"writer         {writer['throughput_mb_s']} MB/s  queue max {writer['queue_depth']['max']}"
+        f"  dropped {writer['dropped']}  late frames {results['late_frames']}"
+    )
+    print(
+        f"stored         {results['stored']['frames']} of {results['stored']['expected_frames']} frames"
+        f" ({results['stored']['skipped_frames']} skipped)"
+        f"  preview fps {results['preview']['fps_per_viewer']}"
+    )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
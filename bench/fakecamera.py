@@ -0,0 +1,268 @@
+"""
+A stand-in for Picamera2 that produces synthetic YUV420 frames, so the capture path
+can be run and measured on a computer without a camera.
+
+install() puts the stand-in in place of the picamera2 and libcamera modules, it has
+to be called before app.camera is imported.
+"""
+import queue
+import sys
+import threading
+import time
+import types
+
+import cv2
+import numpy as np
+
+
+def _stride(width):
+    # Picamera2 pads the rows of YUV420 buffers to a multiple of 64 bytes
+    return (width + 63) // 64 * 64
+
+
+class FakeRequest:
+    """
+    A captured frame with one array per stream and its metadata.
+    """
+
+    def __init__(self, arrays, timestamp):
+        self.arrays = arrays
+        self.metadata = {"SensorTimestamp": timestamp}
+
+    def get_metadata(self):
+        return self.metadata
+
+
+class MappedArray:
+    def __init__(self, request, stream, *args, **kwargs):
+        self.array = request.arrays[stream]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class MJPEGEncoder:
+    def __init__(self, bitrate=None, *args, **kwargs):
+        self.bitrate = bitrate
+        self.firsttimestamp = None
+        self.output = None
+
+
+class FileOutput:
+    def __init__(self, file=None, *args, **kwargs):
+        self.fileoutput = file
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.fileoutput.write(frame)
+
+
+class _EncoderThread(threading.Thread):
+    """
+    Hands the encoded frames to the output of an encoder, like the encoder thread of Picamera2.
+    """
+
+    def __init__(self, encoder, jpegs):
+        super().__init__(daemon=True)
+        self.encoder = encoder
+        self.jpegs = jpegs
+        self.queue = queue.Queue()
+        self.max_depth = 0
+        # Each counter is only written by one thread
+        self.submitted = 0
+        self.processed = 0
+        self.latencies = []
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            index, timestamp, captured = item
+            if self.encoder.firsttimestamp is None:
+                self.encoder.firsttimestamp = timestamp // 1000
+            self.encoder.output.outputframe(
+                self.jpegs[index % len(self.jpegs)],
+                True,
+                timestamp // 1000 - self.encoder.firsttimestamp,
+            )
+            self.latencies.append((time.perf_counter_ns() - captured) / 1000)
+            self.processed += 1
+
+    def put(self, item):
+        if item is not None:
+            self.submitted += 1
+        self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+
+class Picamera2:
+    """
+    Produces frames from run() instead of a sensor. Every frame goes through the
+    pre_callback and is then passed to the started encoders as a pre-encoded JPEG
+    of the same size, so the time spent is the time of the code under test.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.started = False
+        self.pre_callback = None
+        self._config = None
+        self._encoders = {}
+        self._jpegs = {}
+        self._lock = threading.Lock()
+        self.callback_latencies = []
+        self.late_frames = 0
+
+    def create_video_configuration(self, main=None, lores=None, **kwargs):
+        config = dict(kwargs)
+        for name, stream in (("main", main), ("lores", lores)):
+            if stream is not None:
+                config[name] = dict(stream, stride=_stride(stream["size"][0]))
+        return config
+
+    def configure(self, config):
+        self._config = config
+        self._pool = {}
+        rng = np.random.default_rng(0)
+        for name in ("main", "lores"):
+            if name not in config:
+                continue
+            width, height = config[name]["size"]
+            shape = (height * 3 // 2, config[name]["stride"])
+            # A gradient with some noise compresses to about the size of a real frame
+            gradient = np.linspace(16, 235, shape[1], dtype=np.float32)[np.newaxis, :]
+            self._pool[name] = [
+                np.clip(gradient + rng.normal(0, 6, shape), 0, 255).astype(np.uint8) for _ in range(4)
+            ]
+            self._jpegs[name] = [
+                cv2.imencode(".jpg", frame[:height, :width], [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+                for frame in self._pool[name]
+            ]
+
+    def camera_configuration(self):
+        return self._config
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def switch_mode(self, config):
+        self.configure(config)
+
+    def start_encoder(self, encoder, output, name="main", *args, **kwargs):
+        encoder.output = output
+        thread = _EncoderThread(encoder, self._jpegs[name])
+        thread.start()
+        with self._lock:
+            self._encoders[encoder] = (name, thread)
+
+    def stop_encoder(self, encoders=None):
+        with self._lock:
+            if encoders is None:
+                stopping = list(self._encoders)
+            elif isinstance(encoders, (list, tuple, set)):
+                stopping = list(encoders)
+            else:
+                stopping = [encoders]
+            threads = [self._encoders.pop(encoder)[1] for encoder in stopping if encoder in self._encoders]
+        for thread in threads:
+            thread.put(None)
+            thread.join()
+
+    def encoder_threads(self):
+        """
+        Get the encoder threads that are running, by stream name.
+        """
+        with self._lock:
+            return [(name, thread) for name, thread in self._encoders.values()]
+
+    def run(self, frames, fps, realtime=True, on_frame=None):
+        """
+        Capture frames at the given frame rate.
+
+        Args:
+            frames (int): The number of frames to capture.
+            fps (int): The frame rate.
+            realtime (bool): Wait for the time of each frame instead of capturing as fast as possible.
+            on_frame: A function called with the frame index and its sensor timestamp before each frame.
+        """
+        period = 1_000_000_000 // fps
+        start = time.monotonic_ns()
+        for index in range(frames):
+            due = start + index * period
+            if realtime:
+                delay = due - time.monotonic_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+                elif -delay > period:
+                    # A camera with no free buffer would have dropped this frame
+                    self.late_frames += 1
+            timestamp = due if realtime else time.monotonic_ns()
+            if on_frame is not None:
+                on_frame(index, timestamp)
+            arrays = {name: pool[index % len(pool)] for name, pool in self._pool.items()}
+            request = FakeRequest(arrays, timestamp)
+            captured = time.perf_counter_ns()
+            callback = self.pre_callback
+            if callback is not None:
+                callback(request)
+            self.callback_latencies.append((time.perf_counter_ns() - captured) / 1000)
+            for name, thread in self.encoder_threads():
+                thread.put((index, timestamp, captured))
+
+    def drain(self):
+        """
+        Wait until the encoders have handed over every captured frame.
+        """
+        for _, thread in self.encoder_threads():
+            while thread.processed < thread.submitted:
+                time.sleep(0.001)
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+class _Enum:
+    def __getattr__(self, name):
+        return name
+
+
+def install():
+    """
+    Replace the picamera2 and libcamera modules with the stand-in.
+    """
+    encoders = _module("picamera2.encoders", MJPEGEncoder=MJPEGEncoder)
+    outputs = _module("picamera2.outputs", FileOutput=FileOutput)
+    picamera2 = _module(
+        "picamera2",
+        Picamera2=Picamera2,
+        MappedArray=MappedArray,
+        encoders=encoders,
+        outputs=outputs,
+        __path__=[],
+    )
+    controls = _module(
+        "libcamera.controls",
+        AeExposureModeEnum=_Enum(),
+        AeConstraintModeEnum=_Enum(),
+        AeFlickerModeEnum=_Enum(),
+        AeMeteringModeEnum=_Enum(),
+    )
+    transform = lambda hflip=False, vflip=False: types.SimpleNamespace(hflip=hflip, vflip=vflip)  # noqa: E731
+    libcamera = _module("libcamera", Transform=transform, controls=controls)
+    sys.modules.update(
+        {
+            "picamera2": picamera2,
+            "picamera2.encoders": encoders,
+            "picamera2.outputs": outputs,
+            "libcamera": libcamera,
+            "libcamera.controls": controls,
+        }
+    )
@@ -0,0 +1,180 @@
+"""
+Hammers the race state and the database from many threads at once, runs without a Raspberry Pi.
+
+One thread plays the capture daemon and creates, starts and finishes races through
+RaceState as fast as it can. Other threads play the GPIO callback and read the running
+race from the state, and others play the web workers, which read the running race from
+the database and change the configuration. Afterwards the database has to agree with
+the state and no thread may have seen an inconsistent race or a locked database.
+
+Usage: python -m bench.state [--seconds S] [--readers N] [--web-threads N] [--no-wal]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import OperationalError
+
+from bench import load_app_package
+
+load_app_package()
+
+from app import database  # noqa: E402
+
+
+def percentiles(values):
+    """
+    Summarise durations in microseconds.
+    """
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    return {name: round(float(np.percentile(values, q)), 1) for name, q in (("p50", 50), ("p99", 99))}
+
+
+def create_app(path, wal):
+    """
+    Create a Flask application with its own database, set up like the real one.
+    """
+    flask_app = Flask("bench")
+    flask_app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options()
+    db = SQLAlchemy(flask_app)
+    # The models and the state take the database from the app package
+    sys.modules["app"].db = db
+    with flask_app.app_context():
+        if wal:
+            database.setup(db)
+        from app import models  # noqa: F401
+
+        db.create_all()
+        db.session.add(models.Config())
+        db.session.commit()
+    return flask_app, db
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        flask_app, db = create_app(os.path.join(directory, "data.db"), not args.no_wal)
+        from app import models
+        from app.state import RaceState
+
+        state = RaceState()
+        with flask_app.app_context():
+            state.load()
+        stopped = threading.Event()
+        errors = []
+        races = [0]
+        state_reads = [[] for _ in range(args.readers)]
+        database_reads = [[] for _ in range(args.web_threads)]
+        config_writes = [0] * args.web_threads
+
+        def daemon():
+            with flask_app.app_context():
+                while not stopped.is_set():
+                    try:
+                        race = state.create_race(f"race-{races[0]:06d}", "task")
+                        state.start_race()
+                        if state.race.id != race.id or not state.race.started:
+                            errors.append("The started race is not the running race")
+                        state.finish_race(frame_count=races[0], byte_size=0)
+                        if races[0] % 10 == 0:
+                            state.reload_config()
+                        races[0] += 1
+                    except OperationalError as e:
+                        errors.append(f"daemon: {e}")
+
+        def gpio(samples):
+            while not stopped.is_set():
+                started = time.perf_counter_ns()
+                race = state.race
+                config = state.config
+                samples.append((time.perf_counter_ns() - started) / 1000)
+                if race is not None and not race.running:
+                    errors.append("A finished race is the running race")
+                if config is None:
+                    errors.append("The configuration is missing")
+
+        def web(index, samples):
+            with flask_app.app_context():
+                while not stopped.is_set():
+                    try:
+                        started = time.perf_counter_ns()
+                        running = models.Race.query.filter_by(running=True).all()
+                        models.Config.query.first()
+                        samples.append((time.perf_counter_ns() - started) / 1000)
+                        if len(running) > 1:
+                            errors.append("More than one race is running")
+                        db.session.rollback()
+                        if len(samples) % 20 == 0:
+                            config = models.Config.query.first()
+                            config.start_filming_after = len(samples) % 10
+                            db.session.commit()
+                            config_writes[index] += 1
+                    except OperationalError as e:
+                        db.session.rollback()
+                        errors.append(f"web: {e}")
+
+        threads = [threading.Thread(target=daemon)]
+        threads += [threading.Thread(target=gpio, args=(samples,)) for samples in state_reads]
+        threads += [
+            threading.Thread(target=web, args=(index, samples)) for index, samples in enumerate(database_reads)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+        with flask_app.app_context():
+            running = models.Race.query.filter_by(running=True).count()
+            finished = models.Race.query.filter_by(running=False, started=True).count()
+            if running != (0 if state.race is None else 1):
+                errors.append(f"{running} races are running in the database")
+            if finished != state.finished:
+                errors.append(f"{finished} finished races in the database, {state.finished} in the state")
+            journal = db.session.execute(db.text("PRAGMA journal_mode")).scalar()
+
+        return {
+            "journal_mode": journal,
+            "races_per_second": round(races[0] / args.seconds, 1),
+            "state_read_us": percentiles([value for samples in state_reads for value in samples]),
+            "database_read_us": percentiles([value for samples in database_reads for value in samples]),
+            "config_writes": sum(config_writes),
+            "errors": errors[:10],
+            "error_count": len(errors),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--readers", type=int, default=2, help="threads reading the state like the GPIO callback")
+    parser.add_argument("--web-threads", type=int, default=5, help="threads using the database like a web worker")
+    parser.add_argument("--no-wal", action="store_true", help="keep the default rollback journal")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(
+        f"journal {results['journal_mode']}  {results['races_per_second']} races/s"
+        f"  {results['config_writes']} configuration writes"
+    )
+    print(f"state read     {results['state_read_us']} µs")
+    print(f"database read  {results['database_read_us']} µs")
+    print(f"errors         {results['error_count']}")
+    for error in results["errors"]:
+        print(f"  {error}")
+    if results["error_count"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
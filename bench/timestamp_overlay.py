@@ -0,0 +1,87 @@
+"""
+Microbenchmark of the race clock overlay, cv2.putText compared to the glyph atlas.
+
+Usage: python -m bench.timestamp_overlay [--frames N] [--width W] [--height H]
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from bench import load_app_package
+
+load_app_package()
+
+from app.constants import (TIMESTAMP_COLOUR, TIMESTAMP_FONT,  # noqa: E402
+                           TIMESTAMP_ORIGIN, TIMESTAMP_SCALE,
+                           TIMESTAMP_THICKNESS)
+from app.overlay import TimestampRenderer, format_timestamp  # noqa: E402
+
+
+def put_text(array, elapsed_ns):
+    cv2.putText(
+        array,
+        format_timestamp(elapsed_ns),
+        TIMESTAMP_ORIGIN,
+        TIMESTAMP_FONT,
+        TIMESTAMP_SCALE,
+        TIMESTAMP_COLOUR,
+        TIMESTAMP_THICKNESS,
+    )
+
+
+def measure(draw, frames, timestamps):
+    """
+    Time draw() on every frame and return the durations in microseconds.
+    """
+    durations = np.empty(len(timestamps))
+    for i, elapsed_ns in enumerate(timestamps):
+        frame = frames[i % len(frames)]
+        start = time.perf_counter_ns()
+        draw(frame, elapsed_ns)
+        durations[i] = (time.perf_counter_ns() - start) / 1000
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--frames", type=int, default=2500)
+    parser.add_argument("--width", type=int, default=1332)
+    parser.add_argument("--height", type=int, default=990)
+    parser.add_argument("--fps", type=int, default=100)
+    args = parser.parse_args()
+
+    # YUV420 frames are mapped with the rows padded to a multiple of 64 bytes
+    stride = (args.width + 63) // 64 * 64
+    shape = (args.height * 3 // 2, stride)
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(8)]
+    timestamps = [i * 1_000_000_000 // args.fps for i in range(args.frames)]
+
+    renderer = TimestampRenderer()
+    start = time.perf_counter_ns()
+    renderer.prepare(shape)
+    prepare_ms = (time.perf_counter_ns() - start) / 1e6
+
+    for elapsed_ns in timestamps[:: max(1, args.frames // 50)]:
+        expected = frames[0].copy()
+        actual = frames[0].copy()
+        put_text(expected, elapsed_ns)
+        renderer.render(actual, elapsed_ns)
+        if not np.array_equal(expected, actual):
+            raise SystemExit(f"Overlay differs from cv2.putText at {elapsed_ns} ns")
+
+    print(f"{args.width}x{args.height} YUV420, {args.frames} frames at {args.fps} fps")
+    print(f"Glyph atlas prepared in {prepare_ms:.1f} ms, exact: {renderer.exact}")
+    print(f"{'path':<12}{'mean':>10}{'p50':>10}{'p99':>10}{'max':>10}  (µs per frame)")
+    for name, draw in (("putText", put_text), ("atlas", renderer.render)):
+        durations = measure(draw, frames, timestamps)
+        print(
+            f"{name:<12}{durations.mean():>10.1f}{np.percentile(durations, 50):>10.1f}"
+            f"{np.percentile(durations, 99):>10.1f}{durations.max():>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()